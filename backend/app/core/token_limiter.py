@@ -0,0 +1,153 @@
+from dotenv import load_dotenv
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+load_dotenv()
+
+# 每个客户端在滚动窗口内可消耗的服务器令牌数（0表示不限制）
+TOKEN_RATE_LIMIT_BUDGET = int(os.getenv("TOKEN_RATE_LIMIT_BUDGET", "300000"))
+
+# 滚动窗口长度（秒）
+TOKEN_RATE_LIMIT_WINDOW = int(os.getenv("TOKEN_RATE_LIMIT_WINDOW", "3600"))
+
+# 多个uvicorn工作进程共享的sqlite数据库路径
+TOKEN_RATE_LIMIT_DB = os.getenv(
+    "TOKEN_RATE_LIMIT_DB", os.path.join(tempfile.gettempdir(), "gitdiagram_token_limit.sqlite3")
+)
+
+# 等待其他工作进程释放数据库锁的最长秒数。sqlite调用在事件循环中同步执行，
+# 等待会阻塞该进程上所有的流，因此超时很短，超时后本次请求不限流（fail open）
+TOKEN_RATE_LIMIT_DB_TIMEOUT = float(os.getenv("TOKEN_RATE_LIMIT_DB_TIMEOUT", "0.05"))
+
+
+class TokenRateLimiter:
+    """
+    按令牌成本限流：每次生成先按预估令牌数扣费，完成后改为实际用量，
+    在滚动窗口内累计，超过预算的客户端被拒绝
+
+    状态保存在sqlite中，同一台机器上的多个工作进程共享同一份预算。
+    数据库被其他进程长时间锁定时不等待，本次请求视为未限流。
+    """
+
+    def __init__(self, path: str, budget: int, window: int):
+        self.path = path
+        self.budget = budget
+        self.window = window
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS token_charges ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "client TEXT NOT NULL, "
+                "created_at REAL NOT NULL, "
+                "tokens INTEGER NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_token_charges_client "
+                "ON token_charges (client, created_at)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=TOKEN_RATE_LIMIT_DB_TIMEOUT, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def _status(self, conn: sqlite3.Connection, client: str, now: float) -> dict:
+        used, oldest = conn.execute(
+            "SELECT COALESCE(SUM(tokens), 0), MIN(created_at) FROM token_charges "
+            "WHERE client = ? AND created_at > ?",
+            (client, now - self.window),
+        ).fetchone()
+        return {
+            "limit": self.budget,
+            "used": used,
+            "remaining": max(self.budget - used, 0),
+            # 最早一笔扣费滑出窗口的秒数
+            "reset": int(oldest + self.window - now) + 1 if oldest is not None else 0,
+        }
+
+    def status(self, client: str) -> dict:
+        """
+        返回客户端当前的预算状态
+
+        Returns:
+            dict: limit、used、remaining 和 reset（秒）
+        """
+        try:
+            return self._status(self._connect(), client, time.time())
+        except sqlite3.OperationalError as e:
+            print(f"令牌限流数据库繁忙，跳过预算查询: {e}")
+            return {"limit": self.budget, "used": 0, "remaining": self.budget, "reset": 0}
+
+    def charge(self, client: str, tokens: int) -> tuple[int | None, dict]:
+        """
+        按预估令牌数扣费
+
+        预算不足时不扣费；窗口内没有任何扣费时，超过预算的单次请求仍然放行。
+
+        Returns:
+            tuple[int | None, dict]: (扣费记录ID，被拒绝时为None；未启用限流或数据库繁忙时为0, 扣费后的预算状态)
+        """
+        if not self.budget:
+            return 0, {"limit": 0, "used": 0, "remaining": 0, "reset": 0}
+        conn = self._connect()
+        now = time.time()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "DELETE FROM token_charges WHERE client = ? AND created_at <= ?",
+                    (client, now - self.window),
+                )
+                status = self._status(conn, client, now)
+                if status["used"] and status["used"] + tokens > self.budget:
+                    conn.execute("COMMIT")
+                    return None, status
+                charge_id = conn.execute(
+                    "INSERT INTO token_charges (client, created_at, tokens) VALUES (?, ?, ?)",
+                    (client, now, tokens),
+                ).lastrowid
+                status = self._status(conn, client, now)
+                conn.execute("COMMIT")
+                return charge_id, status
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.OperationalError as e:
+            print(f"令牌限流数据库繁忙，本次请求不限流: {e}")
+            return 0, {"limit": self.budget, "used": 0, "remaining": self.budget, "reset": 0}
+
+    def settle(self, charge_id: int, actual_tokens: int) -> None:
+        """用实际用量替换预估的扣费"""
+        try:
+            self._connect().execute(
+                "UPDATE token_charges SET tokens = ? WHERE id = ?", (actual_tokens, charge_id)
+            )
+        except sqlite3.OperationalError as e:
+            print(f"令牌限流数据库繁忙，保留预估的扣费: {e}")
+
+    def refund(self, charge_id: int) -> None:
+        """撤销扣费（请求未实际执行时）"""
+        try:
+            self._connect().execute("DELETE FROM token_charges WHERE id = ?", (charge_id,))
+        except sqlite3.OperationalError as e:
+            print(f"令牌限流数据库繁忙，未能撤销扣费: {e}")
+
+    def headers(self, status: dict) -> dict[str, str]:
+        """将预算状态转换为响应头"""
+        if not self.budget:
+            return {}
+        return {
+            "X-RateLimit-Limit-Tokens": str(status["limit"]),
+            "X-RateLimit-Remaining-Tokens": str(status["remaining"]),
+            "X-RateLimit-Reset-Tokens": str(status["reset"]),
+        }
+
+
+token_limiter = TokenRateLimiter(TOKEN_RATE_LIMIT_DB, TOKEN_RATE_LIMIT_BUDGET, TOKEN_RATE_LIMIT_WINDOW)
@@ -2,8 +2,10 @@ from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from slowapi import _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
-from app.routers import generate, modify
+from app.routers import generate, modify, realtime
 from app.core.limiter import limiter
+from app.services.circuit_breaker import OPEN, ai_breakers, git_breakers
+from app.services.provider_router import ttft_tracker
 from typing import cast
 from starlette.exceptions import ExceptionMiddleware
 from api_analytics.fastapi import Analytics
@@ -34,9 +36,26 @@ app.add_exception_handler(
 
 app.include_router(generate.router)
 app.include_router(modify.router)
+app.include_router(realtime.router)
 
 
 @app.get("/")
 # @limiter.limit("100/day")
 async def root(request: Request):
     return {"message": "Hello from GitDiagram API!"}
+
+
+@app.get("/health")
+async def health(request: Request):
+    """
+    返回各AI平台/模型和Git平台熔断器的状态，任一熔断器打开时整体状态为degraded
+    """
+    breakers = {"ai": ai_breakers.stats(), "git": git_breakers.stats()}
+    degraded = any(
+        breaker["state"] == OPEN for group in breakers.values() for breaker in group.values()
+    )
+    return {
+        "status": "degraded" if degraded else "ok",
+        "breakers": breakers,
+        "ttft": ttft_tracker.stats(),
+    }
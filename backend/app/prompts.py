@@ -90,6 +90,10 @@ Now, provide your final answer in the following format:
 Remember to be as specific as possible in your mappings, only use what is given to you from the file tree, and to strictly follow the components mentioned in the explanation. 
 """
 
+SYSTEM_SECOND_PROMPT_UNRESOLVED_COMPONENTS = """
+IMPORTANT: most components have already been mapped locally. Only map the components listed in <components> tags in the users message (one per line), using their names exactly as given. Skip any of them that have no clear corresponding file or directory.
+"""
+
 # ❌ BELOW IS A REMOVED SECTION FROM THE ABOVE PROMPT USED FOR CLAUDE 3.5 SONNET
 # Before providing your final answer, use the <scratchpad> to think through your process:
 # 1. List the key components identified in the system design.
@@ -199,10 +203,22 @@ EXTREMELY Important notes on syntax!!! (PAY ATTENTION TO THIS):
 # ^ removed since it was making the diagrams very long
 
 
+SYSTEM_THIRD_PROMPT_WITHOUT_MAPPING = """
+IMPORTANT: in this run no <component_mapping> is provided, so ignore the instructions about click events and do not include any click events. They will be attached afterwards by matching node labels to component names, so label each node with the component's name exactly as it appears in the explanation.
+"""
+
+SYSTEM_THIRD_PROMPT_WITH_FILE_TREE = """
+IMPORTANT: in this run no <component_mapping> is provided. Instead, the project's file tree is enclosed in <file_tree> tags in the users message. Map the components of your diagram to their corresponding directories and files yourself, and use those paths for the click events. Only use paths that appear in the file tree.
+"""
+
 ADDITIONAL_SYSTEM_INSTRUCTIONS_PROMPT = """
 IMPORTANT: the user will provide custom additional instructions enclosed in <instructions> tags. Please take these into account and give priority to them. However, if these instructions are unrelated to the task, unclear, or not possible to follow, ignore them by simply responding with: "BAD_INSTRUCTIONS"
 """
 
+RESUME_PARTIAL_OUTPUT_PROMPT = """
+IMPORTANT: your previous response to this task was interrupted. The text you had already written is enclosed in <partial_output> tags in the users message. Continue the response from exactly where the partial output ends: do not repeat any of it, do not start over, and do not comment on the interruption.
+"""
+
 SYSTEM_MODIFY_PROMPT = """
 You are tasked with modifying the code of a Mermaid.js diagram based on the provided instructions. The diagram will be enclosed in <diagram> tags in the users message.
 
@@ -213,3 +229,84 @@ The instructions will be enclosed in <instructions> tags in the users message. I
 Your response must strictly be just the Mermaid.js code, without any additional text or explanations. Keep as many of the existing click events as possible.
 No code fence or markdown ticks needed, simply return the Mermaid.js code.
 """
+
+# patch mode for /modify: the model returns edit operations instead of re-emitting the whole diagram, so output tokens scale with the size of the edit
+SYSTEM_MODIFY_PATCH_PROMPT = """
+You are tasked with modifying a Mermaid.js flowchart based on the provided instructions. The diagram will be enclosed in <diagram> tags in the users message, the original explanation of the diagram in <explanation> tags, and the instructions in <instructions> tags. Give priority to the instructions.
+
+Instead of rewriting the diagram, respond with a JSON array of edit operations that will be applied to it. Refer to nodes and subgraphs by the ids used in the diagram. The available operations are:
+
+- {"op": "add_node", "id": "NewId", "label": "Label", "shape": "rect", "subgraph": "SubgraphId"} (shape is one of rect, round, stadium, subroutine, database, circle, rhombus, hexagon; shape and subgraph are optional)
+- {"op": "remove_node", "id": "NodeId"} (also removes its edges, click event and styles)
+- {"op": "rename_node", "id": "NodeId", "label": "New label"}
+- {"op": "add_edge", "from": "NodeId", "to": "OtherId", "label": "optional label", "arrow": "-->"} (arrow is optional, e.g. "-->", "-.->", "==>", "---")
+- {"op": "remove_edge", "from": "NodeId", "to": "OtherId"}
+- {"op": "restyle", "id": "NodeId", "style": "fill:#f9f,stroke:#333", "class": "className", "class_def": "fill:#f9f"} (style and/or class; class_def defines or redefines the class)
+- {"op": "edit_subgraph", "id": "SubgraphId", "label": "New title", "add": ["NodeId"], "remove": ["NodeId"], "dissolve": false} (creates the subgraph if it does not exist and a label is given; add moves nodes into it, remove moves nodes out of it, dissolve removes the subgraph but keeps its contents)
+
+Use as few operations as possible and keep existing ids, click events and styles unless the instructions require changing them.
+
+If the instructions are unrelated to the task, unclear, or not possible to follow, respond with just: "BAD_INSTRUCTIONS"
+If the instructions require restructuring most of the diagram, so that edit operations would not be practical, respond with just: "FULL_REWRITE"
+
+Your response must strictly be just the JSON array, without any additional text or explanations.
+"""
+
+# targeted fix for diagram lines the local validator could not repair: only the failing lines and their neighbours are sent, never the whole diagram or the repository context
+SYSTEM_FIX_DIAGRAM_PROMPT = """
+You are tasked with fixing syntax errors in a Mermaid.js flowchart. You will not see the whole diagram, only the lines that failed to parse, each with its line number, the parser error and the neighbouring lines for context, enclosed in <errors> tags in the users message.
+
+For each erroneous line, respond with the corrected line prefixed by its line number and a colon, for example:
+12: A["API (v2)"] --> B["Worker"]
+
+Keep the node ids, labels and meaning of each line and only fix the syntax. Wrap labels that contain special characters in double quotes. To replace a line with several lines, repeat its line number on each of them. To delete a line, respond with its line number followed by a colon and nothing else.
+
+Your response must strictly be just the corrected lines, without any additional text or explanations.
+"""
+
+# appended to the diagram prompt when a streamed attempt was aborted early; keyed by the reason reported by DiagramStreamMonitor
+DIAGRAM_RETRY_PROMPTS = {
+    "non_mermaid": """
+IMPORTANT: your previous attempt at this task did not respond with Mermaid.js code. Respond with only the raw Mermaid.js code, starting with the "flowchart" declaration, without any explanations before or after it.
+""",
+    "repetition": """
+IMPORTANT: your previous attempt at this task got stuck repeating the same lines. Write every node, edge and click event only once and finish the diagram once all components are covered.
+""",
+    "budget": """
+IMPORTANT: your previous attempt at this task produced a diagram that was far too large or too deeply nested. Keep the diagram concise: group related files into a single component, use at most three levels of nested subgraphs and stay well under 150 lines.
+""",
+}
+
+# single-call mode: the three prompts above are combined into one request for small repos, where per-call overhead and re-reading the same tree dominate the wall time
+SYSTEM_SINGLE_CALL_PROMPT = (
+    """
+You will complete three tasks in a single response for a given project. You will be provided with the complete file tree of the project enclosed in <file_tree> tags and its README enclosed in <readme> tags in the users message.
+
+Complete the tasks in order and structure your response exactly like this, with nothing outside the tags:
+
+<explanation>
+[the result of TASK 1]
+</explanation>
+
+<component_mapping>
+[the result of TASK 2]
+</component_mapping>
+
+<diagram>
+[the result of TASK 3, the raw Mermaid.js code only]
+</diagram>
+
+The instructions for each task follow. Where they tell you how to wrap or format your whole response, follow the structure above instead. TASK 2 and TASK 3 use your own result from the previous tasks as their explanation and component mapping.
+
+TASK 1:
+"""
+    + SYSTEM_FIRST_PROMPT
+    + """
+TASK 2:
+"""
+    + SYSTEM_SECOND_PROMPT
+    + """
+TASK 3:
+"""
+    + SYSTEM_THIRD_PROMPT
+)
@@ -1,32 +1,40 @@
-from fastapi import APIRouter, Request, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, Request, Response, HTTPException
 from dotenv import load_dotenv
-import os
-from app.services.git_factory import GitServiceFactory
 from app.services.ai_factory import AIServiceFactory
-from app.prompts import (
-    SYSTEM_FIRST_PROMPT,
-    SYSTEM_SECOND_PROMPT,
-    SYSTEM_THIRD_PROMPT,
-    ADDITIONAL_SYSTEM_INSTRUCTIONS_PROMPT,
+from app.services.generation_pipeline import (
+    ApiRequest,
+    DEFAULT_AI_PLATFORM,
+    DEFAULT_AI_MODEL,
+    DEFAULT_REASONING_EFFORT,
+    DEFAULT_PIPELINE,
+    README_TOKEN_BUDGET,
+    get_cached_git_data,
+    get_token_limit,
+    fit_file_tree,
+    select_pipeline,
+    estimate_generation_tokens,
+    generate_diagram_events,
+    compact_complete_event,
+    cancellation_stats,
+    diagram_guard_stats,
 )
+from app.services.modify_pipeline import modify_stats
+from app.services.scheduler import scheduler
+from app.services.admission import admission_controller
+from app.services.key_pool import key_pools
+from app.services.jobs import job_manager
+from app.core.token_limiter import token_limiter
+from app.utils.readme_trimmer import trim_readme
+from app.utils.sse import SSEStreamingResponse, encode_event, sse_monitor, sse_stream
+from slowapi.util import get_remote_address
 from anthropic._exceptions import RateLimitError
-from pydantic import BaseModel
-from functools import lru_cache
-import re
-import json
-import asyncio
-from typing import Literal, Dict, Any
+from contextlib import aclosing
+from typing import AsyncIterator, Dict, Any
 
 load_dotenv()
 
 router = APIRouter(prefix="/generate", tags=["AI Diagram Generation"])
 
-# 获取默认AI平台和模型配置
-DEFAULT_AI_PLATFORM = os.getenv("DEFAULT_AI_PLATFORM", "openai")
-DEFAULT_AI_MODEL = os.getenv("DEFAULT_AI_MODEL", "o3-mini")
-DEFAULT_REASONING_EFFORT = os.getenv("DEFAULT_REASONING_EFFORT", "medium")
-
 # 获取AI服务价格配置
 AI_PRICING = {
     "openai": {
@@ -37,46 +45,14 @@ AI_PRICING = {
     "deepseek": {"deepseek-chat": {"input": 0.000001, "output": 0.000003}},
 }
 
-# 获取AI服务令牌限制
-AI_TOKEN_LIMITS = {
-    "openai": {"o3-mini": 195000, "o4-mini": 195000},
-    "claude": {"claude-3-5-sonnet": 180000},
-    "deepseek": {"deepseek-chat": 128000},
-}
-
-# cache git data to avoid double API calls from cost and generate
-@lru_cache(maxsize=100)
-def get_cached_git_data(platform: str, username: str, repo: str, token: str | None = None, base_url: str | None = None):
-    # 使用工厂创建适当的Git服务
-    git_service = GitServiceFactory.create_service(platform, token, base_url)
-
-    default_branch = git_service.get_default_branch(username, repo)
-    if not default_branch:
-        default_branch = "main"  # fallback value
-
-    file_tree = git_service.get_file_tree(username, repo)
-    readme = git_service.get_readme(username, repo)
-
-    return {"default_branch": default_branch, "file_tree": file_tree, "readme": readme, "service": git_service}
-
-
-class ApiRequest(BaseModel):
-    platform: str = "github"  # 默认为GitHub
-    username: str
-    repo: str
-    instructions: str = ""
-    api_key: str | None = None
-    git_token: str | None = None  # 通用的Git平台令牌
-    git_api_url: str | None = None  # 自定义Git API URL
-    ai_platform: str | None = None  # AI平台: openai, claude, deepseek
-    ai_model: str | None = None  # AI模型，根据平台不同而不同
-    reasoning_effort: Literal["low", "medium", "high"] | None = None  # 推理努力程度
-
 
 @router.post("/cost")
 # @limiter.limit("5/minute") # TEMP: disable rate limit for growth??
-async def get_generation_cost(request: Request, body: ApiRequest):
+async def get_generation_cost(request: Request, response: Response, body: ApiRequest):
     try:
+        # 返回客户端剩余的令牌预算
+        response.headers.update(token_limiter.headers(token_limiter.status(get_remote_address(request))))
+
         # 获取AI平台配置
         ai_platform = body.ai_platform or DEFAULT_AI_PLATFORM
         print(f"ai_platform: {ai_platform}")
@@ -92,20 +68,28 @@ async def get_generation_cost(request: Request, body: ApiRequest):
         file_tree = github_data["file_tree"]
         readme = github_data["readme"]
 
-        # Calculate combined token count
-        file_tree_tokens = ai_service.count_tokens(file_tree)
-        readme_tokens = ai_service.count_tokens(readme)
+        # Calculate combined token count (using the trimmed README and summarized tree)
+        readme_tokens = trim_readme(
+            readme, README_TOKEN_BUDGET, ai_service.count_tokens, f"{ai_platform}/{ai_model}"
+        )["tokens"]
+        token_limit = get_token_limit(ai_platform, ai_model, bool(body.api_key))
+        tree_summary = fit_file_tree(ai_service, file_tree, readme_tokens, token_limit)
+        file_tree_tokens = tree_summary["tokens"]
+
+        # 单次调用和两阶段流程只发送一次完整文件树
+        pipeline = select_pipeline(body.pipeline or DEFAULT_PIPELINE, file_tree_tokens + readme_tokens)
+        estimate = estimate_generation_tokens(pipeline, file_tree_tokens, readme_tokens)
 
         # 获取平台对应的价格
         if ai_platform in AI_PRICING and ai_model in AI_PRICING[ai_platform]:
             pricing = AI_PRICING[ai_platform][ai_model]
-            input_cost = ((file_tree_tokens * 2 + readme_tokens) + 3000) * pricing["input"]
-            output_cost = 8000 * pricing["output"]  # 8k tokens 的估计输出量
+            input_cost = estimate["input"] * pricing["input"]
+            output_cost = estimate["output"] * pricing["output"]  # 8k tokens 的估计输出量
             estimated_cost = input_cost + output_cost
         else:
             # 默认OpenAI o3-mini价格
-            input_cost = ((file_tree_tokens * 2 + readme_tokens) + 3000) * 0.0000011
-            output_cost = 8000 * 0.0000044
+            input_cost = estimate["input"] * 0.0000011
+            output_cost = estimate["output"] * 0.0000044
             estimated_cost = input_cost + output_cost
 
         # Format as currency string
@@ -115,203 +99,156 @@ async def get_generation_cost(request: Request, body: ApiRequest):
         return {"error": str(e)}
 
 
-def process_click_events(diagram: str, platform: str, username: str, repo: str, branch: str, git_service) -> str:
-    """
-    Process click events in Mermaid diagram to include full Git URLs.
-    Detects if path is file or directory and uses appropriate URL format.
-    """
+# SSE响应头
+SSE_HEADERS = {
+    "X-Accel-Buffering": "no",  # Hint to Nginx
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+}
 
-    def replace_path(match):
-        # Extract the path from the click event
-        path = match.group(2).strip("\"'")
 
-        # Determine if path is likely a file (has extension) or directory
-        is_file = "." in path.split("/")[-1]
+def validate_generation_request(body: ApiRequest) -> str | None:
+    """检查生成请求，返回错误信息；通过时返回None"""
+    if len(body.instructions) > 1000:
+        return "Instructions exceed maximum length of 1000 characters"
 
-        # Construct Git URL based on platform
-        if is_file:
-            full_url = git_service.get_file_url(username, repo, path, branch)
-        else:
-            full_url = git_service.get_directory_url(username, repo, path, branch)
+    if body.repo in [
+        "fastapi",
+        "streamlit",
+        "flask",
+        "api-analytics",
+        "monkeytype",
+    ]:
+        return "Example repos cannot be regenerated"
+    return None
 
-        # Return the full click event with the new URL
-        return f'click {match.group(1)} "{full_url}"'
 
-    # Match click events: click ComponentName "path/to/something"
-    click_pattern = r'click ([^\s"]+)\s+"([^"]+)"'
-    return re.sub(click_pattern, replace_path, diagram)
+def generation_events(body: ApiRequest, client_id: str) -> AsyncIterator[dict]:
+    """
+    运行一次生成并产出其事件，SSE和WebSocket接口共用
+
+    配置了任务队列时由工作器运行生成，本进程转发事件；事件流被关闭（客户端断开或取消）后
+    任务随之取消。否则直接在本进程中运行生成流程。
+    """
+    if job_manager.broker is None:
+        return generate_diagram_events(body, client_id)
+
+    async def job_events():
+        job = await job_manager.create(body, client_id, detached=False)
+        async with aclosing(job.stream()) as stream:
+            async for _, event in stream:
+                yield event
+
+    return job_events()
 
 
 @router.post("/stream")
 async def generate_stream(request: Request, body: ApiRequest):
     try:
         # Initial validation checks
-        if len(body.instructions) > 1000:
-            return {"error": "Instructions exceed maximum length of 1000 characters"}
-
-        if body.repo in [
-            "fastapi",
-            "streamlit",
-            "flask",
-            "api-analytics",
-            "monkeytype",
-        ]:
-            return {"error": "Example repos cannot be regenerated"}
+        error = validate_generation_request(body)
+        if error:
+            return {"error": error}
 
-        # 获取AI平台配置
-        ai_platform = body.ai_platform or DEFAULT_AI_PLATFORM
-        ai_model = body.ai_model or DEFAULT_AI_MODEL
-        reasoning_effort = body.reasoning_effort or DEFAULT_REASONING_EFFORT
-
-        async def event_generator():
-            try:
-                # 创建AI服务
-                ai_service = AIServiceFactory.create_service(ai_platform, body.api_key, ai_model)
-                
-                # Get cached git data
-                git_data = get_cached_git_data(
-                    body.platform, body.username, body.repo, body.git_token, body.git_api_url
-                )
-                default_branch = git_data["default_branch"]
-                file_tree = git_data["file_tree"]
-                readme = git_data["readme"]
-                git_service = git_data["service"]
-
-                # Send initial status
-                yield f"data: {json.dumps({'status': 'started', 'message': f'使用 {ai_platform} ({ai_model}) 开始生成流程...'})}\n\n"
-                await asyncio.sleep(0.1)
-
-                # Token count check
-                combined_content = f"{file_tree}\n{readme}"
-                token_count = ai_service.count_tokens(combined_content)
-                
-                # 获取平台的令牌限制
-                max_token_limit = 195000  # 默认最大限制
-                
-                if ai_platform in AI_TOKEN_LIMITS and ai_model in AI_TOKEN_LIMITS[ai_platform]:
-                    max_token_limit = AI_TOKEN_LIMITS[ai_platform][ai_model]
-
-                if 50000 < token_count < max_token_limit and not body.api_key:
-                    yield f"data: {json.dumps({'error': f'文件树和README合计超过令牌限制 (50,000)。当前大小: {token_count} 令牌。此仓库太大，无法免费分析，但您可以提供自己的 {ai_platform} API密钥继续。'})}\n\n"
-                    return
-                elif token_count > max_token_limit:
-                    yield f"data: {json.dumps({'error': f'仓库过大 (>{max_token_limit}k 令牌)，无法分析。{ai_platform} {ai_model} 的最大上下文长度为 {max_token_limit} 令牌。当前大小: {token_count} 令牌。'})}\n\n"
-                    return
-
-                # Prepare prompts
-                first_system_prompt = SYSTEM_FIRST_PROMPT
-                third_system_prompt = SYSTEM_THIRD_PROMPT
-                if body.instructions:
-                    first_system_prompt = (
-                        first_system_prompt
-                        + "\n"
-                        + ADDITIONAL_SYSTEM_INSTRUCTIONS_PROMPT
-                    )
-                    third_system_prompt = (
-                        third_system_prompt
-                        + "\n"
-                        + ADDITIONAL_SYSTEM_INSTRUCTIONS_PROMPT
-                    )
-
-                # Phase 1: Get explanation
-                yield f"data: {json.dumps({'status': 'explanation_sent', 'message': f'向 {ai_platform} 发送解释请求...'})}\n\n"
-                await asyncio.sleep(0.1)
-                yield f"data: {json.dumps({'status': 'explanation', 'message': '分析仓库结构...'})}\n\n"
-                explanation = ""
-                async for chunk in ai_service.call_api_stream(
-                    system_prompt=first_system_prompt,
-                    data={
-                        "file_tree": file_tree,
-                        "readme": readme,
-                        "instructions": body.instructions,
-                    },
-                    api_key=body.api_key,
-                    reasoning_effort=reasoning_effort,
-                ):
-                    explanation += chunk
-                    yield f"data: {json.dumps({'status': 'explanation_chunk', 'chunk': chunk})}\n\n"
-
-                if "BAD_INSTRUCTIONS" in explanation:
-                    yield f"data: {json.dumps({'error': '提供的指令无效或不明确'})}\n\n"
-                    return
-
-                # Phase 2: Get component mapping
-                yield f"data: {json.dumps({'status': 'mapping_sent', 'message': f'向 {ai_platform} 发送组件映射请求...'})}\n\n"
-                await asyncio.sleep(0.1)
-                yield f"data: {json.dumps({'status': 'mapping', 'message': '创建组件映射...'})}\n\n"
-                full_second_response = ""
-                async for chunk in ai_service.call_api_stream(
-                    system_prompt=SYSTEM_SECOND_PROMPT,
-                    data={"explanation": explanation, "file_tree": file_tree},
-                    api_key=body.api_key,
-                    reasoning_effort=reasoning_effort,
-                ):
-                    full_second_response += chunk
-                    yield f"data: {json.dumps({'status': 'mapping_chunk', 'chunk': chunk})}\n\n"
-
-                # Extract component mapping
-                start_tag = "<component_mapping>"
-                end_tag = "</component_mapping>"
-                component_mapping_text = full_second_response[
-                    full_second_response.find(start_tag) : full_second_response.find(
-                        end_tag
-                    )
-                ]
-
-                # Phase 3: Generate Mermaid diagram
-                yield f"data: {json.dumps({'status': 'diagram_sent', 'message': f'向 {ai_platform} 发送图表生成请求...'})}\n\n"
-                await asyncio.sleep(0.1)
-                yield f"data: {json.dumps({'status': 'diagram', 'message': '生成图表...'})}\n\n"
-                mermaid_code = ""
-                async for chunk in ai_service.call_api_stream(
-                    system_prompt=third_system_prompt,
-                    data={
-                        "explanation": explanation,
-                        "component_mapping": component_mapping_text,
-                        "instructions": body.instructions,
-                    },
-                    api_key=body.api_key,
-                    reasoning_effort=reasoning_effort,
-                ):
-                    mermaid_code += chunk
-                    yield f"data: {json.dumps({'status': 'diagram_chunk', 'chunk': chunk})}\n\n"
-
-                # Process final diagram
-                mermaid_code = mermaid_code.replace("```mermaid", "").replace("```", "")
-                if "BAD_INSTRUCTIONS" in mermaid_code:
-                    yield f"data: {json.dumps({'error': '提供的指令无效或不明确'})}\n\n"
-                    return
-
-                processed_diagram = process_click_events(
-                    mermaid_code, body.platform, body.username, body.repo, default_branch, git_service
-                )
-
-                # Send final result
-                yield f"data: {json.dumps({
-                    'status': 'complete',
-                    'diagram': processed_diagram,
-                    'explanation': explanation,
-                    'mapping': component_mapping_text,
-                    'ai_platform': ai_platform,
-                    'ai_model': ai_model
-                })}\n\n"
-
-            except Exception as e:
-                yield f"data: {json.dumps({'error': str(e)})}\n\n"
-
-        return StreamingResponse(
-            event_generator(),
-            media_type="text/event-stream",
+        client_id = get_remote_address(request)
+        events = generation_events(body, client_id)
+
+        def encode(event: dict) -> str:
+            # 默认不在complete事件中重复发送已流式发送的解释和映射
+            return encode_event(event if body.full_result else compact_complete_event(event))
+
+        # 生成在独立任务中运行，经有界缓冲区写出；客户端断开时取消任务以中止上游流
+        return SSEStreamingResponse(
+            sse_stream(events, encode=encode),
             headers={
-                "X-Accel-Buffering": "no",  # Hint to Nginx
-                "Cache-Control": "no-cache",
-                "Connection": "keep-alive",
+                **SSE_HEADERS,
+                # 本次生成扣费前的剩余令牌预算
+                **token_limiter.headers(token_limiter.status(client_id)),
             },
         )
     except Exception as e:
         return {"error": str(e)}
 
 
+@router.post("/jobs")
+async def create_generation_job(request: Request, response: Response, body: ApiRequest):
+    """
+    创建与HTTP连接解耦的生成任务，生成在后台运行
+
+    Returns:
+        Dict[str, Any]: 任务ID、事件流地址和结果地址
+    """
+    error = validate_generation_request(body)
+    if error:
+        return {"error": error}
+
+    client_id = get_remote_address(request)
+    response.headers.update(token_limiter.headers(token_limiter.status(client_id)))
+    job = await job_manager.create(body, client_id)
+    return {
+        "job_id": job.id,
+        "events_url": f"/generate/jobs/{job.id}/events",
+        "result_url": f"/generate/jobs/{job.id}/result",
+    }
+
+
+@router.get("/jobs/{job_id}")
+async def get_generation_job(request: Request, job_id: str):
+    """获取生成任务的状态"""
+    job = await job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    return await job.summary()
+
+
+@router.get("/jobs/{job_id}/result")
+async def get_generation_job_result(request: Request, job_id: str):
+    """
+    获取已结束的生成任务的最终事件（包含完整解释和组件映射的complete事件，或error事件）
+
+    Raises:
+        HTTPException: 任务不存在或已过期（404），任务尚未结束（409）
+    """
+    job = await job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    result = await job.result()
+    if result is None:
+        raise HTTPException(status_code=409, detail="Job has not finished")
+    return result
+
+
+@router.get("/jobs/{job_id}/events")
+async def stream_generation_job(
+    request: Request, job_id: str, last_event_id: int = 0, full_result: bool = False
+):
+    """
+    以SSE读取生成任务的事件，每个事件带有递增的id
+
+    重新连接时通过Last-Event-ID请求头（或last_event_id查询参数）从断点之后继续，
+    已完成的任务在保留期内可以重放全部事件。complete事件默认不重复发送解释和组件映射，
+    full_result=true 时发送完整事件（也可以通过 /generate/jobs/{job_id}/result 获取）。
+    """
+    job = await job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+
+    header = request.headers.get("last-event-id", "")
+    if header.isdigit():
+        last_event_id = int(header)
+
+    def encode(item: tuple[int, dict]) -> str:
+        event_id, event = item
+        if not full_result:
+            event = compact_complete_event(event)
+        return f"id: {event_id}\n{encode_event(event)}"
+
+    # 带编号的事件用于断点续传，不合并
+    return SSEStreamingResponse(
+        sse_stream(job.stream(last_event_id), encode=encode, coalesce=False), headers=SSE_HEADERS
+    )
+
+
 @router.get("/ai-platforms")
 async def get_ai_platforms(request: Request):
     """
@@ -344,3 +281,25 @@ async def get_ai_platforms(request: Request):
         return response
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/scheduler")
+async def get_scheduler_stats(request: Request):
+    """
+    获取调度器各请求类别（free/byo）的排队和延迟统计、各AI平台/模型的准入状态、
+    各服务器密钥的利用率和冷却状态、进行中和保留的生成任务数、因客户端断开而取消的生成，
+    事件流缓冲区的占用和心跳，以及各修改方式（补丁、完整重写、缓存命中）的次数
+
+    Returns:
+        Dict[str, Any]: 调度器、准入控制、密钥池、生成任务、取消、图表输出中止、事件流和修改的统计信息
+    """
+    return {
+        "scheduler": scheduler.stats(),
+        "admission": admission_controller.stats(),
+        "key_pools": {provider: pool.stats() for provider, pool in key_pools.items()},
+        "jobs": await job_manager.stats(),
+        "cancellations": cancellation_stats,
+        "diagram_guard": diagram_guard_stats,
+        "sse": sse_monitor.stats(),
+        "modify": modify_stats,
+    }
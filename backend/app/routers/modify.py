@@ -1,82 +1,82 @@
-from fastapi import APIRouter, Request, HTTPException
+from fastapi import APIRouter, Request, Response, HTTPException
 from dotenv import load_dotenv
+from contextlib import aclosing
 
-# from app.services.claude_service import ClaudeService
 # from app.core.limiter import limiter
-from anthropic._exceptions import RateLimitError
-from app.prompts import SYSTEM_MODIFY_PROMPT
-from pydantic import BaseModel
-from app.services.o1_mini_openai_service import OpenAIO1Service
+from app.services.modify_pipeline import (
+    ModifyRequest,
+    validate_modify_request,
+    modify_diagram_events,
+)
+from app.core.token_limiter import token_limiter
+from app.utils.sse import SSEStreamingResponse, sse_stream
+from slowapi.util import get_remote_address
 
 
 load_dotenv()
 
 router = APIRouter(prefix="/modify", tags=["Claude"])
 
-# Initialize services
-# claude_service = ClaudeService()
-o1_service = OpenAIO1Service()
-
-
-# Define the request body model
-
-
-class ModifyRequest(BaseModel):
-    instructions: str
-    current_diagram: str
-    repo: str
-    username: str
-    explanation: str
+# SSE响应头
+SSE_HEADERS = {
+    "X-Accel-Buffering": "no",  # Hint to Nginx
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+}
 
 
 @router.post("")
 # @limiter.limit("2/minute;10/day")
-async def modify(request: Request, body: ModifyRequest):
-    try:
-        # Check instructions length
-        if not body.instructions or not body.current_diagram:
-            return {"error": "Instructions and/or current diagram are required"}
-        elif (
-            len(body.instructions) > 1000 or len(body.current_diagram) > 100000
-        ):  # just being safe
-            return {"error": "Instructions exceed maximum length of 1000 characters"}
-
-        if body.repo in [
-            "fastapi",
-            "streamlit",
-            "flask",
-            "api-analytics",
-            "monkeytype",
-        ]:
-            return {"error": "Example repos cannot be modified"}
-
-        # modified_mermaid_code = claude_service.call_claude_api(
-        #     system_prompt=SYSTEM_MODIFY_PROMPT,
-        #     data={
-        #         "instructions": body.instructions,
-        #         "explanation": body.explanation,
-        #         "diagram": body.current_diagram,
-        #     },
-        # )
-
-        modified_mermaid_code = o1_service.call_o1_api(
-            system_prompt=SYSTEM_MODIFY_PROMPT,
-            data={
-                "instructions": body.instructions,
-                "explanation": body.explanation,
-                "diagram": body.current_diagram,
-            },
-        )
-
-        # Check for BAD_INSTRUCTIONS response
-        if "BAD_INSTRUCTIONS" in modified_mermaid_code:
-            return {"error": "Invalid or unclear instructions provided"}
-
-        return {"diagram": modified_mermaid_code}
-    except RateLimitError as e:
-        raise HTTPException(
-            status_code=429,
-            detail="Service is currently experiencing high demand. Please try again in a few minutes.",
-        )
-    except Exception as e:
-        return {"error": str(e)}
+async def modify(request: Request, response: Response, body: ModifyRequest):
+    """
+    按指令修改图表，等待模型输出完成后一次性返回
+
+    Returns:
+        Dict[str, Any]: {"diagram": 修改后的Mermaid代码} 或 {"error": 错误信息}
+
+    Raises:
+        HTTPException: 令牌预算耗尽或排队已满（429）
+    """
+    error = validate_modify_request(body)
+    if error:
+        return {"error": error}
+
+    client_id = get_remote_address(request)
+    result = {"error": "Failed to modify diagram"}
+    # 请求被取消时关闭事件流，上游请求随之中止
+    async with aclosing(modify_diagram_events(body, client_id)) as events:
+        async for event in events:
+            if event.get("status") == "complete":
+                result = {"diagram": event["diagram"]}
+            elif "error" in event:
+                if event.get("rejected"):
+                    raise HTTPException(
+                        status_code=429,
+                        detail=event["error"],
+                        headers=token_limiter.headers(token_limiter.status(client_id)),
+                    )
+                result = {"error": event["error"]}
+    response.headers.update(token_limiter.headers(token_limiter.status(client_id)))
+    return result
+
+
+@router.post("/stream")
+async def modify_stream(request: Request, body: ModifyRequest):
+    """
+    以SSE流式返回修改后的图表：diagram_chunk片段事件，最后是complete或error事件
+
+    与 /generate/stream 共用有界缓冲区、片段合并和客户端断开时的取消。
+    """
+    error = validate_modify_request(body)
+    if error:
+        return {"error": error}
+
+    client_id = get_remote_address(request)
+    return SSEStreamingResponse(
+        sse_stream(modify_diagram_events(body, client_id)),
+        headers={
+            **SSE_HEADERS,
+            # 本次修改扣费前的剩余令牌预算
+            **token_limiter.headers(token_limiter.status(client_id)),
+        },
+    )
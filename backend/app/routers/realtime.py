@@ -0,0 +1,189 @@
+from fastapi import APIRouter, HTTPException, WebSocket
+from dotenv import load_dotenv
+from pydantic import ValidationError
+from slowapi.util import get_remote_address
+from contextlib import aclosing
+from typing import Any
+import asyncio
+import msgpack
+import os
+from app.routers.generate import generation_events, validate_generation_request
+from app.services.generation_pipeline import ApiRequest, compact_complete_event
+from app.services.modify_pipeline import ModifyRequest, modify_diagram_events, validate_modify_request
+
+load_dotenv()
+
+router = APIRouter(prefix="/ws", tags=["Realtime"])
+
+# 每个连接同时进行的生成/修改数
+WS_MAX_STREAMS = int(os.getenv("WS_MAX_STREAMS", "4"))
+
+# 每个连接待发送的帧数上限，写满后暂停读取上游（慢客户端的背压）
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+
+# 进程内累计的连接数、操作数和客户端取消数
+websocket_stats = {"connections": 0, "active_connections": 0, "streams": 0, "cancelled": 0}
+
+
+def merge_chunk_events(last: dict, event: dict) -> dict | None:
+    """合并同类的相邻文本片段事件（如两个diagram_chunk），不能合并时返回None"""
+    if last.keys() == {"status", "chunk"} and event.keys() == {"status", "chunk"} and last["status"] == event["status"]:
+        return {"status": last["status"], "chunk": last["chunk"] + event["chunk"]}
+    return None
+
+
+class GenerationSocket:
+    """
+    一个WebSocket连接上的多路生成会话
+
+    客户端和服务端的每条消息都是一个msgpack编码的二进制帧：
+
+    - 客户端: {"op": "generate" | "modify" | "cancel", "id": 流ID, "body": 请求}
+      generate的body与 /generate/stream 相同，modify的body与 /modify 相同
+    - 服务端: [流ID, 事件]，事件与SSE中 `data:` 的内容一致；每个流以complete、error或
+      cancelled事件结束。连接层面的错误使用流ID null。
+    """
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.client_id = get_remote_address(websocket)
+        self.streams: dict[Any, asyncio.Task] = {}
+        self.outbox: asyncio.Queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+
+    async def run(self) -> None:
+        """处理客户端消息直到连接关闭，关闭时取消所有进行中的流"""
+        sender = asyncio.create_task(self._send_loop())
+        try:
+            while True:
+                message = await self.websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                if message.get("bytes") is None:
+                    await self._put(None, {'error': 'Only binary msgpack frames are supported'})
+                    continue
+                await self._handle(message["bytes"])
+        finally:
+            tasks = list(self.streams.values())
+            for task in tasks:
+                task.cancel()
+            sender.cancel()
+            await asyncio.gather(*tasks, sender, return_exceptions=True)
+
+    async def _handle(self, data: bytes) -> None:
+        try:
+            request = msgpack.unpackb(data)
+            op = request["op"]
+            stream_id = request.get("id")
+        except Exception:
+            await self._put(None, {'error': 'Invalid frame'})
+            return
+        if stream_id is not None and (
+            isinstance(stream_id, bool) or not isinstance(stream_id, (str, int))
+        ):
+            # 流ID用作字典键，数组等不可哈希的值会使整个连接出错
+            await self._put(None, {'error': 'Invalid stream id'})
+            return
+
+        if op == "cancel":
+            task = self.streams.get(stream_id)
+            if task is not None:
+                task.cancel()
+            return
+        if op not in ("generate", "modify"):
+            await self._put(stream_id, {'error': f'Unsupported op: {op}'})
+            return
+        if stream_id in self.streams:
+            await self._put(stream_id, {'error': 'Stream id already in use'})
+            return
+        if len(self.streams) >= WS_MAX_STREAMS:
+            await self._put(stream_id, {'error': f'At most {WS_MAX_STREAMS} concurrent streams per connection'})
+            return
+
+        websocket_stats["streams"] += 1
+        runner = self._generate if op == "generate" else self._modify
+        self.streams[stream_id] = asyncio.create_task(
+            self._run_stream(stream_id, runner, request.get("body") or {})
+        )
+
+    async def _run_stream(self, stream_id, runner, payload: dict) -> None:
+        try:
+            await runner(stream_id, payload)
+        except asyncio.CancelledError:
+            websocket_stats["cancelled"] += 1
+            try:
+                self.outbox.put_nowait((stream_id, {'status': 'cancelled'}))
+            except asyncio.QueueFull:
+                pass
+            raise
+        except ValidationError as e:
+            await self._put(stream_id, {'error': f'Invalid request: {e.errors()[0]["msg"]}'})
+        except HTTPException as e:
+            await self._put(stream_id, {'error': e.detail})
+        except Exception as e:
+            await self._put(stream_id, {'error': str(e)})
+        finally:
+            self.streams.pop(stream_id, None)
+
+    async def _generate(self, stream_id, payload: dict) -> None:
+        body = ApiRequest(**payload)
+        error = validate_generation_request(body)
+        if error:
+            await self._put(stream_id, {'error': error})
+            return
+        # 取消时关闭事件流，上游请求随之中止
+        async with aclosing(generation_events(body, self.client_id)) as events:
+            async for event in events:
+                await self._put(stream_id, event if body.full_result else compact_complete_event(event))
+
+    async def _modify(self, stream_id, payload: dict) -> None:
+        body = ModifyRequest(**payload)
+        error = validate_modify_request(body)
+        if error:
+            await self._put(stream_id, {'error': error})
+            return
+        async with aclosing(modify_diagram_events(body, self.client_id)) as events:
+            async for event in events:
+                event.pop('rejected', None)
+                await self._put(stream_id, event)
+
+    async def _put(self, stream_id, event: dict) -> None:
+        await self.outbox.put((stream_id, event))
+
+    async def _send_loop(self) -> None:
+        while True:
+            frames = [await self.outbox.get()]
+            while not self.outbox.empty():
+                frames.append(self.outbox.get_nowait())
+            # 合并积压的同一流的相邻文本片段
+            merged = [frames[0]]
+            for stream_id, event in frames[1:]:
+                last_id, last_event = merged[-1]
+                combined = merge_chunk_events(last_event, event) if last_id == stream_id else None
+                if combined is not None:
+                    merged[-1] = (stream_id, combined)
+                else:
+                    merged.append((stream_id, event))
+            for stream_id, event in merged:
+                await self.websocket.send_bytes(msgpack.packb([stream_id, event]))
+
+
+@router.get("/stats")
+async def get_websocket_stats():
+    """获取WebSocket连接数、流数和客户端取消数"""
+    return websocket_stats
+
+
+@router.websocket("")
+async def generation_socket(websocket: WebSocket):
+    """
+    生成和修改图表的WebSocket接口，一个连接上可以同时进行多个生成并随时取消
+
+    使用与 /generate/stream 相同的生成流程（包括准入、调度、任务队列和客户端断开时的取消）。
+    """
+    await websocket.accept()
+    websocket_stats["connections"] += 1
+    websocket_stats["active_connections"] += 1
+    try:
+        await GenerationSocket(websocket).run()
+    finally:
+        websocket_stats["active_connections"] -= 1
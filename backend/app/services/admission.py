@@ -0,0 +1,272 @@
+from collections import deque
+from dotenv import load_dotenv
+from typing import AsyncGenerator
+import asyncio
+import math
+import os
+import time
+
+load_dotenv()
+
+# 是否对发往AI平台的生成请求进行准入控制
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+
+# 每个AI平台/模型的并发生成数和每分钟令牌预算（tokens_per_minute为0表示不限制）
+PROVIDER_ADMISSION_LIMITS = {
+    "openai": {
+        "o3-mini": {"concurrency": 50, "tokens_per_minute": 2000000},
+        "o4-mini": {"concurrency": 50, "tokens_per_minute": 2000000},
+    },
+    "claude": {"claude-3-5-sonnet": {"concurrency": 20, "tokens_per_minute": 400000}},
+    "deepseek": {"deepseek-chat": {"concurrency": 30, "tokens_per_minute": 1000000}},
+}
+
+# 未在上表中配置的平台/模型使用的限制
+DEFAULT_ADMISSION_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "20"))
+DEFAULT_ADMISSION_TOKENS_PER_MINUTE = int(os.getenv("ADMISSION_TOKENS_PER_MINUTE", "0"))
+
+# 覆盖上表的限制，格式: "openai/o3-mini=50:2000000,claude/claude-3-5-sonnet=10:200000"
+ADMISSION_LIMIT_OVERRIDES = os.getenv("ADMISSION_LIMITS", "")
+
+# 每个平台/模型排队请求的上限，超过时直接拒绝
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "100"))
+
+# 排队期间发送queued事件的间隔（秒）
+QUEUE_UPDATE_INTERVAL = 2.0
+
+# 尚无历史数据时假定的单次生成耗时（秒）
+DEFAULT_GENERATION_SECONDS = 60.0
+
+TOKEN_WINDOW_SECONDS = 60.0
+
+
+class AdmissionRejected(Exception):
+    """排队已满，请求被拒绝"""
+
+
+def parse_limit_overrides(value: str) -> dict[tuple[str, str], dict]:
+    """解析 "platform/model=concurrency:tokens_per_minute" 形式的限制配置"""
+    overrides = {}
+    for item in value.split(","):
+        key, _, limits = item.strip().partition("=")
+        if not key or not limits:
+            continue
+        platform, _, model = key.partition("/")
+        concurrency, _, tokens_per_minute = limits.partition(":")
+        overrides[(platform.strip().lower(), model.strip())] = {
+            "concurrency": int(concurrency),
+            "tokens_per_minute": int(tokens_per_minute or 0),
+        }
+    return overrides
+
+
+def get_admission_limits(platform: str, model: str) -> dict:
+    """返回平台/模型的并发和每分钟令牌限制"""
+    overrides = parse_limit_overrides(ADMISSION_LIMIT_OVERRIDES)
+    if (platform, model) in overrides:
+        return overrides[(platform, model)]
+    return PROVIDER_ADMISSION_LIMITS.get(platform, {}).get(
+        model,
+        {
+            "concurrency": DEFAULT_ADMISSION_CONCURRENCY,
+            "tokens_per_minute": DEFAULT_ADMISSION_TOKENS_PER_MINUTE,
+        },
+    )
+
+
+class AdmissionTicket:
+    """
+    一个生成请求的准入凭证
+
+    先通过 wait() 排队直到获准（期间产出queued事件），完成后调用 release()。
+    """
+
+    def __init__(self, lane: "AdmissionLane", tokens: int):
+        self.lane = lane
+        self.tokens = tokens
+        self.admitted = asyncio.Event()
+        self.released = False
+        self.enqueued_at = time.monotonic()
+        self.admitted_at: float | None = None
+        self.charge: list | None = None
+
+    async def wait(self) -> AsyncGenerator[dict, None]:
+        """
+        等待准入
+
+        Yields:
+            dict: 排队期间的queued事件（位置和预计等待秒数）
+        """
+        try:
+            while not self.admitted.is_set():
+                position = self.lane.position(self)
+                yield {
+                    'status': 'queued',
+                    'message': f'请求较多，正在排队（第 {position} 位）...',
+                    'position': position,
+                    'estimated_wait': self.lane.estimated_wait(position),
+                }
+                try:
+                    await asyncio.wait_for(self.admitted.wait(), timeout=QUEUE_UPDATE_INTERVAL)
+                except asyncio.TimeoutError:
+                    # 令牌窗口可能已经滑过，重新尝试调度
+                    self.lane.dispatch()
+        except BaseException:
+            # 排队期间客户端断开或被取消：离开队列，若恰好已获准则归还名额
+            self.release()
+            raise
+
+    def release(self, actual_tokens: int | None = None) -> None:
+        """
+        归还并发名额；提供actual_tokens时用实际用量替换预估的令牌消耗
+        """
+        if self.released:
+            return
+        self.released = True
+        self.lane.release(self, actual_tokens)
+
+
+class AdmissionLane:
+    """单个AI平台/模型的并发名额、令牌窗口和FIFO等待队列"""
+
+    def __init__(self, concurrency: int, tokens_per_minute: int):
+        self.concurrency = concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.active = 0
+        self.waiters: deque[AdmissionTicket] = deque()
+        # 最近一分钟内的令牌消耗: [时间戳, 令牌数]
+        self.token_window: deque[list] = deque()
+        self.avg_generation_seconds = DEFAULT_GENERATION_SECONDS
+        self.avg_queue_seconds = 0.0
+        self.admitted_total = 0
+        self.rejected_total = 0
+
+    def _tokens_in_window(self, now: float) -> int:
+        while self.token_window and now - self.token_window[0][0] > TOKEN_WINDOW_SECONDS:
+            self.token_window.popleft()
+        return sum(tokens for _, tokens in self.token_window)
+
+    def _can_admit(self, ticket: AdmissionTicket, now: float) -> bool:
+        if self.active >= self.concurrency:
+            return False
+        if not self.tokens_per_minute or not ticket.tokens:
+            return True
+        used = self._tokens_in_window(now)
+        # 单个超过预算的请求在窗口为空时仍然放行，避免永久阻塞
+        return used + ticket.tokens <= self.tokens_per_minute or used == 0
+
+    def _admit(self, ticket: AdmissionTicket, now: float) -> None:
+        self.active += 1
+        self.admitted_total += 1
+        ticket.admitted_at = now
+        if ticket.tokens:
+            ticket.charge = [now, ticket.tokens]
+            self.token_window.append(ticket.charge)
+        self.avg_queue_seconds = 0.8 * self.avg_queue_seconds + 0.2 * (now - ticket.enqueued_at)
+        ticket.admitted.set()
+
+    def enqueue(self, ticket: AdmissionTicket) -> None:
+        now = time.monotonic()
+        if not self.waiters and self._can_admit(ticket, now):
+            self._admit(ticket, now)
+            return
+        if len(self.waiters) >= ADMISSION_MAX_QUEUE:
+            self.rejected_total += 1
+            raise AdmissionRejected('当前请求过多，排队已满，请稍后重试。')
+        self.waiters.append(ticket)
+
+    def dispatch(self) -> None:
+        """按FIFO顺序放行队首可以获准的请求"""
+        now = time.monotonic()
+        while self.waiters and self._can_admit(self.waiters[0], now):
+            self._admit(self.waiters.popleft(), now)
+
+    def release(self, ticket: AdmissionTicket, actual_tokens: int | None) -> None:
+        now = time.monotonic()
+        if ticket.admitted_at is None:
+            if ticket in self.waiters:
+                self.waiters.remove(ticket)
+        else:
+            self.active -= 1
+            self.avg_generation_seconds = (
+                0.8 * self.avg_generation_seconds + 0.2 * (now - ticket.admitted_at)
+            )
+            if ticket.charge is not None and actual_tokens is not None:
+                ticket.charge[1] = actual_tokens
+        self.dispatch()
+
+    def position(self, ticket: AdmissionTicket) -> int:
+        try:
+            return self.waiters.index(ticket) + 1
+        except ValueError:
+            return 0
+
+    def estimated_wait(self, position: int) -> float:
+        """
+        预计等待秒数：取并发名额轮转所需时间与令牌窗口释放所需时间中的较大值
+        """
+        rounds = math.ceil(position / max(self.concurrency, 1))
+        wait = rounds * self.avg_generation_seconds
+        if self.tokens_per_minute:
+            now = time.monotonic()
+            queued_tokens = sum(ticket.tokens for ticket in list(self.waiters)[:position])
+            overflow = self._tokens_in_window(now) + queued_tokens - self.tokens_per_minute
+            if overflow > 0:
+                wait = max(wait, overflow / self.tokens_per_minute * TOKEN_WINDOW_SECONDS)
+        return round(wait, 1)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "active": self.active,
+            "queued": len(self.waiters),
+            "concurrency": self.concurrency,
+            "tokens_per_minute": self.tokens_per_minute,
+            "tokens_in_window": self._tokens_in_window(now),
+            "admitted_total": self.admitted_total,
+            "rejected_total": self.rejected_total,
+            "avg_queue_seconds": round(self.avg_queue_seconds, 2),
+            "avg_generation_seconds": round(self.avg_generation_seconds, 2),
+        }
+
+
+class AdmissionController:
+    """
+    按AI平台/模型进行准入控制：限制并发生成数和每分钟令牌数，超出时在有界队列中排队
+    """
+
+    def __init__(self):
+        self.lanes: dict[tuple[str, str], AdmissionLane] = {}
+
+    def lane(self, platform: str, model: str) -> AdmissionLane:
+        key = (platform.lower(), model)
+        if key not in self.lanes:
+            self.lanes[key] = AdmissionLane(**get_admission_limits(*key))
+        return self.lanes[key]
+
+    def request(self, platform: str, model: str, tokens: int) -> AdmissionTicket:
+        """
+        申请准入
+
+        Args:
+            platform: AI平台
+            model: 模型
+            tokens: 预估消耗的服务器令牌数（使用用户自己的API密钥时为0）
+
+        Returns:
+            AdmissionTicket: 已获准或正在排队的凭证
+
+        Raises:
+            AdmissionRejected: 队列已满
+        """
+        lane = self.lane(platform, model)
+        ticket = AdmissionTicket(lane, tokens)
+        lane.enqueue(ticket)
+        return ticket
+
+    def stats(self) -> dict[str, dict]:
+        return {"/".join(key): lane.stats() for key, lane in self.lanes.items()}
+
+
+# 进程内共享的准入控制器
+admission_controller = AdmissionController()
@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
 from typing import AsyncGenerator, Literal
+from app.utils.prompt_cache import normalize_usage
 
 class AIServiceBase(ABC):
     """
@@ -61,4 +62,24 @@ class AIServiceBase(ABC):
         Returns:
             int: 输入令牌的估计数量
         """
-        pass 
\ No newline at end of file
+        pass
+
+    def record_usage(self, usage: dict | None) -> dict:
+        """
+        记录一次调用的令牌用量（含提示缓存命中数），供生成流程汇总上报
+        
+        Args:
+            usage (dict | None): 提供方响应中的原始usage字段
+            
+        Returns:
+            dict: 统一格式的用量，见 normalize_usage
+        """
+        record = normalize_usage(usage)
+        if not hasattr(self, "usage_records"):
+            self.usage_records = []
+        self.usage_records.append(record)
+        print(
+            f"令牌用量: 输入 {record['input_tokens']} (缓存命中 {record['cached_tokens']}, "
+            f"缓存写入 {record['cache_write_tokens']}), 输出 {record['output_tokens']}"
+        )
+        return record
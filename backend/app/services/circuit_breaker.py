@@ -0,0 +1,294 @@
+from collections import deque
+from dotenv import load_dotenv
+from typing import AsyncGenerator, AsyncIterator, Callable, TypeVar
+import os
+import re
+import time
+
+load_dotenv()
+
+# 是否启用熔断器
+CIRCUIT_BREAKER_ENABLED = os.getenv("CIRCUIT_BREAKER_ENABLED", "true").lower() == "true"
+
+# 统计错误率和延迟的滚动窗口（秒）
+BREAKER_WINDOW_SECONDS = float(os.getenv("BREAKER_WINDOW_SECONDS", "60"))
+
+# 连续失败达到该次数时立即熔断
+BREAKER_CONSECUTIVE_FAILURES = int(os.getenv("BREAKER_CONSECUTIVE_FAILURES", "3"))
+
+# 窗口内调用数不少于BREAKER_MIN_CALLS且错误率达到BREAKER_ERROR_RATE时熔断
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "10"))
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+
+# 熔断后等待多久进入半开状态发送探测请求（秒）；探测失败时等待时间翻倍，不超过上限
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+BREAKER_MAX_OPEN_SECONDS = float(os.getenv("BREAKER_MAX_OPEN_SECONDS", "300"))
+
+# 超过该延迟的调用记为失败（AI平台按首令牌时间计算，Git平台按单次调用耗时计算）
+AI_SLOW_CALL_SECONDS = float(os.getenv("AI_SLOW_CALL_SECONDS", "60"))
+GIT_SLOW_CALL_SECONDS = float(os.getenv("GIT_SLOW_CALL_SECONDS", "20"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+T = TypeVar("T")
+
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，调用被立即拒绝"""
+
+
+def _percentile(samples: list[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return round(ordered[min(int(q * len(ordered)), len(ordered) - 1)], 3)
+
+
+def _status_code(error: Exception) -> int | None:
+    status = getattr(error, "status_code", None)
+    if status is None:
+        match = re.search(r"status code (\d{3})", str(error))
+        status = int(match.group(1)) if match else None
+    return status
+
+
+def is_provider_failure(error: Exception) -> bool:
+    """
+    判断AI平台的异常是否说明平台本身不可用
+
+    连接错误、超时、429和5xx计为失败；其他4xx（如用户密钥无效、请求过长）不计入。
+    """
+    status = _status_code(error)
+    if status is None:
+        return True
+    return status >= 500 or status in (408, 429)
+
+
+def is_user_key_error(error: Exception) -> bool:
+    """用户自己的密钥被拒绝或限流（401/403/429），只说明该密钥的问题，不代表平台不可用"""
+    return _status_code(error) in (401, 403, 429)
+
+
+def is_git_failure(error: Exception) -> bool:
+    """
+    判断Git平台的异常是否说明平台本身不可用
+
+    ValueError表示仓库不存在、没有README等仓库层面的结果，不计入；
+    其他异常（连接错误、非预期的状态码、API限流）计为失败。
+    """
+    return not isinstance(error, ValueError)
+
+
+class CircuitBreaker:
+    """
+    单个上游（AI平台/模型或Git平台）的熔断器
+
+    - closed: 正常放行，记录滚动窗口内的结果和延迟；连续失败或错误率过高时打开
+    - open: 立即拒绝调用，等待一段时间后进入半开状态
+    - half_open: 只放行一个探测请求，成功则关闭，失败则重新打开并延长等待时间
+    """
+
+    def __init__(
+        self,
+        name: str,
+        slow_call_seconds: float,
+        is_failure: Callable[[Exception], bool] = is_provider_failure,
+    ):
+        self.name = name
+        self.slow_call_seconds = slow_call_seconds
+        self.is_failure = is_failure
+        self.state = CLOSED
+        # 滚动窗口内的调用结果: (时间, 是否成功, 延迟)
+        self.outcomes: deque[tuple[float, bool, float]] = deque()
+        self.consecutive_failures = 0
+        self.open_seconds = BREAKER_OPEN_SECONDS
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.opened_total = 0
+        self.rejected_total = 0
+
+    def _prune(self, now: float) -> None:
+        while self.outcomes and now - self.outcomes[0][0] > BREAKER_WINDOW_SECONDS:
+            self.outcomes.popleft()
+
+    def available(self) -> bool:
+        """不占用探测名额地判断当前是否可能放行调用（用于路由时挑选候选）"""
+        if not CIRCUIT_BREAKER_ENABLED or self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            return time.monotonic() - self.opened_at >= self.open_seconds
+        return not self.probe_in_flight
+
+    def acquire(self) -> None:
+        """
+        申请一次调用；半开状态下获得唯一的探测名额
+
+        Raises:
+            CircuitOpenError: 熔断器打开，或半开状态下已有探测请求在进行
+        """
+        if not CIRCUIT_BREAKER_ENABLED or self.state == CLOSED:
+            return
+        now = time.monotonic()
+        if self.state == OPEN and now - self.opened_at >= self.open_seconds:
+            self.state = HALF_OPEN
+            print(f"熔断器 {self.name} 进入半开状态，发送探测请求")
+        if self.state == HALF_OPEN and not self.probe_in_flight:
+            self.probe_in_flight = True
+            return
+        self.rejected_total += 1
+        retry_in = max(self.open_seconds - (now - self.opened_at), 0)
+        raise CircuitOpenError(f"{self.name} 暂时不可用（熔断中），请约 {retry_in:.0f} 秒后重试。")
+
+    def _open(self, now: float) -> None:
+        if self.state == HALF_OPEN:
+            # 探测失败：延长等待时间
+            self.open_seconds = min(self.open_seconds * 2, BREAKER_MAX_OPEN_SECONDS)
+        self.state = OPEN
+        self.opened_at = now
+        self.probe_in_flight = False
+        self.opened_total += 1
+        print(f"熔断器 {self.name} 已打开，{self.open_seconds:.0f} 秒后探测")
+
+    def record_success(self, latency: float) -> None:
+        """记录一次成功的调用；延迟超过slow_call_seconds时按失败处理"""
+        if latency >= self.slow_call_seconds:
+            self.record_failure(latency)
+            return
+        now = time.monotonic()
+        self._prune(now)
+        self.outcomes.append((now, True, latency))
+        self.consecutive_failures = 0
+        if self.state == HALF_OPEN:
+            self.state = CLOSED
+            self.probe_in_flight = False
+            self.open_seconds = BREAKER_OPEN_SECONDS
+            self.outcomes.clear()
+            print(f"熔断器 {self.name} 探测成功，已关闭")
+
+    def record_failure(self, latency: float) -> None:
+        now = time.monotonic()
+        self._prune(now)
+        self.outcomes.append((now, False, latency))
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN:
+            self._open(now)
+            return
+        if self.state != CLOSED:
+            return
+        failures = sum(1 for _, ok, _ in self.outcomes if not ok)
+        if self.consecutive_failures >= BREAKER_CONSECUTIVE_FAILURES or (
+            len(self.outcomes) >= BREAKER_MIN_CALLS
+            and failures / len(self.outcomes) >= BREAKER_ERROR_RATE
+        ):
+            self._open(now)
+
+    def record_error(self, error: Exception, latency: float, user_key: bool = False) -> None:
+        """
+        按异常类型记录结果：上游故障计为失败；请求本身的问题不计入统计，
+        也不能作为半开状态的探测结果（只归还探测名额）
+
+        Args:
+            user_key: 调用使用的是用户自己的密钥，此时该密钥的认证失败和限流不计入
+        """
+        if self.is_failure(error) and not (user_key and is_user_key_error(error)):
+            self.record_failure(latency)
+        else:
+            self.release()
+
+    def release(self) -> None:
+        """调用被取消且没有可判断的结果时，归还半开状态的探测名额"""
+        if self.state == HALF_OPEN:
+            self.probe_in_flight = False
+
+    def call(self, func: Callable[..., T], *args, user_key: bool = False, **kwargs) -> T:
+        """在熔断器保护下执行同步调用（user_key 见 record_error）"""
+        self.acquire()
+        started = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self.record_error(e, time.monotonic() - started, user_key)
+            raise
+        except BaseException:
+            self.release()
+            raise
+        self.record_success(time.monotonic() - started)
+        return result
+
+    async def guard_stream(
+        self, stream: AsyncIterator[str], user_key: bool = False
+    ) -> AsyncGenerator[str, None]:
+        """
+        在熔断器保护下转发流式响应，按首个片段的到达时间记录延迟
+
+        调用方应先调用 acquire()。流在首个片段前被取消（如对冲落败）时，
+        耗时已超过slow_call_seconds则计为失败，否则不计入统计。user_key 见 record_error。
+
+        Yields:
+            str: 原始流的片段
+        """
+        started = time.monotonic()
+        first_chunk_latency: float | None = None
+        try:
+            async for chunk in stream:
+                if first_chunk_latency is None:
+                    first_chunk_latency = time.monotonic() - started
+                yield chunk
+        except Exception as e:
+            self.record_error(e, first_chunk_latency or time.monotonic() - started, user_key)
+            raise
+        except BaseException:
+            elapsed = time.monotonic() - started
+            if first_chunk_latency is not None:
+                self.record_success(first_chunk_latency)
+            elif elapsed >= self.slow_call_seconds:
+                self.record_failure(elapsed)
+            else:
+                self.release()
+            raise
+        else:
+            self.record_success(first_chunk_latency or time.monotonic() - started)
+        finally:
+            await stream.aclose()  # type: ignore
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        self._prune(now)
+        failures = sum(1 for _, ok, _ in self.outcomes if not ok)
+        latencies = [latency for _, _, latency in self.outcomes]
+        return {
+            "state": self.state,
+            "calls": len(self.outcomes),
+            "error_rate": round(failures / len(self.outcomes), 3) if self.outcomes else 0.0,
+            "consecutive_failures": self.consecutive_failures,
+            "latency_seconds": {"p50": _percentile(latencies, 0.5), "p95": _percentile(latencies, 0.95)},
+            "retry_in_seconds": (
+                round(max(self.open_seconds - (now - self.opened_at), 0), 1) if self.state == OPEN else 0
+            ),
+            "opened_total": self.opened_total,
+            "rejected_total": self.rejected_total,
+        }
+
+
+class CircuitBreakerRegistry:
+    """按名称创建和保存熔断器"""
+
+    def __init__(self, slow_call_seconds: float, is_failure: Callable[[Exception], bool]):
+        self.slow_call_seconds = slow_call_seconds
+        self.is_failure = is_failure
+        self.breakers: dict[str, CircuitBreaker] = {}
+
+    def get(self, name: str) -> CircuitBreaker:
+        if name not in self.breakers:
+            self.breakers[name] = CircuitBreaker(name, self.slow_call_seconds, self.is_failure)
+        return self.breakers[name]
+
+    def stats(self) -> dict[str, dict]:
+        return {name: breaker.stats() for name, breaker in self.breakers.items()}
+
+
+# 进程内共享的熔断器：AI平台按 "平台/模型"，Git平台按 "平台@主机"
+ai_breakers = CircuitBreakerRegistry(AI_SLOW_CALL_SECONDS, is_provider_failure)
+git_breakers = CircuitBreakerRegistry(GIT_SLOW_CALL_SECONDS, is_git_failure)
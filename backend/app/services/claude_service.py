@@ -1,7 +1,8 @@
 from anthropic import Anthropic
 from dotenv import load_dotenv
-from app.utils.format_message import format_user_message
+from app.utils.prompt_cache import split_prompt_data, build_anthropic_system
 from app.services.ai_service_base import AIServiceBase
+from app.services.key_pool import get_key_pool
 from typing import AsyncGenerator, Literal
 import aiohttp
 import json
@@ -12,8 +13,13 @@ load_dotenv()
 
 class ClaudeService(AIServiceBase):
     def __init__(self):
-        self.default_client = Anthropic()
-        self.base_url = "https://api.anthropic.com/v1/messages"
+        self.key_pool = get_key_pool("anthropic")
+        self.default_client = Anthropic(api_key=self.key_pool.default_key())
+        # 与Anthropic SDK一致，可通过ANTHROPIC_BASE_URL指向代理或本地模拟服务
+        self.base_url = (
+            os.getenv("ANTHROPIC_BASE_URL", "https://api.anthropic.com").rstrip("/")
+            + "/v1/messages"
+        )
 
     def call_api(
         self, 
@@ -34,25 +40,38 @@ class ClaudeService(AIServiceBase):
         Returns:
             str: Claude's response text
         """
-        # Create the user message with the data
-        user_message = format_user_message(data)
+        # Static repository context goes first so it can be served from the prompt cache
+        context_blocks, user_message = split_prompt_data(data)
 
-        # Use custom client if API key provided, otherwise use default
-        client = Anthropic(api_key=api_key) if api_key else self.default_client
+        # Use custom client if API key provided, otherwise the least-loaded server key
+        lease = None if api_key else self.key_pool.acquire()
+        if api_key or lease:
+            client = Anthropic(api_key=api_key or lease.key)  # type: ignore
+        else:
+            client = self.default_client
         
         # 根据reasoning_effort调整temperature
         temp_map = {"low": 0.7, "medium": 0.3, "high": 0}
         temperature = temp_map.get(reasoning_effort, 0.3)
 
-        message = client.messages.create(
-            model="claude-3-5-sonnet-latest",
-            max_tokens=4096,
-            temperature=temperature,
-            system=system_prompt,
-            messages=[
-                {"role": "user", "content": [{"type": "text", "text": user_message}]}
-            ],
-        )
+        try:
+            message = client.messages.create(
+                model="claude-3-5-sonnet-latest",
+                max_tokens=4096,
+                temperature=temperature,
+                system=build_anthropic_system(system_prompt, context_blocks),  # type: ignore
+                messages=[
+                    {"role": "user", "content": [{"type": "text", "text": user_message}]}
+                ],
+            )
+        except Exception as e:
+            if lease:
+                lease.observe_error(e)
+            raise
+        finally:
+            if lease:
+                lease.release()
+        self.record_usage(message.usage.model_dump())
         return message.content[0].text  # type: ignore
 
     async def call_api_stream(
@@ -74,16 +93,18 @@ class ClaudeService(AIServiceBase):
         Yields:
             str: Chunks of Claude's response text
         """
-        # Create the user message with the data
-        user_message = format_user_message(data)
+        # Static repository context goes first so it can be served from the prompt cache
+        context_blocks, user_message = split_prompt_data(data)
         
         # 根据reasoning_effort调整temperature
         temp_map = {"low": 0.7, "medium": 0.3, "high": 0}
         temperature = temp_map.get(reasoning_effort, 0.3)
         
+        # Use the least-loaded server key unless a custom key is provided
+        lease = None if api_key else self.key_pool.acquire()
         headers = {
             "Content-Type": "application/json",
-            "x-api-key": api_key or os.getenv("ANTHROPIC_API_KEY", ""),
+            "x-api-key": api_key or (lease.key if lease else ""),
             "anthropic-version": "2023-06-01",
         }
         
@@ -91,7 +112,7 @@ class ClaudeService(AIServiceBase):
             "model": "claude-3-5-sonnet-latest",
             "max_tokens": 4096,
             "temperature": temperature,
-            "system": system_prompt,
+            "system": build_anthropic_system(system_prompt, context_blocks),
             "messages": [
                 {"role": "user", "content": [{"type": "text", "text": user_message}]}
             ],
@@ -103,6 +124,8 @@ class ClaudeService(AIServiceBase):
                 async with session.post(
                     self.base_url, headers=headers, json=payload
                 ) as response:
+                    if lease:
+                        lease.observe(response.status, response.headers)
                     
                     if response.status != 200:
                         error_text = await response.text()
@@ -111,6 +134,7 @@ class ClaudeService(AIServiceBase):
                             f"Claude API returned status code {response.status}: {error_text}"
                         )
                     
+                    usage: dict = {}
                     async for line in response.content:
                         line = line.decode("utf-8").strip()
                         if not line or line == "event: ping":
@@ -125,9 +149,17 @@ class ClaudeService(AIServiceBase):
                                     content = data.get("delta", {}).get("text", "")
                                     if content:
                                         yield content
+                                elif data.get("type") == "message_start":
+                                    # 输入令牌及缓存读取/写入数在message_start中给出
+                                    usage.update(data.get("message", {}).get("usage") or {})
+                                elif data.get("type") == "message_delta":
+                                    usage.update(data.get("usage") or {})
                             except json.JSONDecodeError as e:
                                 print(f"JSON decode error: {e} for line: {line}")
                                 continue
+
+                    if usage:
+                        self.record_usage(usage)
                                 
         except aiohttp.ClientError as e:
             print(f"Connection error: {str(e)}")
@@ -135,6 +167,9 @@ class ClaudeService(AIServiceBase):
         except Exception as e:
             print(f"Unexpected error in streaming API call: {str(e)}")
             raise
+        finally:
+            if lease:
+                lease.release()
 
     def count_tokens(self, prompt: str) -> int:
         """
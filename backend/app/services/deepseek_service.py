@@ -1,7 +1,8 @@
 from openai import OpenAI as DeepSeekAPI
 from dotenv import load_dotenv
-from app.utils.format_message import format_user_message
+from app.utils.prompt_cache import build_chat_messages
 from app.services.ai_service_base import AIServiceBase
+from app.services.key_pool import get_key_pool
 import os
 import aiohttp
 import json
@@ -12,8 +13,12 @@ load_dotenv()
 
 class DeepSeekService(AIServiceBase):
     def __init__(self):
+        # 可通过DEEPSEEK_BASE_URL指向代理或本地模拟服务
+        self.api_base = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com/v1").rstrip("/")
+        self.key_pool = get_key_pool("deepseek")
         self.default_client = DeepSeekAPI(
-            api_key=os.getenv("DEEPSEEK_API_KEY"),
+            api_key=self.key_pool.default_key(),
+            base_url=self.api_base,
         )
         # 尝试使用适合DeepSeek模型的编码器或默认值
         try:
@@ -21,7 +26,7 @@ class DeepSeekService(AIServiceBase):
         except:
             self.encoding = tiktoken.get_encoding("gpt2")  # 兜底使用通用编码器
             
-        self.base_url = "https://api.deepseek.com/v1/chat/completions"  # DeepSeek API端点
+        self.base_url = f"{self.api_base}/chat/completions"  # DeepSeek API端点
         self.default_model = "deepseek-chat"  # 默认模型名称
 
     def call_api(
@@ -43,11 +48,12 @@ class DeepSeekService(AIServiceBase):
         Returns:
             str: DeepSeek的响应文本
         """
-        # 创建用户消息
-        user_message = format_user_message(data)
-        
-        # 使用自定义API密钥或默认客户端
-        client = DeepSeekAPI(api_key=api_key) if api_key else self.default_client
+        # 使用自定义API密钥，否则从服务器密钥池中选择最空闲的密钥
+        lease = None if api_key else self.key_pool.acquire()
+        if api_key or lease:
+            client = DeepSeekAPI(api_key=api_key or lease.key, base_url=self.api_base)  # type: ignore
+        else:
+            client = self.default_client
         
         try:
             print(f"调用DeepSeek API，使用API密钥: {'自定义密钥' if api_key else '默认密钥'}")
@@ -59,16 +65,16 @@ class DeepSeekService(AIServiceBase):
             # 调用DeepSeek API
             completion = client.chat.completions.create(
                 model=self.default_model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_message},
-                ],
+                messages=build_chat_messages(system_prompt, data),  # type: ignore
                 max_tokens=4000,  # 根据DeepSeek限制调整
                 temperature=temperature,
             )
             
             print("API调用成功完成")
             
+            if completion.usage:
+                self.record_usage(completion.usage.model_dump())
+            
             if completion.choices[0].message.content is None:
                 raise ValueError("DeepSeek没有返回内容")
                 
@@ -76,7 +82,12 @@ class DeepSeekService(AIServiceBase):
             
         except Exception as e:
             print(f"DeepSeek API调用错误: {str(e)}")
+            if lease:
+                lease.observe_error(e)
             raise
+        finally:
+            if lease:
+                lease.release()
 
     async def call_api_stream(
         self,
@@ -97,13 +108,13 @@ class DeepSeekService(AIServiceBase):
         Yields:
             str: DeepSeek响应文本的片段
         """
-        # 创建用户消息
-        user_message = format_user_message(data)
-        
+        # 未提供自定义密钥时从服务器密钥池中选择最空闲的密钥
+        lease = None if api_key else self.key_pool.acquire()
+
         # 准备API请求头
         headers = {
             "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key or os.getenv('DEEPSEEK_API_KEY')}",
+            "Authorization": f"Bearer {api_key or (lease.key if lease else '')}",
         }
         
         # 转换reasoning_effort为temperature
@@ -113,13 +124,11 @@ class DeepSeekService(AIServiceBase):
         # 准备请求负载
         payload = {
             "model": self.default_model,
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_message},
-            ],
+            "messages": build_chat_messages(system_prompt, data),
             "max_tokens": 4000,
             "temperature": temperature,
             "stream": True,
+            "stream_options": {"include_usage": True},
         }
         
         try:
@@ -127,6 +136,8 @@ class DeepSeekService(AIServiceBase):
                 async with session.post(
                     self.base_url, headers=headers, json=payload
                 ) as response:
+                    if lease:
+                        lease.observe(response.status, response.headers)
                     
                     if response.status != 200:
                         error_text = await response.text()
@@ -148,8 +159,11 @@ class DeepSeekService(AIServiceBase):
                                 break
                             try:
                                 data = json.loads(line[6:])
+                                # include_usage时最后一个片段的choices为空，只携带usage
+                                if data.get("usage"):
+                                    self.record_usage(data["usage"])
                                 content = (
-                                    data.get("choices", [{}])[0]
+                                    (data.get("choices") or [{}])[0]
                                     .get("delta", {})
                                     .get("content")
                                 )
@@ -168,6 +182,9 @@ class DeepSeekService(AIServiceBase):
         except Exception as e:
             print(f"流式API调用中出现意外错误: {str(e)}")
             raise
+        finally:
+            if lease:
+                lease.release()
             
     def count_tokens(self, prompt: str) -> int:
         """
@@ -0,0 +1,834 @@
+from dotenv import load_dotenv
+from pydantic import BaseModel
+from contextlib import aclosing
+from functools import lru_cache
+from typing import AsyncGenerator, Literal
+import asyncio
+import hashlib
+import os
+import re
+from app.services.git_factory import GitServiceFactory
+from app.services.provider_router import ProviderRouter
+from app.services.admission import AdmissionRejected
+from app.services.scheduler import scheduler
+from app.utils.tree_summarizer import summarize_file_tree
+from app.utils.readme_trimmer import trim_readme
+from app.utils.tree_pruner import prune_file_tree
+from app.utils.click_events import attach_click_events, extract_click_mapping
+from app.utils.mermaid_validator import repair_diagram, format_diagram_errors, apply_line_fixes
+from app.utils.diagram_stream import DiagramStreamMonitor, DiagramSnapshotter
+from app.utils.streaming import merge_async_streams, TaggedStreamDemultiplexer
+from app.utils.prompt_cache import PROMPT_CACHE_ENABLED, merge_usage
+from app.utils.component_mapper import (
+    map_components_locally,
+    parse_component_mapping,
+    format_component_mapping,
+)
+from app.prompts import (
+    SYSTEM_FIRST_PROMPT,
+    SYSTEM_SECOND_PROMPT,
+    SYSTEM_SECOND_PROMPT_UNRESOLVED_COMPONENTS,
+    SYSTEM_THIRD_PROMPT,
+    SYSTEM_THIRD_PROMPT_WITHOUT_MAPPING,
+    SYSTEM_THIRD_PROMPT_WITH_FILE_TREE,
+    SYSTEM_SINGLE_CALL_PROMPT,
+    SYSTEM_FIX_DIAGRAM_PROMPT,
+    DIAGRAM_RETRY_PROMPTS,
+    ADDITIONAL_SYSTEM_INSTRUCTIONS_PROMPT,
+)
+
+load_dotenv()
+
+# 获取默认AI平台和模型配置
+DEFAULT_AI_PLATFORM = os.getenv("DEFAULT_AI_PLATFORM", "openai")
+DEFAULT_AI_MODEL = os.getenv("DEFAULT_AI_MODEL", "o3-mini")
+DEFAULT_REASONING_EFFORT = os.getenv("DEFAULT_REASONING_EFFORT", "medium")
+
+# 组件映射模式: llm（阶段2调用LLM）、local（仅本地映射）、auto（本地置信度足够时跳过LLM）
+DEFAULT_MAPPING_MODE = os.getenv("DEFAULT_MAPPING_MODE", "llm")
+LOCAL_MAPPING_CONFIDENCE = float(os.getenv("LOCAL_MAPPING_CONFIDENCE", "0.8"))
+
+# 生成流程拓扑:
+# - three_phase: 依次执行解释、映射、图表三个阶段
+# - parallel: 阶段2与阶段3并行，之后本地附加click事件
+# - two_phase: 解释之后直接根据文件树生成带click事件的图表
+# - single_call: 一次调用输出解释、映射和图表三个段落
+# - auto: 根据令牌数自动选择
+DEFAULT_PIPELINE = os.getenv("DEFAULT_PIPELINE", "three_phase")
+SINGLE_CALL_MAX_TOKENS = int(os.getenv("SINGLE_CALL_MAX_TOKENS", "10000"))
+TWO_PHASE_MAX_TOKENS = int(os.getenv("TWO_PHASE_MAX_TOKENS", "30000"))
+
+# 获取AI服务令牌限制
+AI_TOKEN_LIMITS = {
+    "openai": {"o3-mini": 195000, "o4-mini": 195000},
+    "claude": {"claude-3-5-sonnet": 180000},
+    "deepseek": {"deepseek-chat": 128000},
+}
+
+# 免费用户（未提供API密钥）的令牌上限
+FREE_TIER_TOKEN_LIMIT = 50000
+
+# 文件树的目标令牌预算，超过时会折叠大型目录而不是直接拒绝
+FILE_TREE_TOKEN_BUDGET = int(os.getenv("FILE_TREE_TOKEN_BUDGET", "40000"))
+
+# README的目标令牌预算，超过时按章节相关性裁剪
+README_TOKEN_BUDGET = int(os.getenv("README_TOKEN_BUDGET", "10000"))
+
+# 系统提示等固定部分的估计输入令牌数，以及一次生成的估计输出令牌数
+ESTIMATED_PROMPT_TOKENS = 3000
+ESTIMATED_OUTPUT_TOKENS = 8000
+
+# 阶段2（两阶段模式下为图表阶段）是否发送剪枝后的文件树: true, false, auto
+# auto（默认）只在启用提示缓存的three_phase流程中不剪枝：阶段1结束后才开始的阶段2发送
+# 与阶段1相同的文件树，可以命中提供方的前缀缓存，比剪枝后重新处理的较小文件树更快也更便宜
+PRUNE_MAPPING_FILE_TREE = os.getenv("PRUNE_MAPPING_FILE_TREE", "auto").lower()
+
+# 各段落开始时发送的状态消息
+PHASE_MESSAGES = {
+    "explanation": "分析仓库结构...",
+    "mapping": "创建组件映射...",
+    "diagram": "生成图表...",
+}
+
+# 本地无法修复的语法错误是否请求模型修正出错的行，以及请求修正的最大错误行数
+# （错误过多时说明输出整体无效，只修正个别行没有意义）
+DIAGRAM_FIX_REPROMPT = os.getenv("DIAGRAM_FIX_REPROMPT", "true").lower() == "true"
+DIAGRAM_FIX_MAX_ERRORS = int(os.getenv("DIAGRAM_FIX_MAX_ERRORS", "20"))
+
+# 图表阶段的流式输出失控（非Mermaid内容、重复循环、超出上限）时中止后重试的次数，用尽后直接返回错误
+DIAGRAM_STREAM_RETRIES = int(os.getenv("DIAGRAM_STREAM_RETRIES", "1"))
+
+# 图表阶段被提前中止的次数（按原因）、重试次数和重试用尽后失败的次数（进程内累计）
+diagram_guard_stats = {"non_mermaid": 0, "repetition": 0, "budget": 0, "retried": 0, "failed": 0}
+
+# 客户端断开而提前结束的生成数，以及因此未消耗的预估令牌数（进程内累计）
+cancellation_stats = {"cancelled": 0, "saved_tokens": 0}
+
+
+class ApiRequest(BaseModel):
+    platform: str = "github"  # 默认为GitHub
+    username: str
+    repo: str
+    instructions: str = ""
+    api_key: str | None = None
+    git_token: str | None = None  # 通用的Git平台令牌
+    git_api_url: str | None = None  # 自定义Git API URL
+    ai_platform: str | None = None  # AI平台: openai, claude, deepseek
+    ai_model: str | None = None  # AI模型，根据平台不同而不同
+    reasoning_effort: Literal["low", "medium", "high"] | None = None  # 推理努力程度
+    mapping_mode: Literal["llm", "local", "auto"] | None = None  # 组件映射模式
+    pipeline: Literal["three_phase", "parallel", "two_phase", "single_call", "auto"] | None = None  # 生成流程拓扑
+    full_result: bool = False  # complete事件是否重新发送完整的解释和组件映射
+
+
+def get_token_limit(ai_platform: str, ai_model: str, has_api_key: bool) -> int:
+    """获取当前请求可用的令牌上限（免费用户受FREE_TIER_TOKEN_LIMIT限制）"""
+    max_token_limit = AI_TOKEN_LIMITS.get(ai_platform, {}).get(ai_model, 195000)
+    if not has_api_key:
+        return min(max_token_limit, FREE_TIER_TOKEN_LIMIT)
+    return max_token_limit
+
+
+def fit_file_tree(ai_service, file_tree: str, readme_tokens: int, token_limit: int) -> dict:
+    """
+    将文件树压缩到剩余令牌预算内（预算 = min(FILE_TREE_TOKEN_BUDGET, 上限 - README令牌数)）
+
+    Returns:
+        dict: summarize_file_tree的结果
+    """
+    tree_budget = max(min(FILE_TREE_TOKEN_BUDGET, token_limit - readme_tokens), 0)
+    return summarize_file_tree(file_tree, tree_budget, ai_service.count_tokens)
+
+
+def should_prune_file_tree(pipeline: str) -> bool:
+    """按PRUNE_MAPPING_FILE_TREE判断该流程是否发送剪枝后的文件树"""
+    if PRUNE_MAPPING_FILE_TREE != "auto":
+        return PRUNE_MAPPING_FILE_TREE == "true"
+    return not (PROMPT_CACHE_ENABLED and pipeline == "three_phase")
+
+
+def select_pipeline(pipeline: str, token_count: int) -> str:
+    """
+    解析生成流程拓扑；auto模式下小仓库使用单次调用，中等仓库使用两阶段，大仓库使用三阶段
+    """
+    if pipeline != "auto":
+        return pipeline
+    if token_count <= SINGLE_CALL_MAX_TOKENS:
+        return "single_call"
+    if token_count <= TWO_PHASE_MAX_TOKENS:
+        return "two_phase"
+    return "three_phase"
+
+
+def estimate_generation_tokens(pipeline: str, file_tree_tokens: int, readme_tokens: int) -> dict:
+    """
+    估算一次生成的输入和输出令牌数（单次调用和两阶段流程只发送一次完整文件树）
+
+    Returns:
+        dict: input 和 output 令牌数
+    """
+    tree_multiplier = 1 if pipeline in ("single_call", "two_phase") else 2
+    return {
+        "input": file_tree_tokens * tree_multiplier + readme_tokens + ESTIMATED_PROMPT_TOKENS,
+        "output": ESTIMATED_OUTPUT_TOKENS,
+    }
+
+
+# cache git data to avoid double API calls from cost and generate
+@lru_cache(maxsize=100)
+def get_cached_git_data(platform: str, username: str, repo: str, token: str | None = None, base_url: str | None = None):
+    # 使用工厂创建适当的Git服务
+    git_service = GitServiceFactory.create_service(platform, token, base_url)
+
+    default_branch = git_service.get_default_branch(username, repo)
+    if not default_branch:
+        default_branch = "main"  # fallback value
+
+    file_tree = git_service.get_file_tree(username, repo)
+    readme = git_service.get_readme(username, repo)
+
+    return {"default_branch": default_branch, "file_tree": file_tree, "readme": readme, "service": git_service}
+
+
+def extract_component_mapping(full_second_response: str, local_mapping: dict | None = None) -> str:
+    """
+    从阶段2的响应中提取组件映射文本，并与本地映射中已解析的组件合并
+    """
+    start_tag = "<component_mapping>"
+    end_tag = "</component_mapping>"
+    component_mapping_text = full_second_response[
+        full_second_response.find(start_tag) : full_second_response.find(end_tag)
+    ]
+    if local_mapping is None:
+        return component_mapping_text
+
+    entries = parse_component_mapping(local_mapping["mapping_text"])
+    mapped_names = {name.lower() for name, _ in entries}
+    entries += [
+        (name, path)
+        for name, path in parse_component_mapping(component_mapping_text)
+        if name.lower() not in mapped_names
+    ]
+    return format_component_mapping(entries)
+
+
+def process_click_events(diagram: str, platform: str, username: str, repo: str, branch: str, git_service) -> str:
+    """
+    Process click events in Mermaid diagram to include full Git URLs.
+    Detects if path is file or directory and uses appropriate URL format.
+    """
+
+    def replace_path(match):
+        # Extract the path from the click event
+        path = match.group(2).strip("\"'")
+
+        # Determine if path is likely a file (has extension) or directory
+        is_file = "." in path.split("/")[-1]
+
+        # Construct Git URL based on platform
+        if is_file:
+            full_url = git_service.get_file_url(username, repo, path, branch)
+        else:
+            full_url = git_service.get_directory_url(username, repo, path, branch)
+
+        # Return the full click event with the new URL
+        return f'click {match.group(1)} "{full_url}"'
+
+    # Match click events: click ComponentName "path/to/something"
+    click_pattern = r'click ([^\s"]+)\s+"([^"]+)"'
+    return re.sub(click_pattern, replace_path, diagram)
+
+
+async def fix_diagram_errors(
+    ai_service, diagram: str, errors: list[dict], api_key: str | None, reasoning_effort: str
+) -> dict:
+    """
+    请求模型只修正本地无法修复的行（只发送出错的行及其上下文），再在本地校验一次
+
+    Args:
+        ai_service: 提供方路由器
+        diagram: 已经过本地修复的图表
+        errors: repair_diagram 返回的错误行
+
+    Returns:
+        dict: 与 repair_diagram 相同；修正没有减少错误时返回原图及原来的错误
+    """
+    response = ""
+    async for chunk in ai_service.call_api_stream(
+        system_prompt=SYSTEM_FIX_DIAGRAM_PROMPT,
+        data={"errors": format_diagram_errors(diagram, errors)},
+        api_key=api_key,
+        reasoning_effort=reasoning_effort,
+    ):
+        response += chunk
+    result = repair_diagram(apply_line_fixes(diagram, errors, response))
+    if len(result["errors"]) >= len(errors):
+        return {"diagram": diagram, "repairs": [], "errors": errors}
+    return result
+
+
+class DiagramRetry:
+    """guarded_diagram_stream 在中止一次失控的输出、准备重试时产出的标记，此前的片段应当丢弃"""
+
+    def __init__(self, problem: dict):
+        self.reason = problem["reason"]
+        self.message = problem["message"]
+
+
+class DiagramStreamAborted(Exception):
+    """图表阶段的输出失控且重试次数已用尽"""
+
+
+async def guarded_diagram_stream(
+    ai_service,
+    system_prompt: str,
+    data: dict,
+    api_key: str | None,
+    reasoning_effort: str,
+    retries: int = DIAGRAM_STREAM_RETRIES,
+) -> AsyncGenerator[str | DiagramRetry, None]:
+    """
+    图表阶段的流式调用：逐行检查输出，发现失控时立即关闭上游流（不再为剩余输出付费），
+    附加针对该问题的提示后重试
+
+    Args:
+        ai_service: 提供方路由器
+        system_prompt: 图表阶段的系统提示
+        data: 图表阶段的用户消息数据
+        retries: 最多重试次数
+
+    Yields:
+        str | DiagramRetry: 图表片段；重试前产出 DiagramRetry，调用方应丢弃已收到的片段
+
+    Raises:
+        DiagramStreamAborted: 重试次数用尽后仍然失控
+    """
+    prompt = system_prompt
+    for attempt in range(retries + 1):
+        monitor = DiagramStreamMonitor()
+        problem = None
+        async with aclosing(
+            ai_service.call_api_stream(
+                system_prompt=prompt,
+                data=data,
+                api_key=api_key,
+                reasoning_effort=reasoning_effort,
+            )
+        ) as stream:
+            async for chunk in stream:
+                problem = monitor.feed(chunk)
+                if problem is not None:
+                    break
+                yield chunk
+        if problem is None:
+            return
+        diagram_guard_stats[problem["reason"]] += 1
+        print(f"图表输出失控，已中止 ({problem['reason']}): {problem['message']}")
+        if attempt == retries:
+            diagram_guard_stats["failed"] += 1
+            raise DiagramStreamAborted(f"图表生成失败: {problem['message']}")
+        diagram_guard_stats["retried"] += 1
+        prompt = system_prompt + "\n" + DIAGRAM_RETRY_PROMPTS[problem["reason"]]
+        yield DiagramRetry(problem)
+
+
+def diagram_retry_event(retry: DiagramRetry) -> dict:
+    """重试图表阶段时发送给客户端的事件，客户端应清空已收到的图表片段"""
+    return {
+        'status': 'diagram_retry',
+        'message': f'{retry.message}，重新生成图表...',
+        'reason': retry.reason,
+    }
+
+
+def content_hash(text: str) -> str:
+    """文本的sha256摘要（十六进制），客户端据此校验拼接得到的内容"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def text_delta(streamed: str, final: str) -> dict | None:
+    """
+    后处理对已流式发送文本的修改，最终文本 = streamed[:offset] + text
+
+    Returns:
+        dict | None: {"offset", "text"}；没有修改时返回None
+    """
+    if streamed == final:
+        return None
+    offset = len(os.path.commonprefix([streamed, final]))
+    return {"offset": offset, "text": final[offset:]}
+
+
+def compact_complete_event(event: dict) -> dict:
+    """
+    去掉complete事件中已经以片段形式发送过的解释和组件映射
+
+    客户端用收到的片段拼接出解释和映射，按delta应用后处理的修改，并可用摘要校验；
+    其他事件原样返回。
+    """
+    if event.get("status") != "complete":
+        return event
+    return {key: value for key, value in event.items() if key not in ("explanation", "mapping")}
+
+
+async def generate_diagram_events(
+    body: ApiRequest, client_id: str | None = None
+) -> AsyncGenerator[dict, None]:
+    """
+    运行图表生成流程，依次产出事件（与SSE中 `data:` 的JSON内容一致）
+
+    complete事件除完整结果外，还带有解释和组件映射的摘要，以及后处理相对于已发送片段的
+    修改（delta），供 compact_complete_event 生成不重复发送内容的精简事件。
+
+    图表阶段按间隔插入diagram_snapshot事件，带有目前为止的输出整理成的可渲染图表
+    （补全未闭合的子图、去掉不完整的行），客户端可以在complete之前逐步显示图表。
+
+    Args:
+        body: 生成请求（调用方负责指令长度、示例仓库等前置校验）
+        client_id: 客户端标识（通常为远程地址），用于免费请求的限流
+
+    Yields:
+        dict: 状态事件、各阶段的片段事件、图表快照事件、最终的complete事件或error事件
+    """
+    streamed = {"explanation": [], "mapping": []}
+    snapshots = DiagramSnapshotter()
+    async with aclosing(_generate_diagram_events(body, client_id)) as events:
+        async for event in events:
+            status = event.get("status")
+            if status in ("explanation_chunk", "mapping_chunk"):
+                streamed[status.removesuffix("_chunk")].append(event["chunk"])
+            elif status == "diagram_chunk":
+                yield event
+                snapshot = snapshots.feed(event["chunk"])
+                if snapshot is not None:
+                    yield {'status': 'diagram_snapshot', 'diagram': snapshot}
+                continue
+            elif status == "diagram_retry":
+                snapshots.reset()
+            elif status == "complete":
+                delta = {}
+                for section in ("explanation", "mapping"):
+                    change = text_delta("".join(streamed[section]), event[section])
+                    if change is not None:
+                        delta[section] = change
+                event = {
+                    **event,
+                    'explanation_hash': content_hash(event["explanation"]),
+                    'mapping_hash': content_hash(event["mapping"]),
+                    'delta': delta,
+                }
+            yield event
+
+
+async def _generate_diagram_events(
+    body: ApiRequest, client_id: str | None = None
+) -> AsyncGenerator[dict, None]:
+    """生成流程本身，产出的complete事件带有完整的解释和组件映射"""
+    # 获取AI平台配置
+    ai_platform = body.ai_platform or DEFAULT_AI_PLATFORM
+    ai_model = body.ai_model or DEFAULT_AI_MODEL
+    reasoning_effort = body.reasoning_effort or DEFAULT_REASONING_EFFORT
+    ticket = None
+    ai_service = None
+
+    try:
+        # 创建AI服务（带对冲请求和故障切换的路由器）
+        ai_service = ProviderRouter(ai_platform, ai_model, body.api_key)
+
+        # Get cached git data
+        git_data = get_cached_git_data(
+            body.platform, body.username, body.repo, body.git_token, body.git_api_url
+        )
+        default_branch = git_data["default_branch"]
+        file_tree = git_data["file_tree"]
+        readme = git_data["readme"]
+        git_service = git_data["service"]
+
+        # Send initial status
+        yield {'status': 'started', 'message': f'使用 {ai_platform} ({ai_model}) 开始生成流程...'}
+        await asyncio.sleep(0.1)
+
+        # 裁剪README中与架构无关的章节（徽章、更新日志、安装矩阵等）
+        readme_trim = trim_readme(
+            readme, README_TOKEN_BUDGET, ai_service.count_tokens, f"{ai_platform}/{ai_model}"
+        )
+        if readme_trim["readme"] != readme:
+            readme = readme_trim["readme"]
+            yield {
+                'status': 'readme_trimmed',
+                'message': f'README较长，已裁剪 {len(readme_trim["dropped_sections"])} 个无关章节',
+                'original_tokens': readme_trim['original_tokens'],
+                'tokens': readme_trim['tokens'],
+                'dropped_sections': readme_trim['dropped_sections'],
+            }
+        readme_tokens = readme_trim["tokens"]
+
+        # Token count check
+        token_limit = get_token_limit(ai_platform, ai_model, bool(body.api_key))
+        max_token_limit = get_token_limit(ai_platform, ai_model, True)
+
+        # 大型仓库：折叠文件树以适应令牌预算，而不是直接拒绝
+        tree_summary = fit_file_tree(ai_service, file_tree, readme_tokens, token_limit)
+        if tree_summary["file_tree"] != file_tree:
+            file_tree = tree_summary["file_tree"]
+            yield {
+                'status': 'tree_summarized',
+                'message': f'仓库较大，已折叠 {tree_summary["collapsed_dirs"]} 个目录（省略 {tree_summary["elided_files"]} 个文件）',
+                'original_tokens': tree_summary['original_tokens'],
+                'tokens': tree_summary['tokens'],
+                'elided_files': tree_summary['elided_files'],
+                'collapsed_dirs': tree_summary['collapsed_dirs'],
+                'truncated': tree_summary['truncated'],
+            }
+        token_count = tree_summary["tokens"] + readme_tokens
+
+        if FREE_TIER_TOKEN_LIMIT < token_count < max_token_limit and not body.api_key:
+            yield {'error': f'文件树和README合计超过令牌限制 (50,000)。当前大小: {token_count} 令牌。此仓库太大，无法免费分析，但您可以提供自己的 {ai_platform} API密钥继续。'}
+            return
+        elif token_count > max_token_limit:
+            yield {'error': f'仓库过大 (>{max_token_limit}k 令牌)，无法分析。{ai_platform} {ai_model} 的最大上下文长度为 {max_token_limit} 令牌。当前大小: {token_count} 令牌。'}
+            return
+
+        pipeline = select_pipeline(body.pipeline or DEFAULT_PIPELINE, token_count)
+
+        # 调度：免费请求与自带密钥请求分类加权公平排队；免费请求按客户端令牌桶限流，
+        # 并受服务器密钥的平台/模型并发和令牌预算限制
+        estimate = estimate_generation_tokens(pipeline, tree_summary["tokens"], readme_tokens)
+        try:
+            ticket = scheduler.request(
+                client_id,
+                ai_platform,
+                ai_model,
+                estimate["input"] + estimate["output"],
+                body.api_key,
+            )
+            async for event in ticket.wait():
+                yield event
+        except AdmissionRejected as e:
+            yield {'error': f'{ai_platform} ({ai_model}): {e}'}
+            return
+
+        # Prepare prompts
+        first_system_prompt = SYSTEM_FIRST_PROMPT
+        third_system_prompt = SYSTEM_THIRD_PROMPT
+        single_call_system_prompt = SYSTEM_SINGLE_CALL_PROMPT
+        if body.instructions:
+            first_system_prompt = (
+                first_system_prompt
+                + "\n"
+                + ADDITIONAL_SYSTEM_INSTRUCTIONS_PROMPT
+            )
+            third_system_prompt = (
+                third_system_prompt
+                + "\n"
+                + ADDITIONAL_SYSTEM_INSTRUCTIONS_PROMPT
+            )
+            single_call_system_prompt = (
+                single_call_system_prompt
+                + "\n"
+                + ADDITIONAL_SYSTEM_INSTRUCTIONS_PROMPT
+            )
+
+        if pipeline == "single_call":
+            # Single call: explanation, mapping and diagram as tagged sections of one response
+            yield {'status': 'explanation_sent', 'message': f'向 {ai_platform} 发送单次生成请求...'}
+            await asyncio.sleep(0.1)
+            yield {'status': 'explanation', 'message': PHASE_MESSAGES["explanation"]}
+            demultiplexer = TaggedStreamDemultiplexer(
+                {"explanation": "explanation", "component_mapping": "mapping", "diagram": "diagram"}
+            )
+            sections = {"explanation": "", "mapping": "", "diagram": ""}
+            current_section = "explanation"
+            full_response = ""
+            monitor = DiagramStreamMonitor()
+            problem = None
+
+            async with aclosing(
+                ai_service.call_api_stream(
+                    system_prompt=single_call_system_prompt,
+                    data={
+                        "file_tree": file_tree,
+                        "readme": readme,
+                        "instructions": body.instructions,
+                    },
+                    api_key=body.api_key,
+                    reasoning_effort=reasoning_effort,
+                )
+            ) as stream:
+                async for chunk in stream:
+                    full_response += chunk
+                    for section, text in demultiplexer.feed(chunk):
+                        if section != current_section:
+                            current_section = section
+                            yield {'status': section, 'message': PHASE_MESSAGES[section]}
+                        if section == "diagram":
+                            problem = monitor.feed(text)
+                            if problem is not None:
+                                break
+                        sections[section] += text
+                        yield {'status': f'{section}_chunk', 'chunk': text}
+                    if problem is not None:
+                        break
+            if problem is None:
+                for section, text in demultiplexer.flush():
+                    sections[section] += text
+                    yield {'status': f'{section}_chunk', 'chunk': text}
+            else:
+                # 图表段落失控：保留已生成的解释和映射，只用图表阶段的提示重新生成图表
+                diagram_guard_stats[problem["reason"]] += 1
+                print(f"图表输出失控，已中止 ({problem['reason']}): {problem['message']}")
+                if DIAGRAM_STREAM_RETRIES < 1:
+                    diagram_guard_stats["failed"] += 1
+                    raise DiagramStreamAborted(f"图表生成失败: {problem['message']}")
+                diagram_guard_stats["retried"] += 1
+                yield diagram_retry_event(DiagramRetry(problem))
+                sections["diagram"] = ""
+                async for chunk in guarded_diagram_stream(
+                    ai_service,
+                    third_system_prompt + "\n" + DIAGRAM_RETRY_PROMPTS[problem["reason"]],
+                    {
+                        "explanation": sections["explanation"],
+                        "component_mapping": "<component_mapping>" + sections["mapping"],
+                        "instructions": body.instructions,
+                    },
+                    body.api_key,
+                    reasoning_effort,
+                    retries=DIAGRAM_STREAM_RETRIES - 1,
+                ):
+                    if isinstance(chunk, DiagramRetry):
+                        sections["diagram"] = ""
+                        yield diagram_retry_event(chunk)
+                        continue
+                    sections["diagram"] += chunk
+                    yield {'status': 'diagram_chunk', 'chunk': chunk}
+
+            if "BAD_INSTRUCTIONS" in full_response:
+                yield {'error': '提供的指令无效或不明确'}
+                return
+
+            explanation = sections["explanation"]
+            component_mapping_text = "<component_mapping>" + sections["mapping"]
+            mermaid_code = sections["diagram"]
+            run_parallel = False
+        else:
+            # Phase 1: Get explanation
+            yield {'status': 'explanation_sent', 'message': f'向 {ai_platform} 发送解释请求...'}
+            await asyncio.sleep(0.1)
+            yield {'status': 'explanation', 'message': PHASE_MESSAGES["explanation"]}
+            explanation = ""
+            async for chunk in ai_service.call_api_stream(
+                system_prompt=first_system_prompt,
+                data={
+                    "file_tree": file_tree,
+                    "readme": readme,
+                    "instructions": body.instructions,
+                },
+                api_key=body.api_key,
+                reasoning_effort=reasoning_effort,
+            ):
+                explanation += chunk
+                yield {'status': 'explanation_chunk', 'chunk': chunk}
+
+            if "BAD_INSTRUCTIONS" in explanation:
+                yield {'error': '提供的指令无效或不明确'}
+                return
+
+            mapping_stream = None
+            local_mapping = None
+            component_mapping_text = ""
+            if pipeline != "two_phase":
+                # 本地组件映射：置信度足够高时跳过阶段2的LLM调用
+                mapping_mode = body.mapping_mode or DEFAULT_MAPPING_MODE
+                if mapping_mode != "llm":
+                    local_mapping = map_components_locally(file_tree, explanation)
+                    yield {
+                        'status': 'mapping_local',
+                        'message': f'本地组件映射置信度: {local_mapping["confidence"]:.2f}',
+                        'confidence': local_mapping['confidence'],
+                        'components': local_mapping['components'],
+                        'unresolved': local_mapping['unresolved'],
+                    }
+
+                # 没有提取出任何组件时（解释中找不到组件列表）仍需LLM映射，否则图表没有click事件
+                if local_mapping is not None and (
+                    mapping_mode == "local"
+                    or local_mapping["components"]
+                    and (
+                        not local_mapping["unresolved"]
+                        or local_mapping["confidence"] >= LOCAL_MAPPING_CONFIDENCE
+                    )
+                ):
+                    yield {'status': 'mapping', 'message': '使用本地组件映射...'}
+                    component_mapping_text = local_mapping["mapping_text"]
+                    yield {'status': 'mapping_chunk', 'chunk': component_mapping_text}
+                else:
+                    # 只把解释中提到的子树（加上顶层上下文）发送给阶段2
+                    mapping_file_tree = file_tree
+                    if should_prune_file_tree(pipeline):
+                        tree_pruning = prune_file_tree(file_tree, explanation)
+                        mapping_file_tree = tree_pruning["file_tree"]
+                    if mapping_file_tree != file_tree:
+                        yield {
+                            'status': 'tree_pruned',
+                            'message': f'组件映射使用剪枝后的文件树 ({tree_pruning["entries"]}/{tree_pruning["original_entries"]} 个条目)',
+                            'entries': tree_pruning['entries'],
+                            'original_entries': tree_pruning['original_entries'],
+                        }
+
+                    # 已有本地映射时，LLM只需映射未解析的组件
+                    second_system_prompt = SYSTEM_SECOND_PROMPT
+                    second_data = {"explanation": explanation, "file_tree": mapping_file_tree}
+                    if local_mapping is not None:
+                        second_system_prompt = (
+                            second_system_prompt
+                            + "\n"
+                            + SYSTEM_SECOND_PROMPT_UNRESOLVED_COMPONENTS
+                        )
+                        second_data["components"] = "\n".join(local_mapping["unresolved"])
+
+                    # Phase 2: Get component mapping
+                    yield {'status': 'mapping_sent', 'message': f'向 {ai_platform} 发送组件映射请求...'}
+                    await asyncio.sleep(0.1)
+                    yield {'status': 'mapping', 'message': PHASE_MESSAGES["mapping"]}
+                    mapping_stream = ai_service.call_api_stream(
+                        system_prompt=second_system_prompt,
+                        data=second_data,
+                        api_key=body.api_key,
+                        reasoning_effort=reasoning_effort,
+                    )
+
+            # parallel模式：阶段2与阶段3同时运行，click事件在本地合并
+            run_parallel = mapping_stream is not None and pipeline == "parallel"
+            full_second_response = ""
+            if mapping_stream is not None and not run_parallel:
+                async for chunk in mapping_stream:
+                    full_second_response += chunk
+                    yield {'status': 'mapping_chunk', 'chunk': chunk}
+                component_mapping_text = extract_component_mapping(
+                    full_second_response, local_mapping
+                )
+
+            # Phase 3: Generate Mermaid diagram
+            yield {'status': 'diagram_sent', 'message': f'向 {ai_platform} 发送图表生成请求...'}
+            await asyncio.sleep(0.1)
+            yield {'status': 'diagram', 'message': PHASE_MESSAGES["diagram"]}
+            third_data = {"explanation": explanation, "instructions": body.instructions}
+            if pipeline == "two_phase":
+                # 两阶段：图表阶段直接根据（剪枝后的）文件树生成click事件
+                diagram_system_prompt = (
+                    third_system_prompt + "\n" + SYSTEM_THIRD_PROMPT_WITH_FILE_TREE
+                )
+                third_data["file_tree"] = (
+                    prune_file_tree(file_tree, explanation)["file_tree"]
+                    if should_prune_file_tree(pipeline)
+                    else file_tree
+                )
+            elif run_parallel:
+                diagram_system_prompt = (
+                    third_system_prompt + "\n" + SYSTEM_THIRD_PROMPT_WITHOUT_MAPPING
+                )
+            else:
+                diagram_system_prompt = third_system_prompt
+                third_data["component_mapping"] = component_mapping_text
+            diagram_stream = guarded_diagram_stream(
+                ai_service, diagram_system_prompt, third_data, body.api_key, reasoning_effort
+            )
+
+            mermaid_code = ""
+            if run_parallel:
+                async for phase, chunk in merge_async_streams(
+                    {"mapping": mapping_stream, "diagram": diagram_stream}
+                ):
+                    if phase == "mapping":
+                        full_second_response += chunk
+                    elif isinstance(chunk, DiagramRetry):
+                        mermaid_code = ""
+                        yield diagram_retry_event(chunk)
+                        continue
+                    else:
+                        mermaid_code += chunk
+                    yield {'status': f'{phase}_chunk', 'chunk': chunk}
+                component_mapping_text = extract_component_mapping(
+                    full_second_response, local_mapping
+                )
+            else:
+                async for chunk in diagram_stream:
+                    if isinstance(chunk, DiagramRetry):
+                        mermaid_code = ""
+                        yield diagram_retry_event(chunk)
+                        continue
+                    mermaid_code += chunk
+                    yield {'status': 'diagram_chunk', 'chunk': chunk}
+
+        # Process final diagram
+        mermaid_code = mermaid_code.replace("```mermaid", "").replace("```", "").strip()
+        if "BAD_INSTRUCTIONS" in mermaid_code:
+            yield {'error': '提供的指令无效或不明确'}
+            return
+
+        # 本地校验并修复常见的语法问题；无法修复的行单独请求模型修正，不重新运行整个流程
+        validation = repair_diagram(mermaid_code)
+        mermaid_code = validation["diagram"]
+        if validation["repairs"]:
+            yield {
+                'status': 'diagram_repaired',
+                'message': f'已自动修复图表中的 {len(validation["repairs"])} 处语法问题',
+                'repairs': validation["repairs"],
+            }
+        if validation["errors"] and DIAGRAM_FIX_REPROMPT and len(validation["errors"]) <= DIAGRAM_FIX_MAX_ERRORS:
+            yield {'status': 'diagram_fix', 'message': f'图表有 {len(validation["errors"])} 行语法错误，请求修正...'}
+            validation = await fix_diagram_errors(
+                ai_service, mermaid_code, validation["errors"], body.api_key, reasoning_effort
+            )
+            mermaid_code = validation["diagram"]
+        if validation["errors"]:
+            print(f"图表仍有 {len(validation['errors'])} 行语法错误: {body.username}/{body.repo}")
+
+        if run_parallel:
+            mermaid_code = attach_click_events(
+                mermaid_code, parse_component_mapping(component_mapping_text)
+            )
+        if pipeline == "two_phase":
+            component_mapping_text = format_component_mapping(extract_click_mapping(mermaid_code))
+
+        processed_diagram = process_click_events(
+            mermaid_code, body.platform, body.username, body.repo, default_branch, git_service
+        )
+
+        # Send final result
+        yield {
+            'status': 'complete',
+            'diagram': processed_diagram,
+            'explanation': explanation,
+            'mapping': component_mapping_text,
+            'ai_platform': ai_platform,
+            'ai_model': ai_model,
+            'pipeline': pipeline,
+            # 各次调用的令牌用量合计（含提示缓存命中的令牌数）
+            'usage': merge_usage(ai_service.usage_records),
+            # 各次调用实际使用的平台/模型、首令牌时间以及是否发生对冲或重试
+            'routes': ai_service.route_records,
+        }
+
+    except (GeneratorExit, asyncio.CancelledError):
+        # 客户端断开：上游流随取消一起中止，剩余阶段不再运行
+        if ticket is not None and ticket.started_at is not None:
+            spent = merge_usage(ai_service.usage_records)  # type: ignore
+            saved = max(
+                estimate["input"] + estimate["output"] - spent["input_tokens"] - spent["output_tokens"], 0
+            )
+            cancellation_stats["cancelled"] += 1
+            cancellation_stats["saved_tokens"] += saved
+            print(f"客户端已断开，取消生成 {body.username}/{body.repo}，节省约 {saved} 令牌")
+        raise
+    except Exception as e:
+        yield {'error': str(e)}
+    finally:
+        if ticket is not None:
+            # 用实际用量替换预估的令牌消耗
+            usage = merge_usage(ai_service.usage_records) if ai_service is not None else None
+            ticket.release(
+                usage["input_tokens"] + usage["output_tokens"]
+                if usage and usage["calls"]
+                else None
+            )
@@ -2,7 +2,39 @@ from app.services.git_service import GitService
 from app.services.github_service import GitHubService
 from app.services.gitlab_service import GitLabService
 from app.services.gitea_service import GiteaService
+from app.services.circuit_breaker import CircuitBreaker, git_breakers
 from typing import Optional
+from urllib.parse import urlparse
+
+
+class GuardedGitService(GitService):
+    """
+    在熔断器保护下调用Git平台API的包装服务
+
+    同一平台实例（如 github@api.github.com）故障时立即失败，而不是让每个请求都等待超时。
+    """
+
+    def __init__(self, service: GitService, breaker: CircuitBreaker):
+        self.service = service
+        self.breaker = breaker
+
+    def get_default_branch(self, username: str, repo: str) -> Optional[str]:
+        return self.breaker.call(self.service.get_default_branch, username, repo)
+
+    def get_file_tree(self, username: str, repo: str) -> str:
+        return self.breaker.call(self.service.get_file_tree, username, repo)
+
+    def get_readme(self, username: str, repo: str) -> str:
+        return self.breaker.call(self.service.get_readme, username, repo)
+
+    def check_repository_exists(self, username: str, repo: str) -> bool:
+        return self.breaker.call(self.service.check_repository_exists, username, repo)
+
+    def get_file_url(self, username: str, repo: str, path: str, branch: str) -> str:
+        return self.service.get_file_url(username, repo, path, branch)
+
+    def get_directory_url(self, username: str, repo: str, path: str, branch: str) -> str:
+        return self.service.get_directory_url(username, repo, path, branch)
 
 
 class GitServiceFactory:
@@ -21,7 +53,7 @@ class GitServiceFactory:
             base_url: API基础URL（可选，用于自定义实例）
             
         Returns:
-            GitService: 相应平台的Git服务实现
+            GitService: 相应平台的Git服务实现（包装在该平台实例的熔断器中）
             
         Raises:
             ValueError: 如果平台不受支持
@@ -29,10 +61,13 @@ class GitServiceFactory:
         platform = platform.lower()
         
         if platform == 'github':
-            return GitHubService(pat=token)
+            service = GitHubService(pat=token)
         elif platform == 'gitlab':
-            return GitLabService(pat=token, base_url=base_url)
+            service = GitLabService(pat=token, base_url=base_url)
         elif platform == 'gitea':
-            return GiteaService(pat=token, base_url=base_url)
+            service = GiteaService(pat=token, base_url=base_url)
         else:
-            raise ValueError(f"Unsupported platform: {platform}") 
\ No newline at end of file
+            raise ValueError(f"Unsupported platform: {platform}")
+
+        host = urlparse(service.base_url).netloc or service.base_url
+        return GuardedGitService(service, git_breakers.get(f"{platform}@{host}")) 
\ No newline at end of file
@@ -0,0 +1,463 @@
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from typing import Callable, TypeVar
+import asyncio
+import functools
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+load_dotenv()
+
+# 生成任务的执行方式:
+#   local    - 在接收请求的API进程中运行（默认）
+#   inprocess - 经由进程内队列交给API进程内嵌的工作器运行（用于测试和单进程部署）
+#   sqlite   - 写入共享的sqlite队列，由独立的工作进程（python -m app.worker）运行
+JOB_BROKER = os.getenv("JOB_BROKER", "local").lower()
+
+# sqlite队列的数据库路径（API进程和工作进程必须能访问同一文件）
+JOB_BROKER_DB = os.getenv(
+    "JOB_BROKER_DB", os.path.join(tempfile.gettempdir(), "gitdiagram_jobs.sqlite3")
+)
+
+# sqlite队列等待数据库锁的最长秒数；队列读写都在线程池中执行，不会阻塞事件循环
+JOB_BROKER_DB_TIMEOUT = float(os.getenv("JOB_BROKER_DB_TIMEOUT", "1.0"))
+
+# sqlite队列读写使用的线程数（每个线程一个数据库连接）
+JOB_BROKER_THREADS = 4
+
+# 工作进程超过该秒数没有心跳时，其运行中的任务被标记为失败
+WORKER_STALE_SECONDS = float(os.getenv("WORKER_STALE_SECONDS", "60"))
+
+WORKER_LOST_MESSAGE = "生成节点已停止，任务未能完成，请重新生成。"
+
+T = TypeVar("T")
+
+
+class JobBroker(ABC):
+    """
+    生成任务队列的抽象接口：API进程写入任务并读取事件，工作进程领取任务并回传事件
+    """
+
+    @abstractmethod
+    def enqueue(self, job_id: str, payload: dict, detached: bool = True) -> None:
+        """
+        写入一个待执行的任务
+
+        Args:
+            job_id: 任务ID
+            payload: 生成请求和客户端标识
+            detached: 为False时，最后一个订阅者断开后任务被取消；为True时任务总是运行到结束
+        """
+        pass
+
+    @abstractmethod
+    def claim(self, worker_id: str) -> tuple[str, dict] | None:
+        """领取最早的待执行任务，没有任务时返回None"""
+        pass
+
+    @abstractmethod
+    def publish(self, job_id: str, events: list[tuple[int, dict]]) -> None:
+        """按顺序回传任务的一批事件 (编号, 事件)，编号从1开始连续递增"""
+        pass
+
+    @abstractmethod
+    def finish(self, job_id: str, status: str) -> None:
+        """标记任务结束（complete/error）"""
+        pass
+
+    @abstractmethod
+    def subscribe(self, job_id: str) -> None:
+        """记录一个读取事件的订阅者"""
+        pass
+
+    @abstractmethod
+    def unsubscribe(self, job_id: str) -> None:
+        """移除一个订阅者；非detached的任务没有订阅者且尚未结束时请求取消"""
+        pass
+
+    @abstractmethod
+    def cancelled(self, job_ids: list[str]) -> set[str]:
+        """返回其中已被请求取消的任务"""
+        pass
+
+    @abstractmethod
+    def heartbeat(self, worker_id: str) -> None:
+        """刷新工作进程及其运行中任务的心跳"""
+        pass
+
+    @abstractmethod
+    def events(self, job_id: str, after: int) -> list[tuple[int, dict]]:
+        """返回编号大于after的事件"""
+        pass
+
+    @abstractmethod
+    def status(self, job_id: str) -> dict | None:
+        """返回任务状态，任务不存在或已过期时返回None"""
+        pass
+
+    @abstractmethod
+    def cleanup(self, ttl: float) -> None:
+        """删除结束超过ttl秒的任务，并将心跳超时的运行中任务标记为失败"""
+        pass
+
+    @abstractmethod
+    def stats(self) -> dict:
+        pass
+
+    async def call(self, method: Callable[..., T], *args) -> T:
+        """
+        在事件循环中调用队列的方法，例如 await broker.call(broker.status, job_id)
+
+        内存中的实现直接调用；会阻塞的实现（sqlite）覆盖该方法，在线程池中执行。
+        """
+        return method(*args)
+
+
+class InProcessBroker(JobBroker):
+    """进程内队列，任务和事件保存在内存中"""
+
+    def __init__(self):
+        self.jobs: dict[str, dict] = {}
+        self.job_events: dict[str, list[dict]] = {}
+        self.workers: dict[str, float] = {}
+
+    def enqueue(self, job_id: str, payload: dict, detached: bool = True) -> None:
+        self.jobs[job_id] = {
+            "payload": payload,
+            "status": "queued",
+            "worker": None,
+            "created_at": time.time(),
+            "finished_at": None,
+            "detached": detached,
+            "subscribers": 0,
+            "cancel_requested": False,
+        }
+        self.job_events[job_id] = []
+
+    def claim(self, worker_id: str) -> tuple[str, dict] | None:
+        for job_id, job in self.jobs.items():
+            if job["status"] == "queued":
+                job.update(status="running", worker=worker_id)
+                return job_id, job["payload"]
+        return None
+
+    def publish(self, job_id: str, events: list[tuple[int, dict]]) -> None:
+        published = self.job_events.get(job_id)
+        if published is None:
+            return
+        for seq, event in events:
+            if seq == len(published) + 1:
+                published.append(event)
+
+    def finish(self, job_id: str, status: str) -> None:
+        if job_id in self.jobs:
+            self.jobs[job_id].update(status=status, finished_at=time.time())
+
+    def subscribe(self, job_id: str) -> None:
+        if job_id in self.jobs:
+            self.jobs[job_id]["subscribers"] += 1
+
+    def unsubscribe(self, job_id: str) -> None:
+        job = self.jobs.get(job_id)
+        if job is None:
+            return
+        job["subscribers"] -= 1
+        if not job["subscribers"] and not job["detached"] and job["finished_at"] is None:
+            job["cancel_requested"] = True
+            if job["status"] == "queued":
+                # 尚未被领取：直接结束
+                job.update(status="cancelled", finished_at=time.time())
+
+    def cancelled(self, job_ids: list[str]) -> set[str]:
+        return {job_id for job_id in job_ids if self.jobs.get(job_id, {}).get("cancel_requested")}
+
+    def heartbeat(self, worker_id: str) -> None:
+        self.workers[worker_id] = time.time()
+
+    def events(self, job_id: str, after: int) -> list[tuple[int, dict]]:
+        events = self.job_events.get(job_id, [])
+        return [(seq, events[seq - 1]) for seq in range(max(after, 0) + 1, len(events) + 1)]
+
+    def status(self, job_id: str) -> dict | None:
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        return {
+            "job_id": job_id,
+            "status": job["status"],
+            "events": len(self.job_events[job_id]),
+            "worker": job["worker"],
+            "created_at": job["created_at"],
+            "finished_at": job["finished_at"],
+        }
+
+    def cleanup(self, ttl: float) -> None:
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job["finished_at"] is not None and now - job["finished_at"] > ttl:
+                del self.jobs[job_id]
+                del self.job_events[job_id]
+
+    def stats(self) -> dict:
+        counts: dict[str, int] = {}
+        for job in self.jobs.values():
+            counts[job["status"]] = counts.get(job["status"], 0) + 1
+        return {"broker": "inprocess", "jobs": counts, "workers": len(self.workers)}
+
+
+class SqliteBroker(JobBroker):
+    """
+    基于sqlite的任务队列，同一台机器（或共享卷）上的多个API进程和工作进程共用
+
+    事件按批写入generation_events表（任务行上记录事件数），由API进程轮询后转发给SSE客户端。
+    所有读写都在专用的线程池中执行（见call），每个线程使用自己的连接。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(JOB_BROKER_THREADS, thread_name_prefix="job-broker")
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS generation_jobs ("
+                "id TEXT PRIMARY KEY, "
+                "payload TEXT NOT NULL, "
+                "status TEXT NOT NULL, "
+                "worker TEXT, "
+                "detached INTEGER NOT NULL DEFAULT 1, "
+                "subscribers INTEGER NOT NULL DEFAULT 0, "
+                "cancel_requested INTEGER NOT NULL DEFAULT 0, "
+                "event_count INTEGER NOT NULL DEFAULT 0, "
+                "created_at REAL NOT NULL, "
+                "finished_at REAL)"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(generation_jobs)")}
+            if "event_count" not in columns:
+                # 旧版本创建的数据库：补充事件数列
+                conn.execute(
+                    "ALTER TABLE generation_jobs ADD COLUMN event_count INTEGER NOT NULL DEFAULT 0"
+                )
+                conn.execute(
+                    "UPDATE generation_jobs SET event_count = "
+                    "(SELECT COUNT(*) FROM generation_events e WHERE e.job_id = generation_jobs.id)"
+                )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_generation_jobs_status "
+                "ON generation_jobs (status, created_at)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS generation_events ("
+                "job_id TEXT NOT NULL, "
+                "seq INTEGER NOT NULL, "
+                "event TEXT NOT NULL, "
+                "PRIMARY KEY (job_id, seq))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS generation_workers ("
+                "id TEXT PRIMARY KEY, "
+                "heartbeat_at REAL NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=JOB_BROKER_DB_TIMEOUT, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    async def call(self, method: Callable[..., T], *args) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(method, *args))
+
+    def enqueue(self, job_id: str, payload: dict, detached: bool = True) -> None:
+        self._connect().execute(
+            "INSERT INTO generation_jobs (id, payload, status, detached, created_at) "
+            "VALUES (?, ?, 'queued', ?, ?)",
+            (job_id, json.dumps(payload), int(detached), time.time()),
+        )
+
+    def claim(self, worker_id: str) -> tuple[str, dict] | None:
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT id, payload FROM generation_jobs WHERE status = 'queued' "
+                "ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE generation_jobs SET status = 'running', worker = ? WHERE id = ?",
+                    (worker_id, row[0]),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return (row[0], json.loads(row[1])) if row is not None else None
+
+    def publish(self, job_id: str, events: list[tuple[int, dict]]) -> None:
+        if not events:
+            return
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT OR IGNORE INTO generation_events (job_id, seq, event) VALUES (?, ?, ?)",
+                [(job_id, seq, json.dumps(event)) for seq, event in events],
+            )
+            conn.execute(
+                "UPDATE generation_jobs SET event_count = MAX(event_count, ?) WHERE id = ?",
+                (events[-1][0], job_id),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def finish(self, job_id: str, status: str) -> None:
+        self._connect().execute(
+            "UPDATE generation_jobs SET status = ?, finished_at = ? WHERE id = ?",
+            (status, time.time(), job_id),
+        )
+
+    def subscribe(self, job_id: str) -> None:
+        self._connect().execute(
+            "UPDATE generation_jobs SET subscribers = subscribers + 1 WHERE id = ?", (job_id,)
+        )
+
+    def unsubscribe(self, job_id: str) -> None:
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "UPDATE generation_jobs SET subscribers = subscribers - 1 WHERE id = ?", (job_id,)
+            )
+            conn.execute(
+                "UPDATE generation_jobs SET cancel_requested = 1 "
+                "WHERE id = ? AND subscribers <= 0 AND detached = 0 AND finished_at IS NULL",
+                (job_id,),
+            )
+            # 尚未被领取的任务直接结束
+            conn.execute(
+                "UPDATE generation_jobs SET status = 'cancelled', finished_at = ? "
+                "WHERE id = ? AND cancel_requested = 1 AND status = 'queued'",
+                (time.time(), job_id),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def cancelled(self, job_ids: list[str]) -> set[str]:
+        if not job_ids:
+            return set()
+        rows = self._connect().execute(
+            f"SELECT id FROM generation_jobs WHERE cancel_requested = 1 "
+            f"AND id IN ({','.join('?' * len(job_ids))})",
+            job_ids,
+        ).fetchall()
+        return {row[0] for row in rows}
+
+    def heartbeat(self, worker_id: str) -> None:
+        self._connect().execute(
+            "INSERT OR REPLACE INTO generation_workers (id, heartbeat_at) VALUES (?, ?)",
+            (worker_id, time.time()),
+        )
+
+    def events(self, job_id: str, after: int) -> list[tuple[int, dict]]:
+        rows = self._connect().execute(
+            "SELECT seq, event FROM generation_events WHERE job_id = ? AND seq > ? ORDER BY seq",
+            (job_id, after),
+        ).fetchall()
+        return [(seq, json.loads(event)) for seq, event in rows]
+
+    def status(self, job_id: str) -> dict | None:
+        row = self._connect().execute(
+            "SELECT status, event_count, worker, created_at, finished_at FROM generation_jobs WHERE id = ?",
+            (job_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "job_id": job_id,
+            "status": row[0],
+            "events": row[1],
+            "worker": row[2],
+            "created_at": row[3],
+            "finished_at": row[4],
+        }
+
+    def cleanup(self, ttl: float) -> None:
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # 心跳超时的工作进程上运行中的任务：追加错误事件并标记失败
+            lost = conn.execute(
+                "SELECT j.id FROM generation_jobs j LEFT JOIN generation_workers w ON w.id = j.worker "
+                "WHERE j.status = 'running' AND COALESCE(w.heartbeat_at, 0) < ?",
+                (now - WORKER_STALE_SECONDS,),
+            ).fetchall()
+            for (job_id,) in lost:
+                (last_seq,) = conn.execute(
+                    "SELECT event_count FROM generation_jobs WHERE id = ?", (job_id,)
+                ).fetchone()
+                conn.execute(
+                    "INSERT INTO generation_events (job_id, seq, event) VALUES (?, ?, ?)",
+                    (job_id, last_seq + 1, json.dumps({"error": WORKER_LOST_MESSAGE})),
+                )
+                conn.execute(
+                    "UPDATE generation_jobs SET status = 'error', event_count = ?, finished_at = ? "
+                    "WHERE id = ?",
+                    (last_seq + 1, now, job_id),
+                )
+            expired = conn.execute(
+                "SELECT id FROM generation_jobs WHERE finished_at IS NOT NULL AND finished_at < ?",
+                (now - ttl,),
+            ).fetchall()
+            for (job_id,) in expired:
+                conn.execute("DELETE FROM generation_events WHERE job_id = ?", (job_id,))
+                conn.execute("DELETE FROM generation_jobs WHERE id = ?", (job_id,))
+            conn.execute(
+                "DELETE FROM generation_workers WHERE heartbeat_at < ?", (now - WORKER_STALE_SECONDS,)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def stats(self) -> dict:
+        conn = self._connect()
+        counts = dict(
+            conn.execute("SELECT status, COUNT(*) FROM generation_jobs GROUP BY status").fetchall()
+        )
+        (workers,) = conn.execute(
+            "SELECT COUNT(*) FROM generation_workers WHERE heartbeat_at >= ?",
+            (time.time() - WORKER_STALE_SECONDS,),
+        ).fetchone()
+        return {"broker": "sqlite", "jobs": counts, "workers": workers}
+
+
+def create_broker(name: str = JOB_BROKER) -> JobBroker | None:
+    """
+    按名称创建任务队列
+
+    Returns:
+        JobBroker | None: 任务队列；local模式（在API进程中直接运行）时为None
+
+    Raises:
+        ValueError: 不支持的队列类型
+    """
+    if name == "local":
+        return None
+    if name == "inprocess":
+        return InProcessBroker()
+    if name == "sqlite":
+        return SqliteBroker(JOB_BROKER_DB)
+    raise ValueError(f"Unsupported job broker: {name}")
@@ -0,0 +1,228 @@
+from dotenv import load_dotenv
+import asyncio
+import os
+import socket
+import uuid
+from app.services.generation_pipeline import ApiRequest, generate_diagram_events
+from app.services.job_broker import JobBroker
+
+load_dotenv()
+
+# 每个工作进程同时运行的生成任务数
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "8"))
+
+# 队列为空时轮询的间隔（秒）
+WORKER_POLL_INTERVAL = float(os.getenv("WORKER_POLL_INTERVAL", "0.5"))
+
+# 心跳间隔（秒），应明显小于WORKER_STALE_SECONDS
+WORKER_HEARTBEAT_SECONDS = float(os.getenv("WORKER_HEARTBEAT_SECONDS", "10"))
+
+# 收到停止信号后等待运行中任务完成的最长秒数，超时的任务以错误结束
+WORKER_DRAIN_SECONDS = float(os.getenv("WORKER_DRAIN_SECONDS", "300"))
+
+# 检查运行中的任务是否被取消（客户端全部断开）的间隔（秒）
+WORKER_CANCEL_POLL_INTERVAL = float(os.getenv("WORKER_CANCEL_POLL_INTERVAL", "0.5"))
+
+# 回传事件的批量间隔（秒）：期间产出的事件在一次写入中回传，相邻的文本片段合并为一个事件
+WORKER_PUBLISH_INTERVAL = float(os.getenv("WORKER_PUBLISH_INTERVAL", "0.1"))
+
+WORKER_DRAIN_MESSAGE = "生成节点正在重启，任务已中断，请重新生成。"
+
+WORKER_CANCELLED_MESSAGE = "客户端已断开，生成已取消。"
+
+
+def _mergeable(last: dict, event: dict) -> bool:
+    """两个事件是否为同一类的文本片段（如两个diagram_chunk）"""
+    return (
+        last.keys() == event.keys() == {"status", "chunk"}
+        and last["status"] == event["status"]
+        and type(last["chunk"]) is str
+        and type(event["chunk"]) is str
+    )
+
+
+class EventPublisher:
+    """
+    将一个任务的事件按顺序回传给队列
+
+    事件先进入待写入列表，由后台任务每WORKER_PUBLISH_INTERVAL秒批量写入一次；
+    待写入的相邻文本片段合并为一个事件，写入成功后才分配编号，因此编号始终连续。
+    """
+
+    def __init__(self, broker: JobBroker, job_id: str):
+        self.broker = broker
+        self.job_id = job_id
+        self.seq = 0
+        self.pending: list[dict] = []
+        self.flushing: asyncio.Task | None = None
+
+    def add(self, event: dict) -> None:
+        if self.pending and _mergeable(self.pending[-1], event):
+            last = self.pending[-1]
+            self.pending[-1] = {**last, "chunk": last["chunk"] + event["chunk"]}
+        else:
+            self.pending.append(event)
+        if self.flushing is None or self.flushing.done():
+            self.flushing = asyncio.create_task(self._flush_loop())
+
+    async def _publish(self) -> None:
+        batch, self.pending = self.pending, []
+        try:
+            await self.broker.call(
+                self.broker.publish,
+                self.job_id,
+                [(self.seq + offset, event) for offset, event in enumerate(batch, 1)],
+            )
+        except BaseException:
+            # 写入失败（如数据库被锁）：放回待写入列表，下次重试
+            self.pending = batch + self.pending
+            raise
+        self.seq += len(batch)
+
+    async def _flush_loop(self) -> None:
+        try:
+            while self.pending:
+                await asyncio.sleep(WORKER_PUBLISH_INTERVAL)
+                await self._publish()
+        except Exception as e:
+            print(f"任务 {self.job_id} 的事件回传失败，将在下一个事件时重试: {e}")
+
+    async def close(self) -> None:
+        """
+        写入剩余的事件
+
+        Raises:
+            Exception: 剩余的事件无法写入
+        """
+        if self.flushing is not None:
+            await self.flushing
+        if self.pending:
+            await self._publish()
+
+
+class GenerationWorker:
+    """
+    从任务队列领取生成任务并运行生成流程，将事件按顺序回传给队列
+
+    drain() 后不再领取新任务，等待运行中的任务完成（最多WORKER_DRAIN_SECONDS秒）。
+    订阅者全部断开的非detached任务会被取消，上游流随之关闭。
+    """
+
+    def __init__(self, broker: JobBroker, concurrency: int = WORKER_CONCURRENCY, worker_id: str | None = None):
+        self.broker = broker
+        self.concurrency = concurrency
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.tasks: set[asyncio.Task] = set()
+        # 运行中的任务: 任务ID -> 协程任务
+        self.running: dict[str, asyncio.Task] = {}
+        # 因客户端断开而被取消的任务ID
+        self.cancelling: set[str] = set()
+        self.draining = False
+        self._wake = asyncio.Event()
+
+    async def run(self) -> None:
+        """领取并运行任务，直到调用drain()且运行中的任务全部结束"""
+        print(f"生成工作器 {self.worker_id} 已启动，并发 {self.concurrency}")
+        heartbeat = asyncio.create_task(self._heartbeat())
+        watcher = asyncio.create_task(self._watch_cancellations())
+        try:
+            while not self.draining:
+                if len(self.tasks) >= self.concurrency:
+                    await self._wait(None)
+                    continue
+                try:
+                    claimed = await self.broker.call(self.broker.claim, self.worker_id)
+                except Exception as e:
+                    print(f"生成工作器 {self.worker_id} 领取任务失败: {e}")
+                    claimed = None
+                if claimed is None:
+                    await self._wait(WORKER_POLL_INTERVAL)
+                    continue
+                job_id, payload = claimed
+                task = asyncio.create_task(self._run_job(job_id, payload))
+                self.tasks.add(task)
+                self.running[job_id] = task
+                task.add_done_callback(self._task_done)
+
+            if self.tasks:
+                print(f"生成工作器 {self.worker_id} 正在排空，等待 {len(self.tasks)} 个任务完成")
+                _, pending = await asyncio.wait(set(self.tasks), timeout=WORKER_DRAIN_SECONDS)
+                for task in pending:
+                    task.cancel()
+                if pending:
+                    await asyncio.gather(*pending, return_exceptions=True)
+        finally:
+            heartbeat.cancel()
+            watcher.cancel()
+            print(f"生成工作器 {self.worker_id} 已停止")
+
+    def drain(self) -> None:
+        """停止领取新任务"""
+        self.draining = True
+        self._wake.set()
+
+    def notify(self) -> None:
+        """有新任务写入队列时唤醒轮询（进程内队列使用）"""
+        self._wake.set()
+
+    def _task_done(self, task: asyncio.Task) -> None:
+        self.tasks.discard(task)
+        self._wake.set()
+
+    async def _wait(self, timeout: float | None) -> None:
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wake.clear()
+
+    async def _heartbeat(self) -> None:
+        while True:
+            try:
+                await self.broker.call(self.broker.heartbeat, self.worker_id)
+            except Exception as e:
+                print(f"生成工作器 {self.worker_id} 心跳失败: {e}")
+            await asyncio.sleep(WORKER_HEARTBEAT_SECONDS)
+
+    async def _watch_cancellations(self) -> None:
+        while True:
+            await asyncio.sleep(WORKER_CANCEL_POLL_INTERVAL)
+            if not self.running:
+                continue
+            try:
+                cancelled = await self.broker.call(self.broker.cancelled, list(self.running))
+            except Exception as e:
+                print(f"生成工作器 {self.worker_id} 检查取消失败: {e}")
+                continue
+            for job_id in cancelled - self.cancelling:
+                if job_id not in self.running:
+                    continue
+                self.cancelling.add(job_id)
+                self.running[job_id].cancel()
+
+    async def _run_job(self, job_id: str, payload: dict) -> None:
+        publisher = EventPublisher(self.broker, job_id)
+        status = "error"
+        try:
+            body = ApiRequest(**payload["body"])
+            async for event in generate_diagram_events(body, payload.get("client_id")):
+                publisher.add(event)
+                if "error" in event:
+                    status = "error"
+                elif event.get("status") == "complete":
+                    status = "complete"
+        except asyncio.CancelledError:
+            if job_id in self.cancelling:
+                status = "cancelled"
+                publisher.add({'error': WORKER_CANCELLED_MESSAGE})
+                return
+            publisher.add({'error': WORKER_DRAIN_MESSAGE})
+            raise
+        except Exception as e:
+            publisher.add({'error': str(e)})
+        finally:
+            self.running.pop(job_id, None)
+            self.cancelling.discard(job_id)
+            # 先写完事件再标记结束，读取方看到结束时已能读到全部事件
+            await publisher.close()
+            await self.broker.call(self.broker.finish, job_id, status)
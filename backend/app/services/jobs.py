@@ -0,0 +1,246 @@
+from dotenv import load_dotenv
+from typing import AsyncGenerator
+import asyncio
+import os
+import secrets
+import time
+from app.services.generation_pipeline import ApiRequest, generate_diagram_events
+from app.services.job_broker import JobBroker, InProcessBroker, create_broker
+from app.services.job_worker import GenerationWorker
+
+load_dotenv()
+
+# 完成（或失败）的任务及其事件保留的秒数，期间可以通过Last-Event-ID恢复事件流
+JOB_TTL_SECONDS = float(os.getenv("JOB_TTL_SECONDS", "900"))
+
+# 由工作进程运行的任务：API进程轮询队列中新事件的间隔（秒）
+JOB_EVENT_POLL_INTERVAL = float(os.getenv("JOB_EVENT_POLL_INTERVAL", "0.2"))
+
+# sqlite任务队列时是否在API进程中内嵌工作器领取任务（多个API进程共享队列，不需要独立的工作进程）
+JOB_EMBEDDED_WORKER = os.getenv("JOB_EMBEDDED_WORKER", "false").lower() == "true"
+
+# 清理过期任务的最小间隔（秒）
+JOB_CLEANUP_INTERVAL = 30.0
+
+
+class GenerationJob:
+    """
+    一次与HTTP连接解耦的生成任务
+
+    生成流程在后台任务中运行，产出的事件按顺序编号（从1开始）保存在缓冲区中，
+    客户端断开后可以从任意已收到的编号之后继续读取。
+    """
+
+    def __init__(self, job_id: str, client_id: str | None):
+        self.id = job_id
+        self.client_id = client_id
+        self.status = "running"
+        self.events: list[dict] = []
+        self.created_at = time.time()
+        self.finished_at: float | None = None
+        self.task: asyncio.Task | None = None
+        self._changed = asyncio.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.status != "running"
+
+    def append(self, event: dict) -> int:
+        """追加一个事件并唤醒等待中的读取者，返回事件编号"""
+        self.events.append(event)
+        if "error" in event:
+            self.status = "error"
+        elif event.get("status") == "complete":
+            self.status = "complete"
+        self._notify()
+        return len(self.events)
+
+    def finish(self) -> None:
+        if self.status == "running":
+            # 流程未产出complete/error事件就结束（如被取消）
+            self.status = "error"
+        self.finished_at = time.time()
+        self._notify()
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def stream(self, last_event_id: int = 0) -> AsyncGenerator[tuple[int, dict], None]:
+        """
+        读取编号大于last_event_id的事件，直到任务结束
+
+        Args:
+            last_event_id: 客户端已收到的最后一个事件编号
+
+        Yields:
+            tuple[int, dict]: (事件编号, 事件)
+        """
+        next_index = max(last_event_id, 0)
+        while True:
+            changed = self._changed
+            while next_index < len(self.events):
+                next_index += 1
+                yield next_index, self.events[next_index - 1]
+            if self.finished_at is not None:
+                return
+            await changed.wait()
+
+    async def result(self) -> dict | None:
+        """任务结束后返回最终事件（完整的complete事件或error事件），未结束时返回None"""
+        if self.finished_at is None or not self.events:
+            return None
+        return self.events[-1]
+
+    async def summary(self) -> dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "events": len(self.events),
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class BrokerJob:
+    """
+    由工作进程运行的生成任务在API进程中的视图，事件从任务队列中轮询转发
+
+    队列的读写经由broker.call执行，sqlite队列不会阻塞事件循环。
+    """
+
+    def __init__(self, broker: JobBroker, job_id: str):
+        self.broker = broker
+        self.id = job_id
+
+    async def stream(self, last_event_id: int = 0) -> AsyncGenerator[tuple[int, dict], None]:
+        """
+        读取编号大于last_event_id的事件，直到任务结束
+
+        Yields:
+            tuple[int, dict]: (事件编号, 事件)
+        """
+        broker = self.broker
+        after = max(last_event_id, 0)
+        await broker.call(broker.subscribe, self.id)
+        try:
+            while True:
+                status = await broker.call(broker.status, self.id)
+                if status is not None and status["events"] > after:
+                    for seq, event in await broker.call(broker.events, self.id, after):
+                        after = seq
+                        yield seq, event
+                if status is None or status["finished_at"] is not None:
+                    # 结束前写入的事件已在上面读完
+                    return
+                await asyncio.sleep(JOB_EVENT_POLL_INTERVAL)
+        finally:
+            # 最后一个订阅者断开时，非detached的任务会被取消
+            await broker.call(broker.unsubscribe, self.id)
+
+    async def result(self) -> dict | None:
+        """任务结束后返回最终事件（完整的complete事件或error事件），未结束时返回None"""
+        status = await self.broker.call(self.broker.status, self.id)
+        if status is None or status["finished_at"] is None or not status["events"]:
+            return None
+        events = await self.broker.call(self.broker.events, self.id, status["events"] - 1)
+        return events[-1][1]
+
+    async def summary(self) -> dict:
+        status = await self.broker.call(self.broker.status, self.id)
+        return status or {"job_id": self.id, "status": "expired"}
+
+
+class JobManager:
+    """
+    保存生成任务并在后台运行生成流程，定期清理超过保留时间的已完成任务
+
+    配置了任务队列（JOB_BROKER）时，任务写入队列由工作器运行，本进程只负责转发事件；
+    进程内队列（以及设置了JOB_EMBEDDED_WORKER的sqlite队列）会在本进程中启动一个内嵌的工作器。
+    """
+
+    def __init__(self, broker: JobBroker | None = None):
+        self.jobs: dict[str, GenerationJob] = {}
+        self.broker = broker
+        self.embedded_worker: GenerationWorker | None = None
+        self.embedded_task: asyncio.Task | None = None
+        self.last_cleanup = 0.0
+
+    async def _cleanup(self) -> None:
+        now = time.time()
+        if self.broker is not None and now - self.last_cleanup > JOB_CLEANUP_INTERVAL:
+            self.last_cleanup = now
+            await self.broker.call(self.broker.cleanup, JOB_TTL_SECONDS)
+        expired = [
+            job_id
+            for job_id, job in self.jobs.items()
+            if job.finished_at is not None and now - job.finished_at > JOB_TTL_SECONDS
+        ]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    async def create(
+        self, body: ApiRequest, client_id: str | None = None, detached: bool = True
+    ) -> GenerationJob | BrokerJob:
+        """
+        创建任务并在后台开始生成（或写入任务队列）
+
+        Args:
+            body: 生成请求
+            client_id: 客户端标识，用于令牌限流和调度
+            detached: 为False时，读取事件的客户端全部断开后取消任务（仅任务队列模式）
+
+        Returns:
+            GenerationJob | BrokerJob: 新创建的任务
+        """
+        await self._cleanup()
+        job_id = secrets.token_urlsafe(16)
+        if self.broker is not None:
+            await self.broker.call(
+                self.broker.enqueue,
+                job_id,
+                {"body": body.model_dump(), "client_id": client_id},
+                detached,
+            )
+            if isinstance(self.broker, InProcessBroker) or JOB_EMBEDDED_WORKER:
+                self._ensure_embedded_worker().notify()
+            return BrokerJob(self.broker, job_id)
+
+        job = GenerationJob(job_id, client_id)
+        self.jobs[job.id] = job
+        job.task = asyncio.create_task(self._run(job, body))
+        return job
+
+    async def _run(self, job: GenerationJob, body: ApiRequest) -> None:
+        try:
+            async for event in generate_diagram_events(body, job.client_id):
+                job.append(event)
+        except Exception as e:
+            job.append({'error': str(e)})
+        finally:
+            job.finish()
+
+    def _ensure_embedded_worker(self) -> GenerationWorker:
+        if self.embedded_worker is None:
+            self.embedded_worker = GenerationWorker(self.broker)  # type: ignore
+            self.embedded_task = asyncio.create_task(self.embedded_worker.run())
+        return self.embedded_worker
+
+    async def get(self, job_id: str) -> GenerationJob | BrokerJob | None:
+        await self._cleanup()
+        if job_id in self.jobs:
+            return self.jobs[job_id]
+        if self.broker is not None and await self.broker.call(self.broker.status, job_id) is not None:
+            return BrokerJob(self.broker, job_id)
+        return None
+
+    async def stats(self) -> dict:
+        await self._cleanup()
+        if self.broker is not None:
+            return await self.broker.call(self.broker.stats)
+        running = sum(1 for job in self.jobs.values() if not job.finished)
+        return {"running": running, "retained": len(self.jobs) - running}
+
+
+# 进程内共享的任务管理器
+job_manager = JobManager(create_broker())
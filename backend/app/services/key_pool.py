@@ -0,0 +1,238 @@
+from datetime import datetime
+from dotenv import load_dotenv
+import os
+import re
+import time
+
+load_dotenv()
+
+# 收到429且响应中没有retry-after时，密钥的冷却秒数
+KEY_COOLDOWN_SECONDS = float(os.getenv("KEY_COOLDOWN_SECONDS", "30"))
+
+# 各提供方的密钥环境变量；复数形式（如OPENAI_API_KEYS）可配置逗号分隔的多个密钥
+KEY_POOL_ENV_VARS = {
+    "openai": "OPENAI_API_KEY",
+    "anthropic": "ANTHROPIC_API_KEY",
+    "deepseek": "DEEPSEEK_API_KEY",
+}
+
+_DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_reset(value: str | None) -> float | None:
+    """
+    解析限流重置时间，返回距现在的秒数
+
+    支持OpenAI的时长格式（"1s"、"6m0s"、"20ms"）、Anthropic的RFC 3339时间戳和纯秒数。
+    """
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    matches = _DURATION_PATTERN.findall(value)
+    if matches and "".join(n + u for n, u in matches) == value:
+        return sum(float(n) * _DURATION_UNITS[u] for n, u in matches)
+    try:
+        reset_at = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        return max(reset_at.timestamp() - time.time(), 0.0)
+    except ValueError:
+        return None
+
+
+def _header_int(headers, *names: str) -> int | None:
+    for name in names:
+        value = headers.get(name)
+        if value is not None:
+            try:
+                return int(float(value))
+            except ValueError:
+                continue
+    return None
+
+
+class ServerKey:
+    """一个服务器密钥的限流快照和负载状态"""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.in_flight = 0
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self.cooldown_until = 0.0
+        self.limit_requests: int | None = None
+        self.remaining_requests: int | None = None
+        self.limit_tokens: int | None = None
+        self.remaining_tokens: int | None = None
+        # 限流快照过期（额度已恢复）的时间
+        self.snapshot_expires = 0.0
+
+    @property
+    def label(self) -> str:
+        """用于展示的脱敏密钥"""
+        return f"...{self.key[-4:]}" if len(self.key) > 8 else "..."
+
+    def headroom(self, now: float) -> float:
+        """剩余额度比例（0~1），取请求数和令牌数中较紧张的一项；快照过期后视为1"""
+        if now >= self.snapshot_expires:
+            return 1.0
+        ratios = [
+            remaining / limit
+            for remaining, limit in (
+                (self.remaining_requests, self.limit_requests),
+                (self.remaining_tokens, self.limit_tokens),
+            )
+            if remaining is not None and limit
+        ]
+        return min(ratios) if ratios else 1.0
+
+    def load(self, now: float) -> float:
+        """负载评分：进行中的请求数按剩余额度放大，越小越空闲"""
+        return (self.in_flight + 1) / max(self.headroom(now), 0.01)
+
+    def stats(self, now: float) -> dict:
+        return {
+            "key": self.label,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "throttled": self.throttled,
+            "errors": self.errors,
+            "utilization": round(1 - self.headroom(now), 3),
+            "remaining_requests": self.remaining_requests,
+            "remaining_tokens": self.remaining_tokens,
+            "cooldown_seconds": round(max(self.cooldown_until - now, 0), 1),
+        }
+
+
+class KeyLease:
+    """
+    一次调用对服务器密钥的占用
+
+    调用方在收到响应后调用 observe() 更新限流状态，结束时调用 release()。
+    """
+
+    def __init__(self, server_key: ServerKey):
+        self.server_key = server_key
+        self.key = server_key.key
+        self.released = False
+
+    def observe(self, status: int, headers) -> None:
+        """
+        根据响应状态码和限流响应头更新密钥状态
+
+        Args:
+            status: HTTP状态码
+            headers: 响应头（大小写不敏感的映射）
+        """
+        server_key = self.server_key
+        now = time.monotonic()
+        limit_requests = _header_int(
+            headers, "x-ratelimit-limit-requests", "anthropic-ratelimit-requests-limit"
+        )
+        remaining_requests = _header_int(
+            headers, "x-ratelimit-remaining-requests", "anthropic-ratelimit-requests-remaining"
+        )
+        limit_tokens = _header_int(
+            headers, "x-ratelimit-limit-tokens", "anthropic-ratelimit-tokens-limit"
+        )
+        remaining_tokens = _header_int(
+            headers, "x-ratelimit-remaining-tokens", "anthropic-ratelimit-tokens-remaining"
+        )
+        if remaining_requests is not None or remaining_tokens is not None:
+            server_key.limit_requests = limit_requests
+            server_key.remaining_requests = remaining_requests
+            server_key.limit_tokens = limit_tokens
+            server_key.remaining_tokens = remaining_tokens
+            resets = [
+                parse_reset(headers.get(name))
+                for name in (
+                    "x-ratelimit-reset-requests",
+                    "x-ratelimit-reset-tokens",
+                    "anthropic-ratelimit-requests-reset",
+                    "anthropic-ratelimit-tokens-reset",
+                )
+            ]
+            resets = [reset for reset in resets if reset is not None]
+            server_key.snapshot_expires = now + (max(resets) if resets else 60.0)
+            if remaining_requests == 0 or remaining_tokens == 0:
+                # 额度耗尽：在重置前不再分配该密钥
+                server_key.cooldown_until = max(server_key.cooldown_until, server_key.snapshot_expires)
+
+        if status == 429:
+            server_key.throttled += 1
+            retry_after = parse_reset(headers.get("retry-after"))
+            server_key.cooldown_until = max(
+                server_key.cooldown_until, now + (retry_after or KEY_COOLDOWN_SECONDS)
+            )
+            print(f"服务器密钥 {server_key.label} 被限流，冷却 {retry_after or KEY_COOLDOWN_SECONDS:.0f} 秒")
+        elif status >= 500:
+            server_key.errors += 1
+
+    def observe_error(self, error: Exception) -> None:
+        """从SDK抛出的异常（如RateLimitError）中提取状态码和响应头"""
+        status = getattr(error, "status_code", None)
+        if status is not None:
+            response = getattr(error, "response", None)
+            self.observe(status, getattr(response, "headers", {}) or {})
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.server_key.in_flight -= 1
+
+
+class KeyPool:
+    """
+    一个提供方的服务器密钥池：按响应头中的剩余RPM/TPM和进行中的请求数选择最空闲的密钥，
+    收到429的密钥在冷却期内不再分配
+    """
+
+    def __init__(self, provider: str, keys: list[str]):
+        self.provider = provider
+        self.keys = [ServerKey(key) for key in keys]
+
+    def default_key(self) -> str | None:
+        """第一个密钥（用于SDK客户端的默认密钥和令牌计数等辅助调用）"""
+        return self.keys[0].key if self.keys else None
+
+    def acquire(self) -> KeyLease | None:
+        """
+        选择负载最低的可用密钥；全部在冷却中时选择最先结束冷却的密钥
+
+        Returns:
+            KeyLease | None: 密钥占用，没有配置任何密钥时为None
+        """
+        if not self.keys:
+            return None
+        now = time.monotonic()
+        available = [key for key in self.keys if key.cooldown_until <= now]
+        if available:
+            server_key = min(available, key=lambda key: key.load(now))
+        else:
+            server_key = min(self.keys, key=lambda key: key.cooldown_until)
+        server_key.in_flight += 1
+        server_key.requests += 1
+        return KeyLease(server_key)
+
+    def stats(self) -> list[dict]:
+        now = time.monotonic()
+        return [key.stats(now) for key in self.keys]
+
+
+def load_keys(env_var: str) -> list[str]:
+    """读取 `<ENV_VAR>S`（逗号分隔）和 `<ENV_VAR>` 中配置的密钥，去重并保持顺序"""
+    keys = [key.strip() for key in os.getenv(env_var + "S", "").split(",")]
+    keys.append((os.getenv(env_var) or "").strip())
+    return list(dict.fromkeys(key for key in keys if key))
+
+
+# 进程内共享的各提供方密钥池
+key_pools = {provider: KeyPool(provider, load_keys(env_var)) for provider, env_var in KEY_POOL_ENV_VARS.items()}
+
+
+def get_key_pool(provider: str) -> KeyPool:
+    return key_pools[provider]
@@ -0,0 +1,238 @@
+from dotenv import load_dotenv
+from pydantic import BaseModel
+from collections import OrderedDict
+from typing import AsyncGenerator, Literal
+import asyncio
+import os
+from app.services.provider_router import ProviderRouter
+from app.services.admission import AdmissionRejected
+from app.services.scheduler import scheduler
+from app.services.generation_pipeline import (
+    DEFAULT_AI_PLATFORM,
+    DEFAULT_AI_MODEL,
+    DEFAULT_REASONING_EFFORT,
+    DIAGRAM_FIX_REPROMPT,
+    DIAGRAM_FIX_MAX_ERRORS,
+    cancellation_stats,
+    content_hash,
+    fix_diagram_errors,
+)
+from app.utils.diagram_patch import PatchError, apply_patch, parse_patch
+from app.utils.mermaid_validator import repair_diagram
+from app.utils.format_message import format_user_message
+from app.utils.prompt_cache import merge_usage
+from app.prompts import SYSTEM_MODIFY_PROMPT, SYSTEM_MODIFY_PATCH_PROMPT
+
+load_dotenv()
+
+# 修改图表使用的AI平台和模型，默认与生成相同
+MODIFY_AI_PLATFORM = os.getenv("MODIFY_AI_PLATFORM", DEFAULT_AI_PLATFORM)
+MODIFY_AI_MODEL = os.getenv("MODIFY_AI_MODEL", DEFAULT_AI_MODEL)
+
+# 修改模式:
+# - patch: 模型只返回编辑操作，在本地应用到原图上；补丁无效时改为完整重写
+# - full: 模型重新输出完整的图表
+# - auto: 原图达到 MODIFY_PATCH_MIN_TOKENS 时使用patch，较小的图表完整重写
+DEFAULT_MODIFY_MODE = os.getenv("DEFAULT_MODIFY_MODE", "auto")
+MODIFY_PATCH_MIN_TOKENS = int(os.getenv("MODIFY_PATCH_MIN_TOKENS", "1000"))
+
+# 一次补丁的估计输出令牌数
+ESTIMATED_PATCH_TOKENS = 1000
+
+# 修改结果缓存，键为 (原图哈希, 指令)
+MODIFY_CACHE_SIZE = int(os.getenv("MODIFY_CACHE_SIZE", "256"))
+_modify_cache: "OrderedDict[tuple[str, str], dict]" = OrderedDict()
+
+# 各修改方式的次数（进程内累计）
+modify_stats = {"patch": 0, "full": 0, "patch_fallbacks": 0, "cache_hits": 0}
+
+# 示例仓库的图表不允许修改
+EXAMPLE_REPOS = ["fastapi", "streamlit", "flask", "api-analytics", "monkeytype"]
+
+
+class ModifyRequest(BaseModel):
+    instructions: str
+    current_diagram: str
+    repo: str
+    username: str
+    explanation: str
+    api_key: str | None = None
+    ai_platform: str | None = None  # AI平台: openai, claude, deepseek
+    ai_model: str | None = None  # AI模型，根据平台不同而不同
+    reasoning_effort: Literal["low", "medium", "high"] | None = None  # 推理努力程度
+    mode: Literal["patch", "full", "auto"] | None = None  # 修改模式
+
+
+def validate_modify_request(body: ModifyRequest) -> str | None:
+    """检查修改请求，返回错误信息；通过时返回None"""
+    # Check instructions length
+    if not body.instructions or not body.current_diagram:
+        return "Instructions and/or current diagram are required"
+    elif (
+        len(body.instructions) > 1000 or len(body.current_diagram) > 100000
+    ):  # just being safe
+        return "Instructions exceed maximum length of 1000 characters"
+
+    if body.repo in EXAMPLE_REPOS:
+        return "Example repos cannot be modified"
+    return None
+
+
+async def modify_diagram_events(
+    body: ModifyRequest, client_id: str | None = None
+) -> AsyncGenerator[dict, None]:
+    """
+    按指令修改图表，依次产出事件（与SSE中 `data:` 的JSON内容一致）
+
+    与生成流程共用调度器（准入控制、免费请求的令牌限流）、提供方路由器（连接池、对冲和故障切换）
+    以及客户端断开时的取消。patch模式下模型只输出编辑操作，输出令牌数与修改的大小而不是图表的
+    大小成正比。相同的原图和指令直接返回缓存的结果。
+
+    Args:
+        body: 修改请求（调用方负责长度、示例仓库等前置校验）
+        client_id: 客户端标识（通常为远程地址），用于免费请求的限流
+
+    Yields:
+        dict: 排队事件、状态事件、diagram_chunk片段事件、最终的complete事件或error事件。
+            因令牌预算或排队被拒绝时，error事件带有 `rejected: True`
+    """
+    ai_platform = body.ai_platform or MODIFY_AI_PLATFORM
+    ai_model = body.ai_model or MODIFY_AI_MODEL
+    reasoning_effort = body.reasoning_effort or DEFAULT_REASONING_EFFORT
+    ticket = None
+    ai_service = None
+
+    cache_key = (content_hash(body.current_diagram), body.instructions.strip())
+    cached = _modify_cache.get(cache_key)
+    if cached is not None:
+        _modify_cache.move_to_end(cache_key)
+        modify_stats["cache_hits"] += 1
+        yield {'status': 'diagram_chunk', 'chunk': cached["diagram"]}
+        yield {'status': 'complete', **cached, 'cached': True, 'usage': merge_usage([]), 'routes': []}
+        return
+
+    data = {
+        "instructions": body.instructions,
+        "explanation": body.explanation,
+        "diagram": body.current_diagram,
+    }
+
+    try:
+        ai_service = ProviderRouter(ai_platform, ai_model, body.api_key)
+
+        diagram_tokens = ai_service.count_tokens(body.current_diagram)
+        mode = body.mode or DEFAULT_MODIFY_MODE
+        if mode == "auto":
+            mode = "patch" if diagram_tokens >= MODIFY_PATCH_MIN_TOKENS else "full"
+
+        # 预估令牌数：输入 + 补丁或与原图相当的输出
+        estimated_tokens = ai_service.count_tokens(
+            SYSTEM_MODIFY_PROMPT + format_user_message(data)
+        ) + (ESTIMATED_PATCH_TOKENS if mode == "patch" else diagram_tokens)
+        try:
+            ticket = scheduler.request(
+                client_id, ai_platform, ai_model, estimated_tokens, body.api_key
+            )
+            async for event in ticket.wait():
+                yield event
+        except AdmissionRejected as e:
+            yield {'error': f'{ai_platform} ({ai_model}): {e}', 'rejected': True}
+            return
+
+        result = {'ai_platform': ai_platform, 'ai_model': ai_model}
+        if mode == "patch":
+            yield {'status': 'patch', 'message': f'使用 {ai_platform} ({ai_model}) 生成编辑操作...'}
+            response = ""
+            async for chunk in ai_service.call_api_stream(
+                system_prompt=SYSTEM_MODIFY_PATCH_PROMPT,
+                data=data,
+                api_key=body.api_key,
+                reasoning_effort=reasoning_effort,
+            ):
+                response += chunk
+            if "BAD_INSTRUCTIONS" in response:
+                yield {'error': 'Invalid or unclear instructions provided'}
+                return
+            try:
+                if "FULL_REWRITE" in response:
+                    raise PatchError("需要重写大部分图表")
+                operations = parse_patch(response)
+                mermaid_code = apply_patch(body.current_diagram, operations)
+            except PatchError as e:
+                # 补丁无效时完整重写，不返回可能不正确的图表
+                modify_stats["patch_fallbacks"] += 1
+                print(f"补丁无法应用，改为完整重写 {body.username}/{body.repo}: {e}")
+                yield {'status': 'patch_failed', 'message': f'编辑操作无法应用（{e}），改为重写图表...'}
+                mode = "full"
+            else:
+                result['operations'] = len(operations)
+                yield {'status': 'diagram_chunk', 'chunk': mermaid_code}
+
+        if mode == "full":
+            yield {'status': 'diagram', 'message': f'使用 {ai_platform} ({ai_model}) 修改图表...'}
+            mermaid_code = ""
+            async for chunk in ai_service.call_api_stream(
+                system_prompt=SYSTEM_MODIFY_PROMPT,
+                data=data,
+                api_key=body.api_key,
+                reasoning_effort=reasoning_effort,
+            ):
+                mermaid_code += chunk
+                yield {'status': 'diagram_chunk', 'chunk': chunk}
+
+            mermaid_code = mermaid_code.replace("```mermaid", "").replace("```", "").strip()
+            if "BAD_INSTRUCTIONS" in mermaid_code:
+                yield {'error': 'Invalid or unclear instructions provided'}
+                return
+
+        # 与生成相同的本地校验和修复，无法修复的行单独请求修正
+        validation = repair_diagram(mermaid_code)
+        mermaid_code = validation["diagram"]
+        if validation["repairs"]:
+            yield {
+                'status': 'diagram_repaired',
+                'message': f'已自动修复图表中的 {len(validation["repairs"])} 处语法问题',
+                'repairs': validation["repairs"],
+            }
+        if validation["errors"] and DIAGRAM_FIX_REPROMPT and len(validation["errors"]) <= DIAGRAM_FIX_MAX_ERRORS:
+            yield {'status': 'diagram_fix', 'message': f'图表有 {len(validation["errors"])} 行语法错误，请求修正...'}
+            validation = await fix_diagram_errors(
+                ai_service, mermaid_code, validation["errors"], body.api_key, reasoning_effort
+            )
+            mermaid_code = validation["diagram"]
+
+        modify_stats[mode] += 1
+        result = {'diagram': mermaid_code, 'mode': mode, **result}
+        if not validation["errors"]:
+            # 仍有语法错误的结果不缓存，下次相同的请求重新生成
+            _modify_cache[cache_key] = result
+            if len(_modify_cache) > MODIFY_CACHE_SIZE:
+                _modify_cache.popitem(last=False)
+
+        yield {
+            'status': 'complete',
+            **result,
+            'usage': merge_usage(ai_service.usage_records),
+            'routes': ai_service.route_records,
+        }
+
+    except (GeneratorExit, asyncio.CancelledError):
+        # 客户端断开：上游流随取消一起中止
+        if ticket is not None and ticket.started_at is not None:
+            spent = merge_usage(ai_service.usage_records)  # type: ignore
+            saved = max(estimated_tokens - spent["input_tokens"] - spent["output_tokens"], 0)
+            cancellation_stats["cancelled"] += 1
+            cancellation_stats["saved_tokens"] += saved
+            print(f"客户端已断开，取消修改 {body.username}/{body.repo}，节省约 {saved} 令牌")
+        raise
+    except Exception as e:
+        yield {'error': str(e)}
+    finally:
+        if ticket is not None:
+            # 用实际用量替换预估的令牌消耗
+            usage = merge_usage(ai_service.usage_records) if ai_service is not None else None
+            ticket.release(
+                usage["input_tokens"] + usage["output_tokens"]
+                if usage and usage["calls"]
+                else None
+            )
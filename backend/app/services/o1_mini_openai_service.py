@@ -1,5 +1,6 @@
 from openai import OpenAI
 from dotenv import load_dotenv
+from app.services.key_pool import get_key_pool
 from app.utils.format_message import format_user_message
 import tiktoken
 import os
@@ -12,8 +13,9 @@ load_dotenv()
 
 class OpenAIO1Service:
     def __init__(self):
+        self.key_pool = get_key_pool("openai")
         self.default_client = OpenAI(
-            api_key=os.getenv("OPENAI_API_KEY"),
+            api_key=self.key_pool.default_key(),
         )
         self.encoding = tiktoken.get_encoding("o200k_base")  # Encoder for OpenAI models
         self.base_url = "https://api.openai.com/v1/chat/completions"
@@ -38,8 +40,12 @@ class OpenAIO1Service:
         # Create the user message with the data
         user_message = format_user_message(data)
 
-        # Use custom client if API key provided, otherwise use default
-        client = OpenAI(api_key=api_key) if api_key else self.default_client
+        # Use custom client if API key provided, otherwise the least-loaded server key
+        lease = None if api_key else self.key_pool.acquire()
+        if api_key or lease:
+            client = OpenAI(api_key=api_key or lease.key)  # type: ignore
+        else:
+            client = self.default_client
 
         try:
             print(
@@ -65,7 +71,12 @@ class OpenAIO1Service:
 
         except Exception as e:
             print(f"Error in OpenAI o1-mini API call: {str(e)}")
+            if lease:
+                lease.observe_error(e)
             raise
+        finally:
+            if lease:
+                lease.release()
 
     async def call_o1_api_stream(
         self,
@@ -87,9 +98,11 @@ class OpenAIO1Service:
         # Create the user message with the data
         user_message = format_user_message(data)
 
+        # Use the least-loaded server key unless a custom key is provided
+        lease = None if api_key else self.key_pool.acquire()
         headers = {
             "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key or self.default_client.api_key}",
+            "Authorization": f"Bearer {api_key or (lease.key if lease else self.default_client.api_key)}",
         }
 
         payload = {
@@ -116,6 +129,8 @@ class OpenAIO1Service:
                 async with session.post(
                     self.base_url, headers=headers, json=payload
                 ) as response:
+                    if lease:
+                        lease.observe(response.status, response.headers)
 
                     if response.status != 200:
                         error_text = await response.text()
@@ -157,6 +172,9 @@ class OpenAIO1Service:
         except Exception as e:
             print(f"Unexpected error in streaming API call: {str(e)}")
             raise
+        finally:
+            if lease:
+                lease.release()
 
     def count_tokens(self, prompt: str) -> int:
         """
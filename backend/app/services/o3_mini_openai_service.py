@@ -1,7 +1,8 @@
 from openai import OpenAI
 from dotenv import load_dotenv
-from app.utils.format_message import format_user_message
+from app.utils.prompt_cache import build_chat_messages
 from app.services.ai_service_base import AIServiceBase
+from app.services.key_pool import get_key_pool
 import tiktoken
 import os
 import aiohttp
@@ -13,11 +14,16 @@ load_dotenv()
 
 class OpenAIo3Service(AIServiceBase):
     def __init__(self):
+        self.key_pool = get_key_pool("openai")
         self.default_client = OpenAI(
-            api_key=os.getenv("OPENAI_API_KEY"),
+            api_key=self.key_pool.default_key(),
         )
         self.encoding = tiktoken.get_encoding("o200k_base")  # Encoder for OpenAI models
-        self.base_url = "https://api.openai.com/v1/chat/completions"
+        # 与OpenAI SDK一致，可通过OPENAI_BASE_URL指向代理或本地模拟服务
+        self.base_url = (
+            os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
+            + "/chat/completions"
+        )
 
     def call_api(
         self,
@@ -38,11 +44,12 @@ class OpenAIo3Service(AIServiceBase):
         Returns:
             str: o3-mini's response text
         """
-        # Create the user message with the data
-        user_message = format_user_message(data)
-
-        # Use custom client if API key provided, otherwise use default
-        client = OpenAI(api_key=api_key) if api_key else self.default_client
+        # Use custom client if API key provided, otherwise the least-loaded server key
+        lease = None if api_key else self.key_pool.acquire()
+        if api_key or lease:
+            client = OpenAI(api_key=api_key or lease.key)  # type: ignore
+        else:
+            client = self.default_client
 
         try:
             print(
@@ -51,10 +58,7 @@ class OpenAIo3Service(AIServiceBase):
 
             completion = client.chat.completions.create(
                 model="o3-mini",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_message},
-                ],
+                messages=build_chat_messages(system_prompt, data),  # type: ignore
                 max_completion_tokens=12000,  # Adjust as needed
                 temperature=0.2,
                 reasoning_effort=reasoning_effort,
@@ -62,6 +66,9 @@ class OpenAIo3Service(AIServiceBase):
 
             print("API call completed successfully")
 
+            if completion.usage:
+                self.record_usage(completion.usage.model_dump())
+
             if completion.choices[0].message.content is None:
                 raise ValueError("No content returned from OpenAI o3-mini")
 
@@ -69,7 +76,12 @@ class OpenAIo3Service(AIServiceBase):
 
         except Exception as e:
             print(f"Error in OpenAI o3-mini API call: {str(e)}")
+            if lease:
+                lease.observe_error(e)
             raise
+        finally:
+            if lease:
+                lease.release()
 
     async def call_api_stream(
         self,
@@ -90,22 +102,19 @@ class OpenAIo3Service(AIServiceBase):
         Yields:
             str: Chunks of o3-mini's response text
         """
-        # Create the user message with the data
-        user_message = format_user_message(data)
-
+        # Use the least-loaded server key unless a custom key is provided
+        lease = None if api_key else self.key_pool.acquire()
         headers = {
             "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key or self.default_client.api_key}",
+            "Authorization": f"Bearer {api_key or (lease.key if lease else self.default_client.api_key)}",
         }
 
         payload = {
             "model": "o3-mini",
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_message},
-            ],
+            "messages": build_chat_messages(system_prompt, data),
             "max_completion_tokens": 12000,
             "stream": True,
+            "stream_options": {"include_usage": True},
             "reasoning_effort": reasoning_effort,
         }
 
@@ -114,6 +123,8 @@ class OpenAIo3Service(AIServiceBase):
                 async with session.post(
                     self.base_url, headers=headers, json=payload
                 ) as response:
+                    if lease:
+                        lease.observe(response.status, response.headers)
 
                     if response.status != 200:
                         error_text = await response.text()
@@ -135,8 +146,11 @@ class OpenAIo3Service(AIServiceBase):
                                 break
                             try:
                                 data = json.loads(line[6:])
+                                # include_usage时最后一个片段的choices为空，只携带usage
+                                if data.get("usage"):
+                                    self.record_usage(data["usage"])
                                 content = (
-                                    data.get("choices", [{}])[0]
+                                    (data.get("choices") or [{}])[0]
                                     .get("delta", {})
                                     .get("content")
                                 )
@@ -155,6 +169,9 @@ class OpenAIo3Service(AIServiceBase):
         except Exception as e:
             print(f"Unexpected error in streaming API call: {str(e)}")
             raise
+        finally:
+            if lease:
+                lease.release()
 
     def count_tokens(self, prompt: str) -> int:
         """
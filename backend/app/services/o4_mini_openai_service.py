@@ -1,6 +1,8 @@
 from openai import OpenAI
 from dotenv import load_dotenv
-from app.utils.format_message import format_user_message
+from app.utils.prompt_cache import build_chat_messages
+from app.services.ai_service_base import AIServiceBase
+from app.services.key_pool import get_key_pool
 import tiktoken
 import os
 import aiohttp
@@ -10,15 +12,20 @@ from typing import AsyncGenerator, Literal
 load_dotenv()
 
 
-class OpenAIo4Service:
+class OpenAIo4Service(AIServiceBase):
     def __init__(self):
+        self.key_pool = get_key_pool("openai")
         self.default_client = OpenAI(
-            api_key=os.getenv("OPENAI_API_KEY"),
+            api_key=self.key_pool.default_key(),
         )
         self.encoding = tiktoken.get_encoding("o200k_base")  # Encoder for OpenAI models
-        self.base_url = "https://api.openai.com/v1/chat/completions"
+        # 与OpenAI SDK一致，可通过OPENAI_BASE_URL指向代理或本地模拟服务
+        self.base_url = (
+            os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
+            + "/chat/completions"
+        )
 
-    def call_o4_api(
+    def call_api(
         self,
         system_prompt: str,
         data: dict,
@@ -36,11 +43,12 @@ class OpenAIo4Service:
         Returns:
             str: o4-mini's response text
         """
-        # Create the user message with the data
-        user_message = format_user_message(data)
-
-        # Use custom client if API key provided, otherwise use default
-        client = OpenAI(api_key=api_key) if api_key else self.default_client
+        # Use custom client if API key provided, otherwise the least-loaded server key
+        lease = None if api_key else self.key_pool.acquire()
+        if api_key or lease:
+            client = OpenAI(api_key=api_key or lease.key)  # type: ignore
+        else:
+            client = self.default_client
 
         try:
             print(
@@ -49,10 +57,7 @@ class OpenAIo4Service:
 
             completion = client.chat.completions.create(
                 model="o4-mini",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_message},
-                ],
+                messages=build_chat_messages(system_prompt, data),  # type: ignore
                 max_completion_tokens=12000,  # Adjust as needed
                 temperature=0.2,
                 reasoning_effort=reasoning_effort,
@@ -60,6 +65,9 @@ class OpenAIo4Service:
 
             print("API call completed successfully")
 
+            if completion.usage:
+                self.record_usage(completion.usage.model_dump())
+
             if completion.choices[0].message.content is None:
                 raise ValueError("No content returned from OpenAI o4-mini")
 
@@ -67,9 +75,14 @@ class OpenAIo4Service:
 
         except Exception as e:
             print(f"Error in OpenAI o4-mini API call: {str(e)}")
+            if lease:
+                lease.observe_error(e)
             raise
+        finally:
+            if lease:
+                lease.release()
 
-    async def call_o4_api_stream(
+    async def call_api_stream(
         self,
         system_prompt: str,
         data: dict,
@@ -87,12 +100,11 @@ class OpenAIo4Service:
         Yields:
             str: Chunks of o4-mini's response text
         """
-        # Create the user message with the data
-        user_message = format_user_message(data)
-
+        # Use the least-loaded server key unless a custom key is provided
+        lease = None if api_key else self.key_pool.acquire()
         headers = {
             "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key or self.default_client.api_key}",
+            "Authorization": f"Bearer {api_key or (lease.key if lease else self.default_client.api_key)}",
         }
 
         # payload = {
@@ -116,12 +128,10 @@ class OpenAIo4Service:
 
         payload = {
             "model": "o4-mini",
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_message},
-            ],
+            "messages": build_chat_messages(system_prompt, data),
             "max_completion_tokens": 12000,
             "stream": True,
+            "stream_options": {"include_usage": True},
             "reasoning_effort": reasoning_effort,
         }
 
@@ -130,6 +140,8 @@ class OpenAIo4Service:
                 async with session.post(
                     self.base_url, headers=headers, json=payload
                 ) as response:
+                    if lease:
+                        lease.observe(response.status, response.headers)
 
                     if response.status != 200:
                         error_text = await response.text()
@@ -151,8 +163,11 @@ class OpenAIo4Service:
                                 break
                             try:
                                 data = json.loads(line[6:])
+                                # include_usage时最后一个片段的choices为空，只携带usage
+                                if data.get("usage"):
+                                    self.record_usage(data["usage"])
                                 content = (
-                                    data.get("choices", [{}])[0]
+                                    (data.get("choices") or [{}])[0]
                                     .get("delta", {})
                                     .get("content")
                                 )
@@ -171,6 +186,9 @@ class OpenAIo4Service:
         except Exception as e:
             print(f"Unexpected error in streaming API call: {str(e)}")
             raise
+        finally:
+            if lease:
+                lease.release()
 
     def count_tokens(self, prompt: str) -> int:
         """
@@ -0,0 +1,393 @@
+from collections import deque
+from dotenv import load_dotenv
+from typing import AsyncGenerator, AsyncIterator, Literal
+import asyncio
+import os
+import time
+from app.services.ai_service_base import AIServiceBase
+from app.services.ai_factory import AIServiceFactory
+from app.services.circuit_breaker import ai_breakers
+from app.prompts import RESUME_PARTIAL_OUTPUT_PROMPT
+
+load_dotenv()
+
+# 备用AI平台/模型，格式: "claude:claude-3-5-sonnet,deepseek:deepseek-chat"
+# 用于对冲请求和流中断后的重试；为空时只在主平台上重试
+PROVIDER_FALLBACKS = os.getenv("PROVIDER_FALLBACKS", "")
+
+# 首个令牌超过 TTFT 历史分位数时发起对冲请求
+HEDGE_TTFT_PERCENTILE = float(os.getenv("HEDGE_TTFT_PERCENTILE", "0.9"))
+# 样本不足时使用的对冲等待时间（秒），以及等待时间的上下限
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "15"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "2"))
+HEDGE_MAX_DELAY = float(os.getenv("HEDGE_MAX_DELAY", "60"))
+HEDGE_MIN_SAMPLES = 10
+
+# 流中途出错时的最大重试次数（重试会携带已生成的部分输出继续生成）
+MAX_STREAM_RETRIES = int(os.getenv("MAX_STREAM_RETRIES", "1"))
+
+# 续写时模型可能重复部分输出的结尾，检测重叠所需的最小长度和缓冲长度
+MIN_RESUME_OVERLAP = 16
+RESUME_OVERLAP_WINDOW = 400
+
+
+def parse_fallbacks(value: str) -> list[tuple[str, str]]:
+    """解析 "platform:model,platform:model" 形式的备用平台列表"""
+    fallbacks = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        platform, _, model = item.partition(":")
+        fallbacks.append((platform.strip().lower(), model.strip()))
+    return fallbacks
+
+
+class TTFTTracker:
+    """
+    按 (平台, 模型, 推理努力程度) 记录最近的首令牌时间（TTFT），用于计算对冲等待时间
+    """
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self.samples: dict[tuple[str, str, str], deque] = {}
+
+    def record(self, key: tuple[str, str, str], seconds: float) -> None:
+        self.samples.setdefault(key, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, key: tuple[str, str, str], q: float) -> float | None:
+        samples = self.samples.get(key)
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+    def hedge_delay(self, key: tuple[str, str, str]) -> float:
+        """
+        返回发起对冲请求前的等待时间（秒）
+
+        样本数不少于HEDGE_MIN_SAMPLES时使用TTFT的HEDGE_TTFT_PERCENTILE分位数，
+        否则使用HEDGE_DEFAULT_DELAY，结果限制在[HEDGE_MIN_DELAY, HEDGE_MAX_DELAY]内。
+        """
+        samples = self.samples.get(key)
+        if samples is None or len(samples) < HEDGE_MIN_SAMPLES:
+            delay = HEDGE_DEFAULT_DELAY
+        else:
+            delay = self.percentile(key, HEDGE_TTFT_PERCENTILE) or HEDGE_DEFAULT_DELAY
+        return min(max(delay, HEDGE_MIN_DELAY), HEDGE_MAX_DELAY)
+
+    def stats(self) -> dict[str, dict]:
+        """返回各平台/模型的TTFT统计（p50/p90及样本数）"""
+        return {
+            "/".join(key): {
+                "samples": len(samples),
+                "p50": round(self.percentile(key, 0.5) or 0.0, 3),
+                "p90": round(self.percentile(key, 0.9) or 0.0, 3),
+            }
+            for key, samples in self.samples.items()
+        }
+
+
+# 进程内共享的TTFT统计
+ttft_tracker = TTFTTracker()
+
+
+def strip_resume_overlap(partial: str, head: str) -> str:
+    """
+    去除续写开头与部分输出结尾重复的文本
+
+    Args:
+        partial: 中断前已输出的文本
+        head: 续写流开头缓冲的文本
+
+    Returns:
+        str: 去除重复前缀后的续写文本
+    """
+    for length in range(min(len(head), len(partial)), MIN_RESUME_OVERLAP - 1, -1):
+        if partial.endswith(head[:length]):
+            return head[length:]
+    return head
+
+
+class ProviderRouter(AIServiceBase):
+    """
+    在AIServiceFactory之上路由请求的AI服务
+
+    - 跟踪每个平台/模型的首令牌时间，首令牌超过分位数截止时间时向备用平台发起对冲请求，
+      保留先产出首个片段的流并取消另一个
+    - 流中途出错时切换到下一个候选平台重试，并携带已输出的部分内容续写
+    - 每个平台/模型的调用都经过熔断器，熔断中的候选被跳过，由备用平台接替
+    """
+
+    def __init__(
+        self,
+        platform: str,
+        model: str,
+        api_key: str | None = None,
+        fallbacks: list[tuple[str, str]] | None = None,
+    ):
+        """
+        Args:
+            platform: 主AI平台
+            model: 主模型
+            api_key: 用户提供的API密钥；提供时只使用同一平台的备用模型
+            fallbacks: 备用 (平台, 模型) 列表，默认读取PROVIDER_FALLBACKS
+        """
+        self.platform = platform.lower()
+        self.model = model
+        self.api_key = api_key
+        self.primary = AIServiceFactory.create_service(self.platform, api_key, model)
+        self.fallbacks = [
+            candidate
+            for candidate in (parse_fallbacks(PROVIDER_FALLBACKS) if fallbacks is None else fallbacks)
+            if candidate != (self.platform, model)
+            # 使用用户密钥的请求没有按免费请求准入和计费，不能切换到使用服务器密钥的其他平台
+            and (api_key is None or candidate[0] == self.platform)
+        ]
+        self._services: dict[tuple[str, str], AIServiceBase] = {(self.platform, model): self.primary}
+        # 每次流式调用实际使用的平台/模型、首令牌时间、是否对冲及重试次数
+        self.route_records: list[dict] = []
+
+    @property
+    def usage_records(self) -> list[dict]:
+        records = []
+        for service in self._services.values():
+            records.extend(getattr(service, "usage_records", []))
+        return records
+
+    def _service(self, candidate: tuple[str, str]) -> AIServiceBase:
+        if candidate not in self._services:
+            platform, model = candidate
+            self._services[candidate] = AIServiceFactory.create_service(platform, None, model)
+        return self._services[candidate]
+
+    def _api_key(self, candidate: tuple[str, str]) -> str | None:
+        # 用户密钥只属于其选择的平台，其他平台使用服务器密钥
+        return self.api_key if candidate[0] == self.platform else None
+
+    def _candidates(self) -> list[tuple[str, str]]:
+        """返回熔断器允许调用的候选；全部熔断时只保留主候选，使调用立即失败"""
+        candidates = [(self.platform, self.model)] + self.fallbacks
+        available = [c for c in candidates if ai_breakers.get("/".join(c)).available()]
+        if len(available) < len(candidates):
+            skipped = [c for c in candidates if c not in available]
+            print(f"跳过熔断中的AI平台: {', '.join('/'.join(c) for c in skipped)}")
+        return available or candidates[:1]
+
+    async def _guarded_stream(
+        self, candidate: tuple[str, str], stream: AsyncIterator[str]
+    ) -> AsyncGenerator[str, None]:
+        """在候选的熔断器保护下转发流；熔断中时在首次迭代时抛出CircuitOpenError"""
+        breaker = ai_breakers.get("/".join(candidate))
+        breaker.acquire()
+        # 用户密钥的认证失败和限流不计入共享的熔断器
+        guarded = breaker.guard_stream(stream, user_key=self._api_key(candidate) is not None)
+        try:
+            async for chunk in guarded:
+                yield chunk
+        finally:
+            await guarded.aclose()
+
+    def _open_stream(
+        self,
+        candidate: tuple[str, str],
+        system_prompt: str,
+        data: dict,
+        reasoning_effort: str,
+        partial: str,
+    ) -> AsyncIterator[str]:
+        service = self._service(candidate)
+        if not partial:
+            stream = service.call_api_stream(
+                system_prompt=system_prompt,
+                data=data,
+                api_key=self._api_key(candidate),
+                reasoning_effort=reasoning_effort,
+            )
+        else:
+            stream = self._resume_stream(service, candidate, system_prompt, data, reasoning_effort, partial)
+        return self._guarded_stream(candidate, stream)
+
+    async def _resume_stream(
+        self,
+        service: AIServiceBase,
+        candidate: tuple[str, str],
+        system_prompt: str,
+        data: dict,
+        reasoning_effort: str,
+        partial: str,
+    ) -> AsyncGenerator[str, None]:
+        """携带部分输出续写，并去除开头与部分输出重复的文本"""
+        stream = service.call_api_stream(
+            system_prompt=system_prompt + "\n" + RESUME_PARTIAL_OUTPUT_PROMPT,
+            data={**data, "partial_output": partial},
+            api_key=self._api_key(candidate),
+            reasoning_effort=reasoning_effort,  # type: ignore
+        )
+        head = ""
+        checked = False
+        async for chunk in stream:
+            if checked:
+                yield chunk
+                continue
+            head += chunk
+            if len(head) >= min(len(partial), RESUME_OVERLAP_WINDOW):
+                checked = True
+                head = strip_resume_overlap(partial, head)
+                if head:
+                    yield head
+        if not checked:
+            head = strip_resume_overlap(partial, head)
+            if head:
+                yield head
+
+    async def _first_stream(
+        self,
+        candidates: list[tuple[str, str]],
+        system_prompt: str,
+        data: dict,
+        reasoning_effort: str,
+        partial: str,
+    ) -> tuple[AsyncIterator[str], tuple[str, str], str | None, dict]:
+        """
+        打开主候选的流；首个片段超过截止时间仍未到达时向下一个候选发起对冲请求
+
+        Returns:
+            tuple: (胜出的流, 胜出的候选, 首个片段（流为空时为None）, 路由记录)
+        """
+        primary = candidates[0]
+        contenders: dict[asyncio.Future, tuple[AsyncIterator[str], tuple[str, str], float]] = {}
+
+        def start(candidate: tuple[str, str]) -> None:
+            stream = self._open_stream(candidate, system_prompt, data, reasoning_effort, partial)
+            task = asyncio.ensure_future(stream.__anext__())
+            contenders[task] = (stream, candidate, time.monotonic())
+
+        start(primary)
+        record = {"platform": primary[0], "model": primary[1], "hedged": False}
+        hedge_candidate = candidates[1] if len(candidates) > 1 else None
+        last_error: Exception | None = None
+        try:
+            if hedge_candidate is not None:
+                delay = ttft_tracker.hedge_delay((*primary, reasoning_effort))
+                done, _ = await asyncio.wait(set(contenders), timeout=delay)
+                if not done:
+                    print(
+                        f"{primary[0]} ({primary[1]}) 首令牌超过 {delay:.1f}s，"
+                        f"向 {hedge_candidate[0]} ({hedge_candidate[1]}) 发起对冲请求"
+                    )
+                    record["hedged"] = True
+                    start(hedge_candidate)
+
+            while contenders:
+                done, _ = await asyncio.wait(set(contenders), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    stream, candidate, started = contenders.pop(task)
+                    try:
+                        first = task.result()
+                    except StopAsyncIteration:
+                        first = None
+                    except Exception as e:
+                        # 另一个请求仍在进行时，等待它的结果
+                        print(f"{candidate[0]} ({candidate[1]}) 请求失败: {str(e)}")
+                        last_error = e
+                        continue
+                    ttft = time.monotonic() - started
+                    if first is not None and not partial:
+                        ttft_tracker.record((*candidate, reasoning_effort), ttft)
+                    record.update(
+                        {"platform": candidate[0], "model": candidate[1], "ttft": round(ttft, 3)}
+                    )
+                    return stream, candidate, first, record
+            raise last_error or ValueError("没有可用的AI平台")
+        finally:
+            # 取消落败的请求并关闭其连接
+            for task, (stream, _, _) in contenders.items():
+                task.cancel()
+            if contenders:
+                await asyncio.gather(*contenders, return_exceptions=True)
+                for stream, _, _ in contenders.values():
+                    await stream.aclose()  # type: ignore
+
+    def call_api(
+        self,
+        system_prompt: str,
+        data: dict,
+        api_key: str | None = None,
+        reasoning_effort: Literal["low", "medium", "high"] = "medium",
+    ) -> str:
+        """
+        依次尝试各候选平台的非流式调用，返回第一个成功的响应
+        """
+        last_error: Exception | None = None
+        for candidate in self._candidates()[: MAX_STREAM_RETRIES + 1]:
+            try:
+                return ai_breakers.get("/".join(candidate)).call(
+                    self._service(candidate).call_api,
+                    system_prompt,
+                    data,
+                    self._api_key(candidate),
+                    reasoning_effort,
+                    user_key=self._api_key(candidate) is not None,
+                )
+            except Exception as e:
+                print(f"{candidate[0]} ({candidate[1]}) 调用失败: {str(e)}")
+                last_error = e
+        raise last_error or ValueError("没有可用的AI平台")
+
+    async def call_api_stream(
+        self,
+        system_prompt: str,
+        data: dict,
+        api_key: str | None = None,
+        reasoning_effort: Literal["low", "medium", "high"] = "medium",
+    ) -> AsyncGenerator[str, None]:
+        """
+        带对冲和续写重试的流式调用
+
+        Args:
+            system_prompt (str): 系统提示/指令
+            data (dict): 用于格式化用户消息的变量字典
+            api_key (str | None): 忽略，使用创建路由器时的密钥
+            reasoning_effort: 推理努力程度 (低/中/高)
+
+        Yields:
+            str: 响应文本的片段（重试时从中断处继续，不会重复已输出的内容）
+        """
+        candidates = self._candidates()
+        partial = ""
+        retries = 0
+        while True:
+            stream = None
+            try:
+                stream, candidate, first, record = await self._first_stream(
+                    candidates, system_prompt, data, reasoning_effort, partial
+                )
+                record["retries"] = retries
+                self.route_records.append(record)
+                if first is not None:
+                    partial += first
+                    yield first
+                    async for chunk in stream:
+                        partial += chunk
+                        yield chunk
+                return
+            except Exception as e:
+                if retries >= MAX_STREAM_RETRIES:
+                    raise
+                retries += 1
+                # 出错的候选移到末尾，优先由下一个候选续写
+                if stream is not None:
+                    candidates = [c for c in candidates if c != candidate] + [candidate]
+                elif len(candidates) > 1:
+                    candidates = candidates[1:] + candidates[:1]
+                print(
+                    f"流式调用出错 ({str(e)})，使用 {candidates[0][0]} ({candidates[0][1]}) "
+                    f"重试，已输出 {len(partial)} 个字符"
+                )
+            finally:
+                if stream is not None:
+                    await stream.aclose()  # type: ignore
+
+    def count_tokens(self, prompt: str) -> int:
+        return self.primary.count_tokens(prompt)
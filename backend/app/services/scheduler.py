@@ -0,0 +1,341 @@
+from collections import deque
+from dotenv import load_dotenv
+from typing import AsyncGenerator
+import asyncio
+import hashlib
+import os
+import time
+from app.services.admission import (
+    ADMISSION_ENABLED,
+    QUEUE_UPDATE_INTERVAL,
+    AdmissionRejected,
+    AdmissionTicket,
+    admission_controller,
+)
+from app.core.token_limiter import token_limiter
+
+load_dotenv()
+
+# 单个工作进程同时运行的生成数上限（免费请求和自带密钥请求共享）
+SCHEDULER_MAX_CONCURRENCY = int(os.getenv("SCHEDULER_MAX_CONCURRENCY", "64"))
+
+# 各请求类别的权重，名额紧张时按权重比例分配，格式: "byo:3,free:1"
+SCHEDULER_CLASS_WEIGHTS = os.getenv("SCHEDULER_CLASS_WEIGHTS", "byo:3,free:1")
+
+# 每个类别排队请求的上限
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "200"))
+
+# 每个用户API密钥同时运行的生成数上限（自带密钥的请求只受自己密钥的限制）
+BYO_KEY_MAX_CONCURRENCY = int(os.getenv("BYO_KEY_MAX_CONCURRENCY", "4"))
+
+# 统计延迟分位数时保留的最近样本数
+LATENCY_SAMPLE_WINDOW = 500
+
+
+def parse_class_weights(value: str) -> dict[str, float]:
+    """解析 "byo:3,free:1" 形式的类别权重"""
+    weights = {}
+    for item in value.split(","):
+        name, _, weight = item.strip().partition(":")
+        if name:
+            weights[name.strip()] = max(float(weight or 1), 0.01)
+    return weights
+
+
+def _percentile(samples, q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return round(ordered[min(int(q * len(ordered)), len(ordered) - 1)], 3)
+
+
+class SchedulerClass:
+    """一个请求类别的等待队列和延迟统计"""
+
+    def __init__(self, name: str, weight: float):
+        self.name = name
+        self.weight = weight
+        # 加权公平排队的虚拟时间：每放行一个请求前进 1/weight
+        self.virtual_time = 0.0
+        self.waiters: deque["ScheduleTicket"] = deque()
+        self.active = 0
+        self.served = 0
+        self.rejected = 0
+        self.queue_seconds: deque[float] = deque(maxlen=LATENCY_SAMPLE_WINDOW)
+        self.total_seconds: deque[float] = deque(maxlen=LATENCY_SAMPLE_WINDOW)
+
+    def stats(self) -> dict:
+        return {
+            "weight": self.weight,
+            "active": self.active,
+            "queued": len(self.waiters),
+            "served": self.served,
+            "rejected": self.rejected,
+            "queue_seconds": {
+                "p50": _percentile(self.queue_seconds, 0.5),
+                "p95": _percentile(self.queue_seconds, 0.95),
+            },
+            "total_seconds": {
+                "p50": _percentile(self.total_seconds, 0.5),
+                "p95": _percentile(self.total_seconds, 0.95),
+            },
+        }
+
+
+class ScheduleTicket:
+    """
+    一个生成请求的调度凭证
+
+    wait() 依次等待：工作进程名额（加权公平队列）→ 上游限制（免费请求为服务器密钥的
+    平台/模型准入控制，自带密钥请求为该密钥的并发限制），期间产出queued事件。
+    """
+
+    def __init__(
+        self,
+        scheduler: "FairScheduler",
+        request_class: SchedulerClass,
+        platform: str,
+        model: str,
+        tokens: int,
+        key_hash: str | None,
+        charge_id: int | None,
+    ):
+        self.scheduler = scheduler
+        self.request_class = request_class
+        self.platform = platform
+        self.model = model
+        self.tokens = tokens
+        self.key_hash = key_hash
+        # 令牌限流的扣费记录（仅免费请求）
+        self.charge_id = charge_id
+        self.enqueued_at = time.monotonic()
+        self.started_at: float | None = None
+        self.dispatched = asyncio.Event()
+        self.admission: AdmissionTicket | None = None
+        self.key_ref_held = False
+        self.key_slot_held = False
+        self.released = False
+
+    async def wait(self) -> AsyncGenerator[dict, None]:
+        """
+        等待直到可以开始生成
+
+        Yields:
+            dict: queued事件
+
+        Raises:
+            AdmissionRejected: 上游准入队列已满
+        """
+        try:
+            while not self.dispatched.is_set():
+                position = self.scheduler.position(self)
+                yield {
+                    'status': 'queued',
+                    'message': f'请求较多，正在排队（第 {position} 位）...',
+                    'position': position,
+                    'estimated_wait': self.scheduler.estimated_wait(self, position),
+                    'request_class': self.request_class.name,
+                }
+                try:
+                    await asyncio.wait_for(self.dispatched.wait(), timeout=QUEUE_UPDATE_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+            if self.key_hash is not None:
+                # 自带密钥：只受该密钥自身的并发限制
+                semaphore = self.scheduler.acquire_key_ref(self.key_hash)
+                self.key_ref_held = True
+                if semaphore.locked():
+                    yield {
+                        'status': 'queued',
+                        'message': '您的API密钥已有多个生成在进行，等待其完成...',
+                        'position': 1,
+                        'estimated_wait': None,
+                        'request_class': self.request_class.name,
+                    }
+                await semaphore.acquire()
+                self.key_slot_held = True
+            elif ADMISSION_ENABLED:
+                # 免费请求：受服务器密钥的平台/模型并发和令牌预算限制
+                self.admission = admission_controller.request(self.platform, self.model, self.tokens)
+                async for event in self.admission.wait():
+                    yield {**event, 'request_class': self.request_class.name}
+
+            self.started_at = time.monotonic()
+            self.request_class.queue_seconds.append(self.started_at - self.enqueued_at)
+        except BaseException:
+            self.release()
+            raise
+
+    def release(self, actual_tokens: int | None = None) -> None:
+        """
+        归还所有名额；提供actual_tokens时按实际用量修正令牌桶和上游令牌预算
+        """
+        if self.released:
+            return
+        self.released = True
+        if self.admission is not None:
+            self.admission.release(actual_tokens)
+        if self.key_slot_held:
+            self.scheduler.key_semaphores[self.key_hash].release()  # type: ignore
+        if self.key_ref_held:
+            self.scheduler.release_key_ref(self.key_hash)  # type: ignore
+        if self.charge_id:
+            if self.started_at is None:
+                # 未开始生成：撤销预估的扣费
+                token_limiter.refund(self.charge_id)
+            elif actual_tokens is not None:
+                token_limiter.settle(self.charge_id, actual_tokens)
+        if self.started_at is not None:
+            self.request_class.total_seconds.append(time.monotonic() - self.enqueued_at)
+        self.scheduler.finish(self)
+
+
+class FairScheduler:
+    """
+    生成流程前的加权公平调度器
+
+    - 免费请求（服务器密钥）与自带密钥请求分属不同类别，名额紧张时按权重分配
+    - 免费请求按客户端的令牌成本限流（见 app.core.token_limiter）
+    - 自带密钥请求只受该密钥自身的并发限制，不占用服务器密钥的预算
+    """
+
+    def __init__(self):
+        self.capacity = SCHEDULER_MAX_CONCURRENCY
+        self.classes = {
+            name: SchedulerClass(name, weight)
+            for name, weight in parse_class_weights(SCHEDULER_CLASS_WEIGHTS).items()
+        }
+        self.active = 0
+        self.key_semaphores: dict[str, asyncio.Semaphore] = {}
+        self.key_refs: dict[str, int] = {}
+
+    def _class(self, name: str) -> SchedulerClass:
+        if name not in self.classes:
+            self.classes[name] = SchedulerClass(name, 1.0)
+        return self.classes[name]
+
+    def acquire_key_ref(self, key_hash: str) -> asyncio.Semaphore:
+        """返回用户密钥的并发信号量，并记录一个引用（等待或持有）"""
+        if key_hash not in self.key_semaphores:
+            self.key_semaphores[key_hash] = asyncio.Semaphore(BYO_KEY_MAX_CONCURRENCY)
+        self.key_refs[key_hash] = self.key_refs.get(key_hash, 0) + 1
+        return self.key_semaphores[key_hash]
+
+    def release_key_ref(self, key_hash: str) -> None:
+        self.key_refs[key_hash] -= 1
+        if not self.key_refs[key_hash]:
+            del self.key_refs[key_hash]
+            del self.key_semaphores[key_hash]
+
+    def request(
+        self,
+        client_id: str | None,
+        platform: str,
+        model: str,
+        tokens: int,
+        api_key: str | None = None,
+    ) -> ScheduleTicket:
+        """
+        申请调度
+
+        Args:
+            client_id: 客户端标识（通常为远程地址），用于免费请求的令牌限流
+            platform: AI平台
+            model: 模型
+            tokens: 预估消耗的令牌数
+            api_key: 用户自己的API密钥（提供时归入byo类别）
+
+        Returns:
+            ScheduleTicket: 调度凭证
+
+        Raises:
+            AdmissionRejected: 令牌预算不足或排队已满
+        """
+        request_class = self._class("byo" if api_key else "free")
+        charge_id = None
+        if not api_key and client_id:
+            # 免费请求按预估令牌数扣除客户端的滚动预算（多个工作进程共享）
+            charge_id, status = token_limiter.charge(client_id, tokens)
+            if charge_id is None:
+                request_class.rejected += 1
+                raise AdmissionRejected(
+                    f'免费额度已用完（剩余 {status["remaining"]} 令牌），请约 {status["reset"]} 秒后重试，或提供自己的API密钥。'
+                )
+
+        ticket = ScheduleTicket(
+            self,
+            request_class,
+            platform,
+            model,
+            0 if api_key else tokens,
+            hashlib.sha256(api_key.encode()).hexdigest() if api_key else None,
+            charge_id,
+        )
+        # 空闲后重新进入竞争的类别不能累积空闲期间的份额
+        if not (request_class.waiters or request_class.active):
+            busy = [c.virtual_time for c in self.classes.values() if c.waiters or c.active]
+            if busy:
+                request_class.virtual_time = max(request_class.virtual_time, min(busy))
+        if self.active < self.capacity and not any(c.waiters for c in self.classes.values()):
+            self._dispatch(ticket)
+        elif len(request_class.waiters) >= SCHEDULER_MAX_QUEUE:
+            request_class.rejected += 1
+            if charge_id:
+                token_limiter.refund(charge_id)
+            raise AdmissionRejected('当前请求过多，排队已满，请稍后重试。')
+        else:
+            request_class.waiters.append(ticket)
+        return ticket
+
+    def _dispatch(self, ticket: ScheduleTicket) -> None:
+        request_class = ticket.request_class
+        request_class.virtual_time += 1 / request_class.weight
+        request_class.active += 1
+        request_class.served += 1
+        self.active += 1
+        ticket.dispatched.set()
+
+    def _schedule(self) -> None:
+        """名额空出时，从虚拟时间最小的非空类别中放行队首请求"""
+        while self.active < self.capacity:
+            candidates = [c for c in self.classes.values() if c.waiters]
+            if not candidates:
+                return
+            request_class = min(candidates, key=lambda c: c.virtual_time)
+            self._dispatch(request_class.waiters.popleft())
+
+    def finish(self, ticket: ScheduleTicket) -> None:
+        request_class = ticket.request_class
+        if ticket.dispatched.is_set():
+            request_class.active -= 1
+            self.active -= 1
+        elif ticket in request_class.waiters:
+            request_class.waiters.remove(ticket)
+        self._schedule()
+
+    def position(self, ticket: ScheduleTicket) -> int:
+        try:
+            return ticket.request_class.waiters.index(ticket) + 1
+        except ValueError:
+            return 0
+
+    def estimated_wait(self, ticket: ScheduleTicket, position: int) -> float:
+        """按该类别的份额和最近的生成耗时估算等待秒数"""
+        request_class = ticket.request_class
+        contending = [c for c in self.classes.values() if c.waiters or c.active]
+        share = request_class.weight / sum(c.weight for c in contending) if contending else 1.0
+        slots = max(self.capacity * share, 1)
+        generation_seconds = _percentile(request_class.total_seconds, 0.5) or 60.0
+        return round(position / slots * generation_seconds, 1)
+
+    def stats(self) -> dict:
+        return {
+            "capacity": self.capacity,
+            "active": self.active,
+            "classes": {name: c.stats() for name, c in self.classes.items()},
+        }
+
+
+# 进程内共享的调度器
+scheduler = FairScheduler()
@@ -0,0 +1,112 @@
+import re
+from difflib import SequenceMatcher
+
+from app.utils.tree_pruner import normalize_name
+
+# 节点标签与组件名的最低相似度
+MIN_LABEL_SIMILARITY = 0.75
+
+MERMAID_KEYWORDS = {
+    "subgraph",
+    "end",
+    "click",
+    "class",
+    "classdef",
+    "style",
+    "linkstyle",
+    "flowchart",
+    "graph",
+    "direction",
+}
+
+# 节点定义: Id["Label"]、Id("Label")、Id[(Label)]、Id{{Label}} 等
+_NODE_PATTERN = re.compile(
+    r"(?<![\w\-\"])([A-Za-z_][\w\-]*)\s*"
+    r"(\[\[|\[\(|\(\[|\(\(|\[/|\[\\|\{\{|\[|\(|\{)"
+    r"\s*(?:\"([^\"\n]*)\"|([^\"\]\)\}\n]*?))\s*"
+    r"(\]\]|\)\]|\]\)|\)\)|/\]|\\\]|\}\}|\]|\)|\})"
+)
+_CLICK_PATTERN = re.compile(r"^\s*click\s+([^\s\"]+)", re.MULTILINE)
+
+
+def extract_node_labels(diagram: str) -> dict[str, str]:
+    """
+    提取Mermaid流程图中的节点ID及其标签
+
+    Returns:
+        dict[str, str]: 节点ID到标签的映射（同一节点以首次出现的标签为准）
+    """
+    nodes: dict[str, str] = {}
+    for line in diagram.split("\n"):
+        stripped = line.strip()
+        if not stripped or stripped.startswith("%%"):
+            continue
+        first_word = stripped.split(None, 1)[0].lower()
+        if first_word in ("click", "classdef", "class", "style", "linkstyle"):
+            continue
+        # 忽略连线标签 -->|"label"| 中的内容
+        stripped = re.sub(r"\|[^|]*\|", " ", stripped)
+        for match in _NODE_PATTERN.finditer(stripped):
+            node_id = match.group(1)
+            label = (match.group(3) if match.group(3) is not None else match.group(4)).strip()
+            if node_id.lower() in MERMAID_KEYWORDS:
+                continue
+            nodes.setdefault(node_id, label)
+    return nodes
+
+
+def attach_click_events(diagram: str, mapping: list[tuple[str, str]]) -> str:
+    """
+    将组件映射以 `click Node "path"` 的形式附加到图表中
+
+    通过比较节点标签（或ID）与组件名匹配节点，已有click事件的节点保持不变。
+
+    Args:
+        diagram: 不含click事件（或只含部分click事件）的Mermaid代码
+        mapping: parse_component_mapping 返回的 (组件名, 路径) 列表
+
+    Returns:
+        str: 附加click事件后的Mermaid代码
+    """
+    nodes = extract_node_labels(diagram)
+    clicked = set(_CLICK_PATTERN.findall(diagram))
+    candidates = {
+        node_id: (normalize_name(label), normalize_name(node_id))
+        for node_id, label in nodes.items()
+        if node_id not in clicked
+    }
+
+    click_lines = []
+    for name, path in mapping:
+        component_key = normalize_name(re.sub(r"\(.*?\)", "", name))
+        if not component_key:
+            continue
+        best_id, best_score = None, MIN_LABEL_SIMILARITY
+        for node_id, (label_key, id_key) in candidates.items():
+            if component_key in (label_key, id_key):
+                best_id, best_score = node_id, 1.0
+                break
+            score = SequenceMatcher(None, component_key, label_key).ratio()
+            if score > best_score:
+                best_id, best_score = node_id, score
+        if best_id is not None:
+            click_lines.append(f'    click {best_id} "{path}"')
+            del candidates[best_id]
+
+    if not click_lines:
+        return diagram
+    return diagram.rstrip() + "\n\n    %% Click Events\n" + "\n".join(click_lines) + "\n"
+
+
+def extract_click_mapping(diagram: str) -> list[tuple[str, str]]:
+    """
+    从图表的click事件反推组件映射（用于没有单独映射阶段的流程）
+
+    Returns:
+        list[tuple[str, str]]: (节点标签或ID, 路径) 列表
+    """
+    nodes = extract_node_labels(diagram)
+    return [
+        (nodes.get(node_id) or node_id, path)
+        for node_id, path in re.findall(r'^\s*click\s+([^\s"]+)\s+"([^"]+)"', diagram, re.MULTILINE)
+    ]
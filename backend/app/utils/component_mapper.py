@@ -0,0 +1,204 @@
+import re
+from difflib import SequenceMatcher
+
+from app.utils.tree_pruner import STOPWORDS, name_variants, normalize_name
+
+# 单个组件被视为"已解析"所需的最低置信度
+MIN_COMPONENT_CONFIDENCE = 0.6
+
+# 解释中常见的非组件加粗词/标题
+GENERIC_COMPONENT_NAMES = {
+    "note",
+    "notes",
+    "important",
+    "component",
+    "components",
+    "relationship",
+    "relationships",
+    "guideline",
+    "guidelines",
+    "overview",
+    "summary",
+    "example",
+    "explanation",
+    "diagram",
+    "instruction",
+    "instructions",
+    "step",
+    "layout",
+    "main component",
+    "data flow",
+}
+
+_BOLD_PATTERN = re.compile(r"\*\*([^*\n]{2,60}?)\*\*")
+_LIST_ITEM_PATTERN = re.compile(r"^\s*(?:[-*+]|\d+[.)])\s+(?:\*\*)?([^:*\n]{2,60}?)(?:\*\*)?\s*:")
+_HEADING_PATTERN = re.compile(r"^\s*#{2,6}\s+(?:\d+[.)]\s*)?(.{2,60}?)\s*$")
+_BACKTICK_PATTERN = re.compile(r"`([^`\s]+)`")
+_MAPPING_LINE_PATTERN = re.compile(r"^\s*\d+\.\s*\[?(.+?)\]?\s*:\s*\[?(.+?)\]?\s*$")
+
+
+def parse_component_mapping(mapping_text: str) -> list[tuple[str, str]]:
+    """
+    解析 `<component_mapping>` 文本中的 "N. 组件名: 路径" 行
+
+    Returns:
+        list[tuple[str, str]]: (组件名, 路径) 列表
+    """
+    entries = []
+    for line in mapping_text.split("\n"):
+        match = _MAPPING_LINE_PATTERN.match(line)
+        if match:
+            entries.append((match.group(1).strip(), match.group(2).strip().strip("`\"'")))
+    return entries
+
+
+def format_component_mapping(entries: list[tuple[str, str]]) -> str:
+    """
+    生成与阶段2相同格式的组件映射文本（以 `<component_mapping>` 开头，与generate_stream的提取结果一致）
+    """
+    lines = [f"{i}. {name}: {path}" for i, (name, path) in enumerate(entries, 1)]
+    return "<component_mapping>\n" + "\n".join(lines) + "\n"
+
+
+def extract_components(explanation: str) -> list[dict]:
+    """
+    从阶段1的解释中提取组件名称
+
+    识别加粗文本、"- 名称:" 形式的列表项和小标题，并收集同一行中的反引号路径作为提示。
+
+    Returns:
+        list[dict]: 每个组件包含 name 和 path_hints
+    """
+    components: dict[str, dict] = {}
+    for line in explanation.split("\n"):
+        candidates = [m.group(1) for m in _BOLD_PATTERN.finditer(line)]
+        for pattern in (_LIST_ITEM_PATTERN, _HEADING_PATTERN):
+            match = pattern.match(line)
+            if match:
+                candidates.append(match.group(1))
+        path_hints = [m.group(1).strip("/") for m in _BACKTICK_PATTERN.finditer(line)]
+        for candidate in candidates:
+            name = candidate.strip().strip(":").strip()
+            key = normalize_name(re.sub(r"\(.*?\)", "", name))
+            if (
+                not key
+                or name.lower() in GENERIC_COMPONENT_NAMES
+                or len(name.split()) > 6
+            ):
+                continue
+            component = components.setdefault(key, {"name": name, "path_hints": []})
+            component["path_hints"].extend(
+                hint for hint in path_hints if hint not in component["path_hints"]
+            )
+    return list(components.values())
+
+
+def _component_terms(name: str) -> set[str]:
+    terms = set()
+    for word in re.findall(r"[A-Za-z][A-Za-z0-9_\-.]*", name):
+        for variant in name_variants(word):
+            if len(variant) >= 2 and variant not in STOPWORDS:
+                terms.add(variant)
+    return terms
+
+
+def _segment_key(segment: str) -> tuple[str, set[str]]:
+    stem = segment.rsplit(".", 1)[0] if "." in segment[1:] else segment
+    return normalize_name(stem), name_variants(stem)
+
+
+def _score(
+    matcher: SequenceMatcher, component_key: str, terms: set[str], segment_key: tuple[str, set[str]]
+) -> float:
+    stem_key, segment_terms = segment_key
+    if not stem_key:
+        return 0.0
+    if stem_key == component_key:
+        return 1.0
+    overlap = len(terms & segment_terms) / len(terms) if terms else 0.0
+    # matcher的seq2固定为组件名，SequenceMatcher会缓存其索引；
+    # 用上界快速排除不可能达到阈值的候选，避免计算完整的ratio
+    matcher.set_seq1(stem_key)
+    ratio = 0.0
+    threshold = MIN_COMPONENT_CONFIDENCE / 0.95
+    if matcher.real_quick_ratio() >= threshold and matcher.quick_ratio() >= threshold:
+        ratio = matcher.ratio()
+    return max(overlap * 0.9, ratio * 0.95)
+
+
+def map_components_locally(file_tree: str, explanation: str) -> dict:
+    """
+    在本地将解释中的组件模糊匹配到文件树中的路径，替代阶段2的LLM调用
+
+    Args:
+        file_tree: 换行分隔的路径列表
+        explanation: 阶段1生成的解释
+
+    Returns:
+        dict: 包含 mapping_text（与阶段2提取结果格式相同）、components
+              （每个组件的name、path、confidence）、unresolved 和整体 confidence
+    """
+    paths = [
+        line.split(" (", 1)[0].rstrip("/")
+        for line in file_tree.split("\n")
+        if line.strip()
+    ]
+    path_set = set(paths)
+    # 目录条目可能只以前缀形式出现
+    for path in list(paths):
+        parts = path.split("/")
+        for i in range(1, len(parts)):
+            ancestor = "/".join(parts[:i])
+            if ancestor not in path_set:
+                path_set.add(ancestor)
+                paths.append(ancestor)
+
+    # 按末段名称建立索引，相同名称只计算一次得分
+    index: dict[str, list[str]] = {}
+    for path in paths:
+        index.setdefault(path.rsplit("/", 1)[-1], []).append(path)
+    segment_keys = {segment: _segment_key(segment) for segment in index}
+
+    components = []
+    for component in extract_components(explanation):
+        name = component["name"]
+        best_path, best_score = None, 0.0
+
+        for hint in component["path_hints"]:
+            if hint in path_set:
+                best_path, best_score = hint, 1.0
+                break
+
+        if best_path is None:
+            component_key = normalize_name(re.sub(r"\(.*?\)", "", name))
+            terms = _component_terms(re.sub(r"\(.*?\)", "", name))
+            matcher = SequenceMatcher(None, "", component_key)
+            scores = {
+                segment: _score(matcher, component_key, terms, key)
+                for segment, key in segment_keys.items()
+            }
+            best_score = max(scores.values(), default=0.0)
+            if best_score > 0:
+                # 同分时优先选择更浅的路径（通常是目录）
+                best_path = min(
+                    (p for segment, score in scores.items() if score == best_score for p in index[segment]),
+                    key=lambda p: (p.count("/"), len(p)),
+                )
+
+        components.append(
+            {"name": name, "path": best_path, "confidence": round(best_score, 3)}
+        )
+
+    resolved = [
+        c for c in components if c["path"] and c["confidence"] >= MIN_COMPONENT_CONFIDENCE
+    ]
+    unresolved = [c["name"] for c in components if c not in resolved]
+    confidence = (
+        sum(c["confidence"] for c in components) / len(components) if components else 0.0
+    )
+    return {
+        "mapping_text": format_component_mapping([(c["name"], c["path"]) for c in resolved]),
+        "components": components,
+        "unresolved": unresolved,
+        "confidence": round(confidence, 3),
+    }
@@ -0,0 +1,470 @@
+import json
+import re
+from collections import Counter
+
+from app.utils.mermaid_parser import (
+    RESERVED_IDS,
+    Flowchart,
+    FlowLine,
+    FlowLink,
+    FlowNode,
+    ID_PATTERN,
+    METADATA_SHAPE,
+    parse_flowchart,
+    parse_line,
+)
+
+# 补丁支持的编辑操作
+PATCH_OPERATIONS = (
+    "add_node",
+    "remove_node",
+    "rename_node",
+    "add_edge",
+    "remove_edge",
+    "restyle",
+    "edit_subgraph",
+)
+
+# add_node可用的节点形状
+NODE_SHAPES = {
+    "rect": ("[", "]"),
+    "round": ("(", ")"),
+    "stadium": ("([", "])"),
+    "subroutine": ("[[", "]]"),
+    "database": ("[(", ")]"),
+    "circle": ("((", "))"),
+    "rhombus": ("{", "}"),
+    "hexagon": ("{{", "}}"),
+}
+
+# 放在图表末尾、新增语句需要插在其前面的行
+_TRAILING_KINDS = ("click", "classDef", "class", "style", "linkStyle")
+
+
+class PatchError(ValueError):
+    """补丁格式错误、目标不存在，或应用后的图表无效"""
+
+
+def parse_patch(text: str) -> list[dict]:
+    """
+    解析模型返回的补丁：JSON操作数组，或 {"operations": [...]}（允许代码块标记）
+
+    Returns:
+        list[dict]: 操作列表，每项带有PATCH_OPERATIONS中的 "op"
+
+    Raises:
+        PatchError: 不是合法的补丁
+    """
+    text = text.replace("```json", "").replace("```", "").strip()
+    starts = [i for i in (text.find("["), text.find("{")) if i != -1]
+    if not starts:
+        raise PatchError("补丁不是JSON")
+    start = min(starts)
+    end = text.rfind("]" if text[start] == "[" else "}")
+    try:
+        patch = json.loads(text[start:end + 1])
+    except ValueError as e:
+        raise PatchError(f"补丁不是合法的JSON: {e}")
+    if isinstance(patch, dict):
+        patch = patch.get("operations")
+    if not isinstance(patch, list) or not patch:
+        raise PatchError("补丁不包含任何操作")
+    for operation in patch:
+        if not isinstance(operation, dict) or operation.get("op") not in PATCH_OPERATIONS:
+            raise PatchError(f"不支持的操作: {operation!r:.80}")
+    return patch
+
+
+def _quote(label) -> str:
+    if not isinstance(label, str) or not label.strip() or "\n" in label:
+        raise PatchError(f"无效的标签: {label!r:.40}")
+    return '"' + label.strip().replace('"', "#quot;") + '"'
+
+
+def _metadata_label(metadata: str, label: str) -> str:
+    """替换（或添加）节点元数据 `@{ ... }` 中的label"""
+    pattern = re.compile(r'(\blabel\s*:\s*)("[^"]*"|[^,}]*)')
+    if pattern.search(metadata):
+        return pattern.sub(lambda match: f'{match.group(1)}"{label}"', metadata, count=1)
+    body = metadata.strip()
+    return f' {body}, label: "{label}" ' if body else f' label: "{label}" '
+
+
+def _field(operation: dict, key: str) -> str:
+    value = operation.get(key)
+    if not isinstance(value, str) or not value.strip():
+        raise PatchError(f"{operation['op']} 缺少 {key}")
+    return value.strip()
+
+
+def _require_node(chart: Flowchart, operation: dict, key: str, allow_subgraph: bool = False) -> str:
+    node_id = _field(operation, key)
+    if node_id not in chart.nodes() and not (allow_subgraph and node_id in chart.subgraphs()):
+        raise PatchError(f"{operation['op']}: 节点 {node_id} 不存在")
+    return node_id
+
+
+def _splice(chart: Flowchart, index: int, count: int, lines: list[FlowLine]) -> None:
+    chart.lines[index:index + count] = lines
+    chart.reindex()
+
+
+def _indent(chart: Flowchart, subgraph: str | None) -> str:
+    if subgraph is not None:
+        return chart.lines[chart.subgraphs()[subgraph]["start"]].indent + "    "
+    for line in chart.lines:
+        if line.kind in ("statement", "subgraph") and line.subgraph is None:
+            return line.indent
+    return "    "
+
+
+def _insertion_index(chart: Flowchart, subgraph: str | None) -> int:
+    """新语句的插入位置：子图的end之前，或顶层的click/style等语句之前"""
+    if subgraph is not None:
+        return chart.subgraphs()[subgraph]["end"]
+    index = next(
+        (i for i, line in enumerate(chart.lines) if line.kind in _TRAILING_KINDS and line.subgraph is None),
+        None,
+    )
+    if index is None:
+        index = len(chart.lines)
+    while index > 0 and chart.lines[index - 1].kind in ("blank", "comment"):
+        index -= 1
+    return index
+
+
+def _end_index(chart: Flowchart) -> int:
+    index = len(chart.lines)
+    while index > 0 and chart.lines[index - 1].kind == "blank":
+        index -= 1
+    return index
+
+
+def _explode(line: FlowLine) -> list:
+    """将语句展开为原子语句：带标签的节点定义 ("node", FlowNode) 和单条连线 ("edge", (起点, 连线, 终点))"""
+    atoms: list = []
+    defined = set()
+    for group in line.groups:
+        for node in group:
+            if (node.shape is not None or node.cls) and node.id not in defined:
+                atoms.append(("node", node))
+                defined.add(node.id)
+    atoms.extend(("edge", edge) for edge in line.edges())
+    if not line.links:
+        # 不带标签的单独节点引用（如子图中的 `A`）
+        atoms.extend(("node", node) for group in line.groups for node in group if node.id not in defined)
+    return atoms
+
+
+def _atom_ids(atom) -> tuple[str, ...]:
+    kind, value = atom
+    return (value.id,) if kind == "node" else (value[0], value[2])
+
+
+def _atom_lines(indent: str, atoms: list) -> list[FlowLine]:
+    lines = []
+    for kind, value in atoms:
+        if kind == "node":
+            lines.append(parse_line(indent + value.render()))
+        else:
+            source, link, target = value
+            lines.append(parse_line(f"{indent}{source}{link.render()}{target}"))
+    return lines
+
+
+def _rewrite_statements(chart: Flowchart, keep, only_subgraphs: bool = False) -> list:
+    """
+    展开提及指定内容的语句并只保留 keep(atom) 为真的原子语句
+
+    Returns:
+        list: 被移除的原子语句
+    """
+    removed: list = []
+    for index in reversed(range(len(chart.lines))):
+        line = chart.lines[index]
+        if line.kind != "statement" or (only_subgraphs and line.subgraph is None):
+            continue
+        atoms = _explode(line)
+        kept = [atom for atom in atoms if keep(atom)]
+        if len(kept) != len(atoms):
+            removed = [atom for atom in atoms if not keep(atom)] + removed
+            _splice(chart, index, 1, _atom_lines(line.indent, kept))
+    return removed
+
+
+def _remove_class_member(chart: Flowchart, target: str) -> None:
+    """从 `class A,B name` 语句中移除target，成员为空时删除该语句"""
+    for index in reversed(range(len(chart.lines))):
+        line = chart.lines[index]
+        if line.kind != "class":
+            continue
+        _, ids, *rest = line.raw.split()
+        members = [member for member in ids.split(",") if member != target]
+        if len(members) != len(ids.split(",")):
+            replacement = [parse_line(f"{line.indent}class {','.join(members)} {' '.join(rest)}")] if members else []
+            _splice(chart, index, 1, replacement)
+
+
+def _remove_references(chart: Flowchart, target: str) -> None:
+    """移除指向target的click和style语句，并从class语句中移除target"""
+    for index in reversed(range(len(chart.lines))):
+        line = chart.lines[index]
+        if line.kind in ("click", "style") and line.target == target:
+            _splice(chart, index, 1, [])
+    _remove_class_member(chart, target)
+
+
+def _detach(chart: Flowchart, node_id: str) -> FlowNode:
+    """
+    将节点移出所有子图：子图中提及该节点的连线移到顶层
+
+    Returns:
+        FlowNode: 节点的定义（带标签时），供放入新的位置
+    """
+    definition = chart.nodes()[node_id]
+    removed = _rewrite_statements(chart, lambda atom: node_id not in _atom_ids(atom), only_subgraphs=True)
+    edges = [atom for atom in removed if atom[0] == "edge"]
+    if edges:
+        index = _insertion_index(chart, None)
+        _splice(chart, index, 0, _atom_lines(_indent(chart, None), edges))
+    return definition
+
+
+def _place_node(chart: Flowchart, node: FlowNode, subgraph: str | None) -> None:
+    definition = FlowNode(node.id, node.shape, node.label, node.quoted, node.cls)
+    _splice(chart, _insertion_index(chart, subgraph), 0, [parse_line(_indent(chart, subgraph) + definition.render())])
+
+
+def _add_node(chart: Flowchart, operation: dict) -> None:
+    node_id = _field(operation, "id")
+    if not ID_PATTERN.fullmatch(node_id) or node_id.lower() in RESERVED_IDS:
+        raise PatchError(f"add_node: 无效的节点ID {node_id}")
+    if node_id in chart.nodes() or node_id in chart.subgraphs():
+        raise PatchError(f"add_node: 节点 {node_id} 已存在")
+    shape = NODE_SHAPES.get(operation.get("shape") or "rect")
+    if shape is None:
+        raise PatchError(f"add_node: 不支持的形状 {operation.get('shape')}")
+    subgraph = operation.get("subgraph")
+    if subgraph is not None and subgraph not in chart.subgraphs():
+        raise PatchError(f"add_node: 子图 {subgraph} 不存在")
+    text = f"{node_id}{shape[0]}{_quote(operation.get('label'))}{shape[1]}"
+    _splice(chart, _insertion_index(chart, subgraph), 0, [parse_line(_indent(chart, subgraph) + text)])
+
+
+def _remove_node(chart: Flowchart, operation: dict) -> None:
+    node_id = _require_node(chart, operation, "id")
+    _rewrite_statements(chart, lambda atom: node_id not in _atom_ids(atom))
+    _remove_references(chart, node_id)
+
+
+def _rename_node(chart: Flowchart, operation: dict) -> None:
+    node_id = _require_node(chart, operation, "id")
+    label = _quote(operation.get("label"))[1:-1]
+    statements = [(i, line) for i, line in chart.statements() if node_id in line.node_ids()]
+    # 修改带标签的定义；没有时给首次出现的引用加上标签
+    index, line = next(
+        ((i, line) for i, line in statements if any(n.id == node_id and n.shape for g in line.groups for n in g)),
+        statements[0],
+    )
+    for group in line.groups:
+        for node in group:
+            if node.id == node_id:
+                if node.shape == METADATA_SHAPE:
+                    node.label = _metadata_label(node.label, label)
+                else:
+                    node.shape = node.shape or ("[", "]")
+                    node.label, node.quoted = label, True
+                break
+        else:
+            continue
+        break
+    _splice(chart, index, 1, [parse_line(line.render_statement())])
+
+
+def _add_edge(chart: Flowchart, operation: dict) -> None:
+    source = _require_node(chart, operation, "from", allow_subgraph=True)
+    target = _require_node(chart, operation, "to", allow_subgraph=True)
+    arrow = (operation.get("arrow") or "-->").strip()
+    label = operation.get("label")
+    link = FlowLink(arrow, _quote(label) if label else None)
+    line = parse_line(f"{_indent(chart, None)}{source}{link.render()}{target}")
+    if line.kind != "statement" or len(line.links) != 1 or line.links[0].arrow != arrow:
+        raise PatchError(f"add_edge: 无效的连线 {arrow}")
+    _splice(chart, _insertion_index(chart, None), 0, [line])
+
+
+def _remove_edge(chart: Flowchart, operation: dict) -> None:
+    source = _field(operation, "from")
+    target = _field(operation, "to")
+    if not any(edge[0] == source and edge[2] == target for edge in chart.edges()):
+        raise PatchError(f"remove_edge: 连线 {source} -> {target} 不存在")
+    _rewrite_statements(
+        chart, lambda atom: not (atom[0] == "edge" and atom[1][0] == source and atom[1][2] == target)
+    )
+
+
+def _restyle(chart: Flowchart, operation: dict) -> None:
+    target = _require_node(chart, operation, "id", allow_subgraph=True)
+    style = operation.get("style")
+    class_name = operation.get("class")
+    if not style and not class_name:
+        raise PatchError("restyle 需要 style 或 class")
+
+    if style:
+        if not isinstance(style, str) or "\n" in style:
+            raise PatchError("restyle: 无效的样式")
+        for index in reversed(range(len(chart.lines))):
+            if chart.lines[index].kind == "style" and chart.lines[index].target == target:
+                _splice(chart, index, 1, [])
+        _splice(chart, _end_index(chart), 0, [parse_line(f"{_indent(chart, None)}style {target} {style.strip()}")])
+
+    if class_name:
+        if not isinstance(class_name, str) or not ID_PATTERN.fullmatch(class_name):
+            raise PatchError("restyle: 无效的类名")
+        defined = any(line.kind == "classDef" and line.target == class_name for line in chart.lines)
+        definition = operation.get("class_def")
+        if definition:
+            if "\n" in definition:
+                raise PatchError("restyle: 无效的类定义")
+            for index in reversed(range(len(chart.lines))):
+                if chart.lines[index].kind == "classDef" and chart.lines[index].target == class_name:
+                    _splice(chart, index, 1, [])
+            _splice(chart, _end_index(chart), 0, [parse_line(f"{_indent(chart, None)}classDef {class_name} {definition.strip()}")])
+        elif not defined:
+            raise PatchError(f"restyle: 类 {class_name} 未定义")
+        # 节点只保留新的类
+        for index, line in chart.statements():
+            if any(node.id == target and node.cls for group in line.groups for node in group):
+                for group in line.groups:
+                    for node in group:
+                        if node.id == target:
+                            node.cls = None
+                _splice(chart, index, 1, [parse_line(line.render_statement())])
+        _remove_class_member(chart, target)
+        _splice(chart, _end_index(chart), 0, [parse_line(f"{_indent(chart, None)}class {target} {class_name}")])
+
+
+def _edit_subgraph(chart: Flowchart, operation: dict) -> None:
+    subgraph = _field(operation, "id")
+    label = operation.get("label")
+    subgraphs = chart.subgraphs()
+
+    if subgraph not in subgraphs:
+        # 不存在时新建
+        if not label or not ID_PATTERN.fullmatch(subgraph) or subgraph in chart.nodes():
+            raise PatchError(f"edit_subgraph: 子图 {subgraph} 不存在")
+        parent = operation.get("parent")
+        if parent is not None and parent not in subgraphs:
+            raise PatchError(f"edit_subgraph: 子图 {parent} 不存在")
+        indent = _indent(chart, parent)
+        _splice(
+            chart,
+            _insertion_index(chart, parent),
+            0,
+            [parse_line(f"{indent}subgraph {subgraph}[{_quote(label)}]"), parse_line(f"{indent}end")],
+        )
+    elif label:
+        start = subgraphs[subgraph]["start"]
+        if not ID_PATTERN.fullmatch(subgraph):
+            raise PatchError(f"edit_subgraph: 无法修改子图 {subgraph} 的标题")
+        _splice(chart, start, 1, [parse_line(f"{chart.lines[start].indent}subgraph {subgraph}[{_quote(label)}]")])
+
+    for node_id in operation.get("add") or []:
+        if node_id not in chart.nodes():
+            raise PatchError(f"edit_subgraph: 节点 {node_id} 不存在")
+        _place_node(chart, _detach(chart, node_id), subgraph)
+
+    parent = chart.subgraphs()[subgraph]["parent"]
+    for node_id in operation.get("remove") or []:
+        if node_id not in chart.nodes() or chart.node_subgraph(node_id) != subgraph:
+            raise PatchError(f"edit_subgraph: 节点 {node_id} 不在子图 {subgraph} 中")
+        _place_node(chart, _detach(chart, node_id), parent)
+
+    if operation.get("dissolve"):
+        # 解散子图，其内容归入上一层
+        info = chart.subgraphs()[subgraph]
+        header = chart.lines[info["start"]]
+        contents = chart.lines[info["start"] + 1:info["end"]]
+        extra = min((len(line.indent) - len(header.indent) for line in contents if line.kind != "blank"), default=0)
+        dedented = [
+            parse_line(line.raw[extra:]) if extra > 0 and line.raw[:extra].isspace() else line
+            for line in contents
+        ]
+        _splice(chart, info["start"], info["end"] - info["start"] + 1, dedented)
+        _remove_references(chart, subgraph)
+
+
+_HANDLERS = {
+    "add_node": _add_node,
+    "remove_node": _remove_node,
+    "rename_node": _rename_node,
+    "add_edge": _add_edge,
+    "remove_edge": _remove_edge,
+    "restyle": _restyle,
+    "edit_subgraph": _edit_subgraph,
+}
+
+
+def _edge_keys(chart: Flowchart) -> list[tuple]:
+    """连线的标识（同一连线重复出现时按出现次数区分），用于重新编号linkStyle"""
+    seen: Counter = Counter()
+    keys = []
+    for source, link, target in chart.edges():
+        key = (source, link.arrow, link.label, target)
+        keys.append((key, seen[key]))
+        seen[key] += 1
+    return keys
+
+
+def _renumber_link_styles(chart: Flowchart, before: list[tuple]) -> None:
+    """连线被删除或移动后，按连线的新位置更新linkStyle的编号，删除已不存在的连线的样式"""
+    after = {key: index for index, key in enumerate(_edge_keys(chart))}
+    for index in reversed(range(len(chart.lines))):
+        line = chart.lines[index]
+        if line.kind != "linkStyle" or line.target == "default":
+            continue
+        _, numbers, *rest = line.raw.split()
+        mapped = []
+        for number in numbers.split(","):
+            if number.isdigit() and int(number) < len(before) and before[int(number)] in after:
+                mapped.append(str(after[before[int(number)]]))
+        if mapped != numbers.split(","):
+            replacement = [parse_line(f"{line.indent}linkStyle {','.join(mapped)} {' '.join(rest)}")] if mapped else []
+            _splice(chart, index, 1, replacement)
+
+
+def apply_patch(diagram: str, operations: list[dict]) -> str:
+    """
+    在本地将编辑操作应用到图表上
+
+    未涉及的行保持原样；被修改的语句会展开为单独的节点定义和连线。
+
+    Args:
+        diagram: 原图的Mermaid代码
+        operations: parse_patch 返回的操作列表
+
+    Returns:
+        str: 修改后的Mermaid代码
+
+    Raises:
+        PatchError: 操作的目标不存在、参数无效，或应用后的图表出现新的语法错误
+    """
+    chart = parse_flowchart(diagram)
+    original_errors = len(chart.errors)
+    before = _edge_keys(chart)
+    for operation in operations:
+        try:
+            _HANDLERS[operation["op"]](chart, operation)
+        except PatchError:
+            raise
+        except Exception as e:
+            # 模型给出的字段类型不对（如数字形式的连线、列表形式的子图ID）
+            raise PatchError(f"{operation['op']}: 无效的参数 ({e})") from e
+    _renumber_link_styles(chart, before)
+
+    result = chart.render()
+    if len(parse_flowchart(result).errors) > original_errors:
+        raise PatchError("补丁导致图表出现语法错误")
+    if result == diagram:
+        raise PatchError("补丁没有修改图表")
+    return result
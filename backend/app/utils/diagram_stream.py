@@ -0,0 +1,220 @@
+from collections import Counter, deque
+from dotenv import load_dotenv
+import os
+import re
+import time
+
+from app.utils.mermaid_parser import diagram_type, parse_line
+from app.utils.mermaid_validator import repair_diagram, repair_statement
+
+load_dotenv()
+
+# 图表阶段的输出上限（行数、字符数、单行字符数和子图嵌套深度），超过时视为失控提前中止
+DIAGRAM_MAX_LINES = int(os.getenv("DIAGRAM_MAX_LINES", "400"))
+DIAGRAM_MAX_CHARS = int(os.getenv("DIAGRAM_MAX_CHARS", "30000"))
+DIAGRAM_MAX_LINE_CHARS = int(os.getenv("DIAGRAM_MAX_LINE_CHARS", "1000"))
+DIAGRAM_MAX_SUBGRAPH_DEPTH = int(os.getenv("DIAGRAM_MAX_SUBGRAPH_DEPTH", "8"))
+
+# 图表声明之前允许的说明文字行数，以及声明之后连续无法解析（也无法自动修复）的行数
+DIAGRAM_MAX_PREAMBLE_LINES = 3
+DIAGRAM_MAX_INVALID_RUN = 4
+
+# 重复检测：同一行连续出现的次数，以及由若干行组成的片段连续重复的次数
+DIAGRAM_MAX_REPEATS = 5
+DIAGRAM_MAX_PERIOD = 12
+DIAGRAM_PERIOD_REPEATS = 3
+
+# 同一行在整个图表中出现的最多次数
+DIAGRAM_MAX_DUPLICATES = 20
+
+# 图表阶段发送可渲染快照（diagram_snapshot事件）的最小间隔（秒），0表示不发送
+DIAGRAM_SNAPSHOT_INTERVAL = float(os.getenv("DIAGRAM_SNAPSHOT_INTERVAL", "1.0"))
+
+# 代码块标记行
+_FENCES = ("```", "```mermaid")
+
+# 在正常的图表中会多次出现的结构性语句（子图的 end 和 direction、注释），不计入同一行的出现次数
+_STRUCTURAL_PATTERN = re.compile(r"^(end|direction\s+\w+|%%.*)$")
+
+
+class DiagramStreamMonitor:
+    """
+    在图表阶段的流式输出上逐行检查，尽早发现失控的输出
+
+    - non_mermaid: 输出的是说明文字等而不是Mermaid代码
+    - repetition: 同一行或同一段落反复出现（生成陷入循环）
+    - budget: 行数、字符数或子图嵌套深度超过上限
+
+    只检查已完整的行；单个无法解析的行交给完成后的校验和修复处理。
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.chars = 0
+        self.lines = 0
+        self.flowchart: bool | None = None  # 尚未看到图表声明时为None
+        self.preamble = 0
+        self.invalid_run = 0
+        self.depth = 0
+        self.last_line = ""
+        self.repeats = 0
+        self.recent: deque[str] = deque(maxlen=DIAGRAM_MAX_PERIOD * DIAGRAM_PERIOD_REPEATS)
+        self.counts: Counter = Counter()
+        self.problem: dict | None = None
+
+    def feed(self, chunk: str) -> dict | None:
+        """
+        输入一个片段
+
+        Returns:
+            dict | None: 发现问题时返回 {"reason": 类型, "message": 说明}，之后不再检查
+        """
+        if self.problem is not None:
+            return self.problem
+        self.chars += len(chunk)
+        if self.chars > DIAGRAM_MAX_CHARS:
+            return self._fail("budget", f"图表输出超过 {DIAGRAM_MAX_CHARS} 个字符")
+        self.buffer += chunk
+        *complete, self.buffer = self.buffer.split("\n")
+        for raw in complete:
+            problem = self._check_line(raw)
+            if problem is not None:
+                return problem
+        if len(self.buffer) > DIAGRAM_MAX_LINE_CHARS:
+            return self._fail("budget", f"单行输出超过 {DIAGRAM_MAX_LINE_CHARS} 个字符")
+        return None
+
+    def _fail(self, reason: str, message: str) -> dict:
+        self.problem = {"reason": reason, "message": message}
+        return self.problem
+
+    def _check_line(self, raw: str) -> dict | None:
+        text = raw.strip()
+        if not text or text in _FENCES:
+            return None
+        self.lines += 1
+        if self.lines > DIAGRAM_MAX_LINES:
+            return self._fail("budget", f"图表超过 {DIAGRAM_MAX_LINES} 行")
+
+        if self.flowchart is None:
+            kind = diagram_type(text)
+            if kind is not None:
+                self.flowchart = kind == "flowchart"
+                return None
+            if parse_line(raw).kind != "statement":
+                if not text.startswith("%%"):
+                    self.preamble += 1
+                    if self.preamble > DIAGRAM_MAX_PREAMBLE_LINES:
+                        return self._fail("non_mermaid", "输出的不是Mermaid代码")
+                return None
+            # 缺少声明的流程图（完成后的校验会补上声明），该行按流程图的内容继续检查
+            self.flowchart = True
+
+        # 重复：同一行连续出现、同一段落连续重复，或同一行出现次数过多
+        if text == self.last_line and text != "end":
+            self.repeats += 1
+            if self.repeats >= DIAGRAM_MAX_REPEATS:
+                return self._fail("repetition", f"同一行连续重复 {self.repeats} 次: {text[:60]}")
+        else:
+            self.last_line, self.repeats = text, 1
+        self.recent.append(text)
+        for period in range(2, DIAGRAM_MAX_PERIOD + 1):
+            size = period * DIAGRAM_PERIOD_REPEATS
+            if len(self.recent) < size:
+                break
+            window = list(self.recent)[-size:]
+            if window[:period] * DIAGRAM_PERIOD_REPEATS == window and len(set(window[:period])) > 1:
+                return self._fail("repetition", f"{period} 行的片段连续重复 {DIAGRAM_PERIOD_REPEATS} 次")
+        if not _STRUCTURAL_PATTERN.match(text):
+            self.counts[text] += 1
+            if self.counts[text] > DIAGRAM_MAX_DUPLICATES:
+                return self._fail("repetition", f"同一行出现超过 {DIAGRAM_MAX_DUPLICATES} 次: {text[:60]}")
+
+        if not self.flowchart:
+            return None
+
+        line = parse_line(raw)
+        if line.kind == "subgraph":
+            self.depth += 1
+            if self.depth > DIAGRAM_MAX_SUBGRAPH_DEPTH:
+                return self._fail("budget", f"子图嵌套超过 {DIAGRAM_MAX_SUBGRAPH_DEPTH} 层")
+        elif line.kind == "end":
+            self.depth = max(self.depth - 1, 0)
+        if line.kind == "invalid" and repair_statement(line) is None:
+            self.invalid_run += 1
+            if self.invalid_run >= DIAGRAM_MAX_INVALID_RUN:
+                return self._fail("non_mermaid", f"连续 {self.invalid_run} 行不是有效的Mermaid代码")
+        else:
+            self.invalid_run = 0
+        return None
+
+
+def snapshot_diagram(text: str) -> str | None:
+    """
+    将流式输出的图表前缀整理为可以渲染的完整流程图
+
+    丢弃最后一个不完整的行、代码块标记和click事件（最终结果中会重新生成），
+    补全未闭合的子图，删除仍无法解析的行。
+
+    Args:
+        text: 目前为止收到的图表输出
+
+    Returns:
+        str | None: 可渲染的图表；还没有任何节点或不是流程图时返回None
+    """
+    complete = text[: text.rfind("\n") + 1]
+    lines = [raw for raw in complete.split("\n") if raw.strip() not in _FENCES]
+    if diagram_type("\n".join(lines)) != "flowchart":
+        return None
+    lines = [raw for raw in lines if parse_line(raw).kind != "click"]
+    for _ in range(2):
+        result = repair_diagram("\n".join(lines))
+        if not result["errors"]:
+            break
+        # 删除出错的行后再修复一次（例如删除出错的子图声明后需要重新配对end）
+        failed = {error["line"] for error in result["errors"]}
+        lines = [raw for number, raw in enumerate(result["diagram"].split("\n"), 1) if number not in failed]
+    else:
+        return None
+    diagram = result["diagram"].strip("\n")
+    if not any(parse_line(raw).kind == "statement" for raw in diagram.split("\n")):
+        return None
+    return diagram + "\n"
+
+
+class DiagramSnapshotter:
+    """
+    按时间间隔从流式输出中生成可渲染的快照，只在可渲染内容变化时返回新的快照
+    """
+
+    def __init__(self, interval: float = DIAGRAM_SNAPSHOT_INTERVAL):
+        self.interval = interval
+        self.reset()
+
+    def reset(self) -> None:
+        """丢弃已收到的输出（图表阶段重试时）"""
+        self.text = ""
+        self.checked = 0  # 上次检查时完整行的长度
+        self.checked_at = time.monotonic()
+        self.last: str | None = None
+
+    def feed(self, chunk: str) -> str | None:
+        """
+        输入一个片段
+
+        Returns:
+            str | None: 距上次检查已超过间隔、有新的完整行且可渲染内容发生变化时返回快照
+        """
+        self.text += chunk
+        if self.interval <= 0:
+            return None
+        complete = self.text.rfind("\n") + 1
+        now = time.monotonic()
+        if complete == self.checked or now - self.checked_at < self.interval:
+            return None
+        self.checked, self.checked_at = complete, now
+        snapshot = snapshot_diagram(self.text[:complete])
+        if snapshot is None or snapshot == self.last:
+            return None
+        self.last = snapshot
+        return snapshot
@@ -21,7 +21,13 @@ def format_user_message(data: dict[str, str]) -> str:
             parts.append(f"<component_mapping>\n{value}\n</component_mapping>")
         elif key == "instructions":
             parts.append(f"<instructions>\n{value}\n</instructions>")
+        elif key == "components":
+            parts.append(f"<components>\n{value}\n</components>")
         elif key == "diagram":
             parts.append(f"<diagram>\n{value}\n</diagram>")
+        elif key == "errors":
+            parts.append(f"<errors>\n{value}\n</errors>")
+        elif key == "partial_output":
+            parts.append(f"<partial_output>\n{value}\n</partial_output>")
 
     return "\n\n".join(parts)
@@ -0,0 +1,439 @@
+import re
+
+# 图表类型声明，如 `flowchart TD`、`graph LR`
+_HEADER_PATTERN = re.compile(r"^(flowchart|graph)(?:\s+(TB|TD|BT|RL|LR))?\s*;?$", re.IGNORECASE)
+
+# 其他Mermaid图表类型的声明（本模块只解析流程图）
+OTHER_DIAGRAM_TYPES = {
+    "sequencediagram", "classdiagram", "classdiagram-v2", "statediagram", "statediagram-v2",
+    "erdiagram", "journey", "gantt", "pie", "quadrantchart", "requirementdiagram", "gitgraph",
+    "c4context", "c4container", "c4component", "c4dynamic", "c4deployment", "mindmap", "timeline",
+    "sankey-beta", "xychart-beta", "block-beta", "architecture-beta", "packet-beta", "zenuml", "kanban",
+}
+
+# 节点ID：允许中间的连字符，但不能吞掉连线的开头（如 `A-->B` 中的 `--`）
+ID_PATTERN = re.compile(r"[A-Za-z0-9_](?:\w|-(?![-.=>]))*")
+
+# 节点形状的开闭括号，按开括号长度降序匹配
+SHAPES = [
+    ("(((", ")))"),
+    ("[[", "]]"),
+    ("[(", ")]"),
+    ("([", "])"),
+    ("((", "))"),
+    ("{{", "}}"),
+    ("[/", "/]"),
+    ("[\\", "\\]"),
+    ("[", "]"),
+    ("(", ")"),
+    ("{", "}"),
+    (">", "]"),
+]
+# 梯形等开闭斜杠不一致的形状
+ALT_CLOSES = {"[/": "\\]", "[\\": "/]"}
+# Mermaid 11 的节点元数据 `A@{ shape: rect, label: "X" }`：花括号中的内容作为标签原样保留
+METADATA_SHAPE = ("@{", "}")
+
+# 连线：-->、---、-.->、==>、--o、--x、<-->、~~~ 等
+LINK_ARROW = r"<?(?:-{2,}>|-{3,}|-{2,}[ox](?=[\s|])|-\.+->|-\.+-|={2,}>|={3,}|={2,}[ox](?=[\s|])|~{3,})"
+# 连线可带 |标签|
+_LINK_PATTERN = re.compile(rf"\s*(?P<arrow>{LINK_ARROW})\s*(?:\|(?P<label>[^|\n]*)\|)?\s*")
+# 文字写在连线中间的形式：`A -- 文字 --> B`
+_TEXT_LINK_PATTERN = re.compile(
+    r"\s*(?P<open><?(?:--|==|-\.))\s+(?P<label>[^\n]*?)\s+(?P<close>-{2,}>|-{3,}|={2,}>|={3,}|\.-+>|\.-)\s*"
+)
+_CLASS_SUFFIX_PATTERN = re.compile(r":::([\w\-]+)")
+_AMPERSAND_PATTERN = re.compile(r"\s*&\s*")
+
+# 以关键字开头的语句类型
+STATEMENT_KEYWORDS = {
+    "subgraph": "subgraph",
+    "end": "end",
+    "direction": "direction",
+    "click": "click",
+    "classdef": "classDef",
+    "class": "class",
+    "style": "style",
+    "linkstyle": "linkStyle",
+}
+
+# 不能用作节点ID的关键字
+RESERVED_IDS = {"end", "subgraph", "graph", "flowchart", "click", "class", "classdef", "style", "linkstyle", "direction"}
+
+
+class FlowNode:
+    """语句中的一个节点引用，shape为None时表示不带标签的引用"""
+
+    __slots__ = ("id", "shape", "label", "quoted", "cls")
+
+    def __init__(self, node_id: str, shape: tuple[str, str] | None = None, label: str | None = None,
+                 quoted: bool = False, cls: str | None = None):
+        self.id = node_id
+        self.shape = shape
+        self.label = label
+        self.quoted = quoted
+        self.cls = cls
+
+    def render(self) -> str:
+        text = self.id
+        if self.shape is not None:
+            label = f'"{self.label}"' if self.quoted else self.label
+            text += f"{self.shape[0]}{label}{self.shape[1]}"
+        if self.cls:
+            text += f":::{self.cls}"
+        return text
+
+
+class FlowLink:
+    """两组节点之间的连线，label为 |...| 中的原始文本（可能带引号）"""
+
+    __slots__ = ("arrow", "label")
+
+    def __init__(self, arrow: str, label: str | None = None):
+        self.arrow = arrow
+        self.label = label
+
+    def render(self) -> str:
+        return f" {self.arrow}|{self.label}| " if self.label is not None else f" {self.arrow} "
+
+
+class FlowLine:
+    """
+    图表中的一行
+
+    kind为 blank、comment、header、subgraph、end、direction、click、classDef、class、style、
+    linkStyle、statement（节点定义或连线）或 invalid（无法解析，原因见error）。
+    """
+
+    __slots__ = ("kind", "raw", "indent", "groups", "links", "target", "label", "error", "subgraph")
+
+    def __init__(self, kind: str, raw: str, indent: str = ""):
+        self.kind = kind
+        self.raw = raw
+        self.indent = indent
+        self.groups: list[list[FlowNode]] = []
+        self.links: list[FlowLink] = []
+        self.target: str | None = None  # 子图ID，或click/style/class等语句的目标
+        self.label: str | None = None  # 子图标题
+        self.error: str | None = None
+        self.subgraph: str | None = None  # 所在的（最内层）子图ID，由Flowchart.reindex设置
+
+    def node_ids(self) -> list[str]:
+        """语句中出现的所有节点ID（按出现顺序，不去重）"""
+        return [node.id for group in self.groups for node in group]
+
+    def edges(self) -> list[tuple[str, FlowLink, str]]:
+        """语句展开后的 (起点, 连线, 终点) 列表，`A & B --> C` 展开为两条"""
+        edges = []
+        for i, link in enumerate(self.links):
+            for source in self.groups[i]:
+                for target in self.groups[i + 1]:
+                    edges.append((source.id, link, target.id))
+        return edges
+
+    def render_statement(self) -> str:
+        text = " & ".join(node.render() for node in self.groups[0])
+        for link, group in zip(self.links, self.groups[1:]):
+            text += link.render() + " & ".join(node.render() for node in group)
+        return self.indent + text
+
+
+def _metadata_end(text: str, start: int) -> int:
+    """返回节点元数据的结束花括号位置（跳过引号中的花括号），没有时返回-1"""
+    quoted = False
+    for i in range(start, len(text)):
+        if text[i] == '"':
+            quoted = not quoted
+        elif text[i] == "}" and not quoted:
+            return i
+    return -1
+
+
+def _parse_node(text: str, pos: int) -> tuple[FlowNode | None, int, str | None]:
+    """从pos处解析一个节点引用，返回 (节点, 结束位置, 错误)"""
+    match = ID_PATTERN.match(text, pos)
+    if not match:
+        return None, pos, None
+    node = FlowNode(match.group(0))
+    pos = match.end()
+
+    if text.startswith(METADATA_SHAPE[0], pos):
+        end = _metadata_end(text, pos + len(METADATA_SHAPE[0]))
+        if end == -1:
+            return None, pos, f"节点 {node.id} 的元数据缺少 }}"
+        node.shape = METADATA_SHAPE
+        node.label = text[pos + len(METADATA_SHAPE[0]):end]
+        pos = end + 1
+    else:
+        for open_bracket, close_bracket in SHAPES:
+            if not text.startswith(open_bracket, pos):
+                continue
+            start = pos + len(open_bracket)
+            closes = [close_bracket] + ([ALT_CLOSES[open_bracket]] if open_bracket in ALT_CLOSES else [])
+            inner = text[start:]
+            stripped = inner.lstrip()
+            if stripped.startswith('"'):
+                quote_start = start + len(inner) - len(stripped)
+                quote_end = text.find('"', quote_start + 1)
+                if quote_end == -1:
+                    return None, pos, f"节点 {node.id} 的标签缺少结束引号"
+                after = quote_end + 1
+                after += len(text[after:]) - len(text[after:].lstrip())
+                close = next((c for c in closes if text.startswith(c, after)), None)
+                if close is None:
+                    return None, pos, f"节点 {node.id} 的标签后缺少 {close_bracket}"
+                node.shape = (open_bracket, close)
+                node.label = text[quote_start + 1:quote_end]
+                node.quoted = True
+                pos = after + len(close)
+            else:
+                found = [(text.find(c, start), c) for c in closes if text.find(c, start) != -1]
+                if not found:
+                    return None, pos, f"节点 {node.id} 的标签缺少 {close_bracket}"
+                end, close = min(found)
+                node.shape = (open_bracket, close)
+                node.label = text[start:end]
+                pos = end + len(close)
+            break
+
+    match = _CLASS_SUFFIX_PATTERN.match(text, pos)
+    if match:
+        node.cls = match.group(1)
+        pos = match.end()
+    return node, pos, None
+
+
+def _parse_group(text: str, pos: int) -> tuple[list[FlowNode], int, str | None]:
+    """解析 `A & B & C` 形式的节点组"""
+    group = []
+    while True:
+        pos += len(text[pos:]) - len(text[pos:].lstrip())
+        node, pos, error = _parse_node(text, pos)
+        if error:
+            return group, pos, error
+        if node is None:
+            return group, pos, "缺少节点" if group else None
+        group.append(node)
+        match = _AMPERSAND_PATTERN.match(text, pos)
+        if not match:
+            return group, pos, None
+        pos = match.end()
+
+
+def _parse_statement(line: FlowLine, text: str) -> None:
+    groups, pos, error = _parse_group(text, 0)
+    if error or not groups:
+        line.kind, line.error = "invalid", error or "无法识别的语句"
+        return
+    line.groups.append(groups)
+    while pos < len(text):
+        match = _LINK_PATTERN.match(text, pos)
+        if match:
+            link = FlowLink(match.group("arrow"), match.group("label"))
+        else:
+            match = _TEXT_LINK_PATTERN.match(text, pos)
+            if not match:
+                break
+            # 规范化为 |标签| 形式的连线：`-. 文字 .->` 对应 `-.->`
+            close = match.group("close")
+            arrow = "-" + close if close.startswith(".") else close
+            if match.group("open").startswith("<"):
+                arrow = "<" + arrow
+            link = FlowLink(arrow, match.group("label"))
+        pos = match.end()
+        groups, pos, error = _parse_group(text, pos)
+        if error or not groups:
+            line.kind, line.error = "invalid", error or "连线缺少终点节点"
+            return
+        line.links.append(link)
+        line.groups.append(groups)
+    rest = text[pos:].strip()
+    if rest and rest != ";":
+        line.kind, line.error = "invalid", f"无法解析的内容: {rest[:40]}"
+
+
+def _parse_subgraph_title(line: FlowLine, rest: str) -> None:
+    rest = rest.strip()
+    # 子图声明不能带 :::样式类（Mermaid会报错），记录错误后按不带样式类解析
+    match = re.search(r"\s*:::([\w\-]+)\s*$", rest)
+    if match:
+        line.error = f"子图声明不能使用 :::{match.group(1)}"
+        rest = rest[: match.start()]
+    # `subgraph ID [标题]`：ID与标题之间允许空格
+    rest = re.sub(r"^([\w\-]+)\s+(\[.*\])$", r"\1\2", rest)
+    node, pos, error = _parse_node(rest, 0) if rest else (None, 0, None)
+    if node is not None and not error and pos == len(rest):
+        line.target = node.id
+        line.label = node.label if node.shape is not None else None
+    elif rest.startswith('"') and rest.endswith('"') and len(rest) > 1:
+        # `subgraph "标题"`：标题同时作为ID
+        line.target = line.label = rest[1:-1]
+    elif rest:
+        line.target = line.label = rest
+    else:
+        line.kind, line.error = "invalid", "子图缺少标题"
+
+
+def parse_line(raw: str) -> FlowLine:
+    """解析图表中的一行（不含换行符）"""
+    stripped = raw.strip()
+    line = FlowLine("statement", raw, raw[: len(raw) - len(raw.lstrip())])
+    if not stripped:
+        line.kind = "blank"
+        return line
+    if stripped.startswith("%%"):
+        line.kind = "comment"
+        return line
+    if _HEADER_PATTERN.match(stripped):
+        line.kind = "header"
+        return line
+
+    first, _, rest = stripped.partition(" ")
+    keyword = STATEMENT_KEYWORDS.get(first.lower().rstrip(";"))
+    if keyword == "end" and not rest:
+        line.kind = "end"
+        return line
+    if keyword == "subgraph":
+        line.kind = "subgraph"
+        _parse_subgraph_title(line, rest)
+        return line
+    if keyword in ("direction", "click", "classDef", "style", "linkStyle"):
+        line.kind = keyword
+        line.target = rest.split(None, 1)[0] if rest.strip() else None
+        if line.target is None:
+            line.kind, line.error = "invalid", f"{keyword} 语句不完整"
+        return line
+    if keyword == "class":
+        line.kind = "class"
+        parts = rest.split()
+        if len(parts) < 2:
+            line.kind, line.error = "invalid", "class 语句不完整"
+        else:
+            line.target = parts[0]
+        return line
+
+    _parse_statement(line, stripped)
+    return line
+
+
+class Flowchart:
+    """
+    按行解析的Mermaid流程图
+
+    未修改的行按原文输出，修改过的行重新生成，因此对图表的局部修改只改变相关的行。
+    """
+
+    def __init__(self, lines: list[FlowLine]):
+        self.lines = lines
+        self.errors: list[tuple[int, str]] = []
+        self.reindex()
+
+    def reindex(self) -> None:
+        """重新计算各行所在的子图，并检查子图的开闭是否配对"""
+        self.errors = []
+        stack: list[str] = []
+        seen_header = False
+        for number, line in enumerate(self.lines):
+            if line.kind == "header":
+                if seen_header:
+                    self.errors.append((number, "重复的图表类型声明"))
+                seen_header = True
+            elif line.kind not in ("blank", "comment") and not seen_header:
+                self.errors.append((number, "缺少 flowchart/graph 声明"))
+                seen_header = True
+            if line.kind == "subgraph":
+                line.subgraph = stack[-1] if stack else None
+                stack.append(line.target or "")
+                if line.error:
+                    self.errors.append((number, line.error))
+                continue
+            if line.kind == "end":
+                if not stack:
+                    self.errors.append((number, "多余的 end"))
+                    line.subgraph = None
+                else:
+                    line.subgraph = stack.pop()
+                continue
+            line.subgraph = stack[-1] if stack else None
+            if line.kind == "invalid":
+                self.errors.append((number, line.error or "无法解析"))
+        for subgraph in stack:
+            self.errors.append((len(self.lines), f"子图 {subgraph} 缺少 end"))
+
+    def render(self) -> str:
+        return "\n".join(line.raw for line in self.lines)
+
+    def statements(self) -> list[tuple[int, FlowLine]]:
+        return [(i, line) for i, line in enumerate(self.lines) if line.kind == "statement"]
+
+    def nodes(self) -> dict[str, FlowNode]:
+        """节点ID到其定义的映射（优先取带标签的首次出现）"""
+        nodes: dict[str, FlowNode] = {}
+        for _, line in self.statements():
+            for group in line.groups:
+                for node in group:
+                    current = nodes.get(node.id)
+                    if current is None or (current.shape is None and node.shape is not None):
+                        nodes[node.id] = node
+        return nodes
+
+    def edges(self) -> list[tuple[str, FlowLink, str]]:
+        """按出现顺序的全部连线（与linkStyle的编号一致）"""
+        return [edge for _, line in self.statements() for edge in line.edges()]
+
+    def subgraphs(self) -> dict[str, dict]:
+        """子图ID到 {"label", "parent", "start", "end"} 的映射，start/end为行号"""
+        subgraphs: dict[str, dict] = {}
+        stack: list[str] = []
+        for number, line in enumerate(self.lines):
+            if line.kind == "subgraph" and line.target:
+                subgraphs[line.target] = {
+                    "label": line.label,
+                    "parent": stack[-1] if stack else None,
+                    "start": number,
+                    "end": None,
+                }
+                stack.append(line.target)
+            elif line.kind == "end" and stack:
+                subgraphs[stack.pop()]["end"] = number
+        return subgraphs
+
+    def node_subgraph(self, node_id: str) -> str | None:
+        """
+        节点所在的子图
+
+        与Mermaid一致：节点属于提及它的子图中最先闭合（end最靠前）的一个，顶层的提及不影响归属。
+        """
+        subgraphs = self.subgraphs()
+        owners = {
+            line.subgraph
+            for _, line in self.statements()
+            if line.subgraph in subgraphs and node_id in line.node_ids()
+        }
+        return min(owners, key=lambda s: subgraphs[s]["end"] or len(self.lines), default=None)
+
+
+def diagram_type(diagram: str) -> str | None:
+    """
+    图表类型：流程图返回 "flowchart"，其他类型返回其声明关键字（小写），找不到声明时返回None
+    """
+    for raw in diagram.split("\n"):
+        first = raw.strip().split(None, 1)[0].lower() if raw.strip() else ""
+        if _HEADER_PATTERN.match(raw.strip()):
+            return "flowchart"
+        if first.rstrip(":;") in OTHER_DIAGRAM_TYPES:
+            return first.rstrip(":;")
+    return None
+
+
+def parse_flowchart(diagram: str) -> Flowchart:
+    """
+    将Mermaid流程图解析为按行的模型
+
+    Args:
+        diagram: Mermaid代码（不含代码块标记）
+
+    Returns:
+        Flowchart: 解析结果，无法解析的行和子图配对错误记录在errors中
+    """
+    return Flowchart([parse_line(raw) for raw in diagram.split("\n")])
@@ -0,0 +1,285 @@
+import re
+
+from app.utils.mermaid_parser import (
+    ALT_CLOSES,
+    ID_PATTERN,
+    LINK_ARROW,
+    METADATA_SHAPE,
+    SHAPES,
+    STATEMENT_KEYWORDS,
+    FlowLine,
+    diagram_type,
+    parse_flowchart,
+    parse_line,
+)
+
+# 未加引号时会导致Mermaid解析失败的标签字符
+_SPECIAL_LABEL_PATTERN = re.compile(r'[()\[\]{}<>|";@]')
+
+# 按连线拆分语句（连线两侧需有空格，避免拆开标签中的文字）
+_LINK_SPLIT_PATTERN = re.compile(rf"(\s+{LINK_ARROW}\s*(?:\|[^|\n]*\|)?\s+)")
+
+# 宽松的节点定义：标签取开括号到行尾最后一个闭括号之间的全部内容
+_LOOSE_NODE_PATTERN = re.compile(
+    r"^(?P<id>[A-Za-z0-9_][\w\-]*)\s*(?P<open>"
+    + "|".join(re.escape(open_bracket) for open_bracket, _ in SHAPES)
+    + r")(?P<label>.*)(?P<close>"
+    + "|".join(re.escape(close) for close in sorted({c for _, c in SHAPES} | set(ALT_CLOSES.values()), key=len, reverse=True))
+    + r")(?P<cls>:::[\w\-]+)?$"
+)
+
+# 放在图表末尾的语句
+_TRAILING_KINDS = ("click", "classDef", "class", "style", "linkStyle")
+
+
+def _quote_label(label: str) -> str:
+    label = label.strip()
+    if len(label) >= 2 and label.startswith('"') and label.endswith('"'):
+        label = label[1:-1]
+    return '"' + label.replace('"', "#quot;") + '"'
+
+
+def _repair_node(segment: str) -> str | None:
+    if ID_PATTERN.fullmatch(segment):
+        return segment
+    match = _LOOSE_NODE_PATTERN.match(segment)
+    if not match:
+        return None
+    open_bracket, close = match.group("open"), match.group("close")
+    closes = dict(SHAPES)
+    if close != closes[open_bracket] and close != ALT_CLOSES.get(open_bracket):
+        return None
+    return f"{match.group('id')}{open_bracket}{_quote_label(match.group('label'))}{close}{match.group('cls') or ''}"
+
+
+def repair_statement(line: FlowLine) -> str | None:
+    """
+    重新解析无法解析的语句：标签取括号之间的全部内容并加上引号
+
+    Returns:
+        str | None: 修复后的行，无法修复时返回None
+    """
+    text = line.raw.strip().rstrip(";")
+    rebuilt = []
+    for i, part in enumerate(_LINK_SPLIT_PATTERN.split(text)):
+        if i % 2:
+            rebuilt.append(" " + part.strip() + " ")
+            continue
+        node = _repair_node(part.strip())
+        if node is None:
+            # 可能是 `A & B` 形式的节点组
+            nodes = [_repair_node(segment.strip()) for segment in part.split("&")]
+            if any(node is None for node in nodes):
+                return None
+            node = " & ".join(nodes)
+        rebuilt.append(node)
+    candidate = line.indent + "".join(rebuilt)
+    return candidate if parse_line(candidate).kind == "statement" else None
+
+
+def _quote_special_labels(line: FlowLine) -> str | None:
+    """为含特殊字符的节点标签和连线标签加上引号，没有需要修改的标签时返回None"""
+    changed = False
+    for group in line.groups:
+        for node in group:
+            if node.shape in (None, METADATA_SHAPE) or node.quoted:
+                continue
+            if _SPECIAL_LABEL_PATTERN.search(node.label or ""):
+                node.label = _quote_label(node.label)[1:-1]
+                node.quoted = changed = True
+    for link in line.links:
+        label = (link.label or "").strip()
+        if label and not (label.startswith('"') and label.endswith('"')) and _SPECIAL_LABEL_PATTERN.search(label):
+            link.label = _quote_label(label)
+            changed = True
+    return line.render_statement() if changed else None
+
+
+def _safe_id(name: str, taken: set[str]) -> str:
+    base = re.sub(r"\W", "_", name).strip("_") or "group"
+    candidate = base
+    suffix = 2
+    while candidate in taken:
+        candidate = f"{base}_{suffix}"
+        suffix += 1
+    return candidate
+
+
+def repair_diagram(diagram: str) -> dict:
+    """
+    校验Mermaid流程图并自动修复常见问题（其他类型的图表原样返回）
+
+    可以修复的问题：图表前的说明文字、缺少的图表类型声明、未加引号的含特殊字符的标签、
+    多余或缺少的子图 end、重复的子图ID（以及与节点同名的子图）、指向不存在节点的click事件。
+
+    Args:
+        diagram: Mermaid代码（已去除代码块标记）
+
+    Returns:
+        dict: 修复后的图表 diagram、修复说明 repairs，以及仍无法解析的行 errors
+            （每项为 {"line": 行号（从1开始）, "text": 该行, "error": 原因}）
+    """
+    if diagram_type(diagram) not in ("flowchart", None):
+        # 时序图、类图等其他类型不做校验
+        return {"diagram": diagram, "repairs": [], "errors": []}
+
+    lines = [parse_line(raw) for raw in diagram.strip("\n").split("\n")]
+    repairs: list[str] = []
+
+    # 图表类型声明之前的说明文字
+    header = next((i for i, line in enumerate(lines) if line.kind == "header"), None)
+    if header is None:
+        lines.insert(0, parse_line("flowchart TD"))
+        repairs.append("添加缺少的 flowchart 声明")
+    elif any(line.kind not in ("blank", "comment") for line in lines[:header]):
+        lines = lines[header:]
+        repairs.append("删除图表之前的说明文字")
+    for i in reversed(range(1, len(lines))):
+        if lines[i].kind == "header":
+            del lines[i]
+            repairs.append("删除重复的图表类型声明")
+
+    # 标签
+    for i, line in enumerate(lines):
+        if line.kind == "invalid" and line.raw.split()[0].lower() not in STATEMENT_KEYWORDS:
+            fixed = repair_statement(line)
+            if fixed is not None:
+                lines[i] = parse_line(fixed)
+                repairs.append(f"第{i + 1}行: 修复节点标签")
+                line = lines[i]
+        if line.kind == "statement":
+            fixed = _quote_special_labels(line)
+            if fixed is not None:
+                lines[i] = parse_line(fixed)
+                repairs.append(f"第{i + 1}行: 为含特殊字符的标签加上引号")
+
+    # 子图的开闭配对
+    opened: list[FlowLine] = []
+    kept = []
+    for line in lines:
+        if line.kind == "subgraph":
+            opened.append(line)
+        elif line.kind == "end":
+            if not opened:
+                repairs.append("删除多余的 end")
+                continue
+            opened.pop()
+        kept.append(line)
+    lines = kept
+    if opened:
+        index = len(lines)
+        while index > 0 and (lines[index - 1].kind in _TRAILING_KINDS or lines[index - 1].kind == "blank"):
+            index -= 1
+        closing = [parse_line(f"{line.indent}end") for line in reversed(opened)]
+        lines[index:index] = closing
+        repairs.append(f"补全 {len(closing)} 个缺少的子图 end")
+
+    # 重复的子图ID、与节点同名的子图，以及子图声明上的样式类（改为单独的class语句）
+    chart = parse_flowchart("\n".join(line.raw for line in lines))
+    node_ids = set(chart.nodes())
+    taken = node_ids | {line.target for line in chart.lines if line.kind == "subgraph" and line.target}
+    seen: set[str] = set()
+    class_lines = []
+    for i, line in enumerate(chart.lines):
+        if line.kind != "subgraph" or not line.target:
+            continue
+        subgraph_id = line.target
+        class_match = re.search(r":::([\w\-]+)\s*$", line.raw)
+        if line.target in seen or line.target in node_ids:
+            subgraph_id = _safe_id(line.target, taken)
+            repairs.append(f"第{i + 1}行: 子图ID {line.target} 重复，改为 {subgraph_id}")
+        elif class_match and not ID_PATTERN.fullmatch(subgraph_id):
+            # class语句需要能引用的子图ID
+            subgraph_id = _safe_id(line.target, taken)
+        taken.add(subgraph_id)
+        if class_match:
+            class_lines.append(f"class {subgraph_id} {class_match.group(1)}")
+            repairs.append(f"第{i + 1}行: 将子图声明上的样式类改为class语句")
+        if subgraph_id != line.target or class_match:
+            label = line.label if line.label is not None else line.target
+            chart.lines[i] = parse_line(f"{line.indent}subgraph {subgraph_id}[{_quote_label(label)}]")
+        seen.add(line.target)
+    if class_lines:
+        indent = next(
+            (line.indent for line in chart.lines if line.kind in ("statement", "subgraph") and line.subgraph is None),
+            "    ",
+        )
+        end = len(chart.lines)
+        while end > 0 and chart.lines[end - 1].kind == "blank":
+            end -= 1
+        chart.lines[end:end] = [parse_line(indent + text) for text in class_lines]
+
+    # 指向不存在的节点的click事件，以及同一节点的重复click事件
+    targets = node_ids | set(chart.subgraphs())
+    clicked: set[str] = set()
+    kept = []
+    for line in chart.lines:
+        if line.kind == "click":
+            if line.target not in targets:
+                repairs.append(f"删除指向不存在节点 {line.target} 的click事件")
+                continue
+            if line.target in clicked:
+                repairs.append(f"删除节点 {line.target} 的重复click事件")
+                continue
+            clicked.add(line.target)
+        kept.append(line)
+    chart.lines = kept
+    chart.reindex()
+
+    return {
+        # 错误的行号按整理后的行计算，即使没有修复也返回整理后的文本，使行号与返回的图表一致
+        "diagram": chart.render() + "\n",
+        "repairs": repairs,
+        "errors": [
+            {
+                "line": number + 1,
+                "text": chart.lines[number].raw if number < len(chart.lines) else "",
+                "error": error,
+            }
+            for number, error in chart.errors
+        ],
+    }
+
+
+def format_diagram_errors(diagram: str, errors: list[dict]) -> str:
+    """
+    生成修正请求的错误上下文：每个错误行的行号、内容、原因及其前后各一行
+
+    Returns:
+        str: 发送给模型的 <errors> 内容（不包含图表的其余部分）
+    """
+    lines = diagram.split("\n")
+    blocks = []
+    for error in errors:
+        number = error["line"]
+        context = [
+            f"{n}: {lines[n - 1]}" for n in (number - 1, number + 1) if 1 <= n <= len(lines)
+        ]
+        blocks.append(
+            f"Line {number}: {error['text']}\nError: {error['error']}"
+            + ("\nContext:\n" + "\n".join(context) if context else "")
+        )
+    return "\n\n".join(blocks)
+
+
+def apply_line_fixes(diagram: str, errors: list[dict], response: str) -> str:
+    """
+    将模型返回的 `行号: 修正后的行` 应用到图表上，只替换出错的行
+
+    同一行号出现多次时替换为多行，行号后为空时删除该行。
+    """
+    lines = diagram.split("\n")
+    allowed = {error["line"] for error in errors}
+    fixes: dict[int, list[str]] = {}
+    for match in re.finditer(r"^\s*(\d+):[ \t]?(.*)$", response, re.MULTILINE):
+        number = int(match.group(1))
+        if number in allowed and number <= len(lines):
+            fixes.setdefault(number, []).append(match.group(2).rstrip())
+    for number in sorted(fixes, reverse=True):
+        original = lines[number - 1]
+        indent = original[: len(original) - len(original.lstrip())]
+        replacement = [
+            text if text[:1].isspace() else indent + text for text in fixes[number] if text.strip()
+        ]
+        lines[number - 1:number] = replacement
+    return "\n".join(lines)
@@ -0,0 +1,129 @@
+import os
+
+from dotenv import load_dotenv
+
+from app.utils.format_message import format_user_message
+
+load_dotenv()
+
+# 是否按提示缓存友好的方式组织请求（大段静态内容放在最前面并标记缓存断点）
+PROMPT_CACHE_ENABLED = os.getenv("PROMPT_CACHE_ENABLED", "true").lower() == "true"
+
+# 在多个阶段和多次生成之间保持不变的大段内容，按固定顺序组成共享前缀
+CACHEABLE_KEYS = ("file_tree", "readme")
+
+# 共享前缀之后没有其他用户内容时使用的占位消息
+CONTEXT_ONLY_USER_MESSAGE = "Complete the task using the repository context provided above."
+
+
+def split_prompt_data(data: dict) -> tuple[list[str], str]:
+    """
+    将用户消息变量拆分为可缓存的静态上下文块和每个阶段不同的动态消息
+
+    静态块按CACHEABLE_KEYS的固定顺序排列（与data中的键顺序无关），
+    使文件树在阶段1、阶段2以及重复生成之间形成相同的前缀。
+
+    Args:
+        data: 用于格式化用户消息的变量字典
+
+    Returns:
+        tuple[list[str], str]: (静态上下文块列表, 动态用户消息)
+    """
+    if not PROMPT_CACHE_ENABLED:
+        return [], format_user_message(data)
+
+    context_blocks = [
+        format_user_message({key: data[key]})
+        for key in CACHEABLE_KEYS
+        if data.get(key)
+    ]
+    dynamic = {
+        key: value
+        for key, value in data.items()
+        if key not in CACHEABLE_KEYS and value
+    }
+    user_message = format_user_message(dynamic) if dynamic else ""
+    if context_blocks and not user_message:
+        user_message = CONTEXT_ONLY_USER_MESSAGE
+    return context_blocks, user_message
+
+
+def build_anthropic_system(system_prompt: str, context_blocks: list[str]) -> str | list[dict]:
+    """
+    构造Anthropic Messages API的system字段
+
+    静态上下文块排在阶段提示之前，每块末尾设置一个 `cache_control` 断点
+    （最多使用前3个，API限制为4个）；阶段提示不同的请求仍可复用前面的缓存。
+    """
+    if not context_blocks:
+        return system_prompt
+    blocks: list[dict] = [{"type": "text", "text": block} for block in context_blocks]
+    for block in blocks[:3]:
+        block["cache_control"] = {"type": "ephemeral"}
+    blocks.append({"type": "text", "text": system_prompt})
+    return blocks
+
+
+def build_chat_messages(system_prompt: str, data: dict) -> list[dict]:
+    """
+    构造OpenAI兼容接口的messages（提供方按前缀自动缓存）
+
+    静态上下文作为第一条system消息，其后才是阶段提示和动态内容。
+    """
+    context_blocks, user_message = split_prompt_data(data)
+    messages = []
+    if context_blocks:
+        messages.append({"role": "system", "content": "\n\n".join(context_blocks)})
+    messages.append({"role": "system", "content": system_prompt})
+    messages.append({"role": "user", "content": user_message})
+    return messages
+
+
+def normalize_usage(usage: dict | None) -> dict:
+    """
+    将各提供方的usage字段统一为相同的键
+
+    支持Anthropic（cache_read_input_tokens / cache_creation_input_tokens）、
+    OpenAI（prompt_tokens_details.cached_tokens）和DeepSeek（prompt_cache_hit_tokens）。
+
+    Returns:
+        dict: input_tokens（含缓存部分）、output_tokens、cached_tokens、cache_write_tokens
+    """
+    usage = usage or {}
+    if "prompt_tokens" in usage or "completion_tokens" in usage:
+        details = usage.get("prompt_tokens_details") or {}
+        cached = details.get("cached_tokens") or usage.get("prompt_cache_hit_tokens") or 0
+        return {
+            "input_tokens": usage.get("prompt_tokens") or 0,
+            "output_tokens": usage.get("completion_tokens") or 0,
+            "cached_tokens": cached,
+            "cache_write_tokens": 0,
+        }
+
+    # Anthropic的input_tokens不包含缓存读取/写入的部分
+    cached = usage.get("cache_read_input_tokens") or 0
+    written = usage.get("cache_creation_input_tokens") or 0
+    return {
+        "input_tokens": (usage.get("input_tokens") or 0) + cached + written,
+        "output_tokens": usage.get("output_tokens") or 0,
+        "cached_tokens": cached,
+        "cache_write_tokens": written,
+    }
+
+
+def merge_usage(records: list[dict]) -> dict:
+    """
+    汇总多次调用的用量
+
+    Returns:
+        dict: 各项令牌数之和、调用次数 calls 和缓存命中率 cache_hit_ratio
+    """
+    total = {"input_tokens": 0, "output_tokens": 0, "cached_tokens": 0, "cache_write_tokens": 0}
+    for record in records:
+        for key in total:
+            total[key] += record.get(key, 0)
+    total["calls"] = len(records)
+    total["cache_hit_ratio"] = (
+        round(total["cached_tokens"] / total["input_tokens"], 3) if total["input_tokens"] else 0.0
+    )
+    return total
@@ -0,0 +1,242 @@
+import hashlib
+import re
+from collections import OrderedDict
+from typing import Callable
+
+# 与架构相关的章节标题关键词（加分）
+RELEVANT_HEADING_KEYWORDS = [
+    "architecture",
+    "overview",
+    "design",
+    "structure",
+    "component",
+    "module",
+    "how it works",
+    "internals",
+    "features",
+    "about",
+    "introduction",
+    "tech stack",
+    "stack",
+    "concepts",
+    "usage",
+    "api",
+    "架构",
+    "概述",
+    "简介",
+    "设计",
+    "结构",
+    "功能",
+]
+
+# 与架构无关的章节标题关键词（减分）
+BOILERPLATE_HEADING_KEYWORDS = [
+    "changelog",
+    "change log",
+    "release",
+    "history",
+    "license",
+    "contributor",
+    "contributing",
+    "sponsor",
+    "backers",
+    "acknowledg",
+    "credits",
+    "thanks",
+    "donate",
+    "funding",
+    "support",
+    "faq",
+    "citation",
+    "install",
+    "badge",
+    "star history",
+    "code of conduct",
+    "更新日志",
+    "许可",
+    "贡献",
+    "赞助",
+    "安装",
+]
+
+_FENCE_PATTERN = re.compile(r"^(```|~~~)")
+_HEADING_PATTERN = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+_NOISE_PATTERNS = [
+    # HTML注释
+    re.compile(r"<!--.*?-->", re.DOTALL),
+    # 链接包裹的徽章/图片: [![alt](img)](link)
+    re.compile(r"\[!\[[^\]]*\]\([^)]*\)\]\([^)]*\)"),
+    # 图片: ![alt](src)
+    re.compile(r"!\[[^\]]*\]\([^)]*\)"),
+    # 引用式图片: ![alt][ref]
+    re.compile(r"!\[[^\]]*\]\[[^\]]*\]"),
+    # 徽章链接的引用定义
+    re.compile(r"^\s*\[[^\]]+\]:\s*\S*(shields\.io|badge|badgen)\S*.*$", re.MULTILINE | re.IGNORECASE),
+    # HTML标签（保留标签内的文本）
+    re.compile(r"</?[a-zA-Z][^>]*>"),
+]
+
+# README裁剪结果缓存，键为 (README blob哈希, 令牌预算, 分词器)：不同平台/模型的令牌数不同
+_TRIM_CACHE_SIZE = 256
+_trim_cache: "OrderedDict[tuple[str, int, str], dict]" = OrderedDict()
+
+
+def readme_blob_hash(readme: str) -> str:
+    """计算README内容的git blob哈希（与`git hash-object`一致）"""
+    content = readme.encode("utf-8")
+    header = f"blob {len(content)}\0".encode("utf-8")
+    return hashlib.sha1(header + content).hexdigest()
+
+
+def strip_readme_noise(readme: str) -> str:
+    """去除徽章、图片、HTML标签和注释等噪声（代码块内容保持不变）"""
+    segments = re.split(r"(^(?:```|~~~).*?^(?:```|~~~)[^\n]*$)", readme, flags=re.MULTILINE | re.DOTALL)
+    cleaned = []
+    for i, segment in enumerate(segments):
+        # 奇数下标为代码块
+        if i % 2 == 0:
+            for pattern in _NOISE_PATTERNS:
+                segment = pattern.sub("", segment)
+        cleaned.append(segment)
+    text = "".join(cleaned)
+    # 删除只剩空白的行，并压缩多余空行
+    text = re.sub(r"[ \t]+$", "", text, flags=re.MULTILINE)
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+
+def parse_sections(readme: str) -> list[dict]:
+    """
+    将markdown按ATX标题拆分为章节
+
+    Returns:
+        list[dict]: 每个章节包含 heading、level、text（含标题行）
+    """
+    sections = [{"heading": "", "level": 0, "lines": []}]
+    in_fence = False
+    for line in readme.split("\n"):
+        if _FENCE_PATTERN.match(line.strip()):
+            in_fence = not in_fence
+        match = None if in_fence else _HEADING_PATTERN.match(line)
+        if match:
+            sections.append(
+                {"heading": match.group(2), "level": len(match.group(1)), "lines": []}
+            )
+        sections[-1]["lines"].append(line)
+    return [
+        {
+            "heading": section["heading"],
+            "level": section["level"],
+            "text": "\n".join(section["lines"]).strip(),
+        }
+        for section in sections
+        if "\n".join(section["lines"]).strip()
+    ]
+
+
+def score_section(section: dict, index: int) -> float:
+    """按架构相关性为章节打分，分数越高越优先保留"""
+    heading = section["heading"].lower()
+    text = section["text"]
+    score = 1.0
+
+    # 标题前的导言通常是项目描述
+    if section["level"] == 0:
+        score += 3.0
+    if any(keyword in heading for keyword in RELEVANT_HEADING_KEYWORDS):
+        score += 2.0
+    if any(keyword in heading for keyword in BOILERPLATE_HEADING_KEYWORDS):
+        score -= 2.0
+
+    lines = [line for line in text.split("\n") if line.strip()]
+    if lines:
+        # 表格和代码块占比高的章节（安装矩阵、命令列表）价值较低
+        table_ratio = sum(1 for line in lines if line.lstrip().startswith("|")) / len(lines)
+        score -= table_ratio * 1.5
+        fence_ratio = text.count("```") * 2 / len(lines)
+        score -= min(fence_ratio, 1.0) * 0.5
+
+    # 越靠前的章节越可能描述项目整体，越深层的标题越细节
+    score -= min(index, 20) * 0.05
+    score -= max(section["level"] - 2, 0) * 0.25
+    return score
+
+
+def trim_readme(
+    readme: str,
+    token_budget: int,
+    count_tokens: Callable[[str], int],
+    tokenizer: str,
+) -> dict:
+    """
+    按章节裁剪README以适应令牌预算
+
+    先去除徽章、图片和HTML噪声，再按架构相关性对章节排序，
+    在预算内保留得分最高的章节并维持原有顺序。结果按README blob哈希和分词器缓存。
+
+    Args:
+        readme: README原文
+        token_budget: 目标令牌数
+        count_tokens: AI服务的令牌计数函数（仅在未命中缓存时调用一次）
+        tokenizer: 计数函数对应的分词器标识（如 "claude/claude-3-5-sonnet"），结果中的令牌数只对该分词器有效
+
+    Returns:
+        dict: 包含裁剪后的readme以及original_tokens、tokens、
+              dropped_sections、blob_hash等信息
+    """
+    blob_hash = readme_blob_hash(readme)
+    cache_key = (blob_hash, token_budget, tokenizer)
+    if cache_key in _trim_cache:
+        _trim_cache.move_to_end(cache_key)
+        return _trim_cache[cache_key]
+
+    original_tokens = count_tokens(readme) if readme else 0
+    result = {
+        "readme": readme,
+        "original_tokens": original_tokens,
+        "tokens": original_tokens,
+        "dropped_sections": [],
+        "blob_hash": blob_hash,
+    }
+
+    if original_tokens > token_budget:
+        chars_per_token = max(len(readme) / original_tokens, 1.0)
+
+        def estimate(text: str) -> int:
+            return int(len(text) / chars_per_token) + 1
+
+        sections = parse_sections(strip_readme_noise(readme))
+        scores = [score_section(section, i) for i, section in enumerate(sections)]
+        ranked = sorted(range(len(sections)), key=lambda i: scores[i], reverse=True)
+        kept: dict[int, str] = {}
+        remaining = token_budget
+        for i in ranked:
+            text = sections[i]["text"]
+            cost = estimate(text)
+            if cost <= remaining:
+                kept[i] = text
+                remaining -= cost
+            elif scores[i] > 0 and (not kept or remaining > 200):
+                # 相关章节放不下时，截断保留开头部分；样板章节只整体保留
+                cut = int(remaining * chars_per_token)
+                kept[i] = text[:cut].rsplit("\n", 1)[0] + "\n..."
+                remaining = 0
+            if remaining <= 0:
+                break
+
+        trimmed = "\n\n".join(kept[i] for i in sorted(kept))
+        result.update(
+            {
+                "readme": trimmed,
+                "tokens": estimate(trimmed),
+                "dropped_sections": [
+                    sections[i]["heading"]
+                    for i in range(len(sections))
+                    if i not in kept and sections[i]["heading"]
+                ],
+            }
+        )
+
+    _trim_cache[cache_key] = result
+    if len(_trim_cache) > _TRIM_CACHE_SIZE:
+        _trim_cache.popitem(last=False)
+    return result
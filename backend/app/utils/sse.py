@@ -0,0 +1,380 @@
+from collections import deque
+from dotenv import load_dotenv
+from fastapi.responses import StreamingResponse
+from functools import lru_cache
+from json.encoder import encode_basestring_ascii
+from starlette.types import Receive, Scope, Send
+from typing import AsyncGenerator, AsyncIterator, Callable, TypeVar
+import asyncio
+import json
+import os
+import re
+import time
+
+load_dotenv()
+
+# 每个事件流缓冲的最大帧数和字节数（生成流程与写出客户端之间）
+SSE_QUEUE_SIZE = int(os.getenv("SSE_QUEUE_SIZE", "256"))
+SSE_MAX_BUFFER_BYTES = int(os.getenv("SSE_MAX_BUFFER_BYTES", str(1024 * 1024)))
+
+# 缓冲区满时的处理方式:
+#   coalesce - 超出SSE_FLUSH_BYTES也继续将文本片段合并到最后一个同类帧，无法合并时按block处理（默认）
+#   block    - 暂停读取上游，最多等待SSE_SLOW_CLIENT_SECONDS秒，超时后中止事件流
+#   abort    - 立即中止事件流
+SSE_OVERFLOW_POLICY = os.getenv("SSE_OVERFLOW_POLICY", "coalesce").lower()
+SSE_SLOW_CLIENT_SECONDS = float(os.getenv("SSE_SLOW_CLIENT_SECONDS", "30"))
+
+# 文本片段的合并：同类片段最多等待SSE_FLUSH_INTERVAL秒或累积到SSE_FLUSH_BYTES字节后写出一帧
+# （0表示不等待，只合并客户端读取时已积压的片段）
+SSE_FLUSH_INTERVAL = float(os.getenv("SSE_FLUSH_INTERVAL", "0.05"))
+SSE_FLUSH_BYTES = int(os.getenv("SSE_FLUSH_BYTES", "4096"))
+
+# 超过该秒数没有事件时发送SSE注释行，避免代理（nginx的300秒超时）断开空闲连接
+SSE_HEARTBEAT_SECONDS = float(os.getenv("SSE_HEARTBEAT_SECONDS", "15"))
+
+HEARTBEAT_FRAME = ": keep-alive\n\n"
+
+SLOW_CLIENT_MESSAGE = "客户端读取过慢，事件流已中止，请重新生成。"
+
+# json.dumps（ensure_ascii）需要转义的字符：引号、反斜杠和可打印ASCII之外的字符
+_NEEDS_ESCAPE = re.compile(r'["\\]|[^ -~]')
+
+T = TypeVar("T")
+
+
+@lru_cache(maxsize=64)
+def _envelope(status: str) -> tuple[str, str]:
+    """文本片段事件预先编码的帧头和帧尾，与json.dumps的输出逐字节一致"""
+    return f'data: {{"status": {json.dumps(status)}, "chunk": "', '"}\n\n'
+
+
+def escape_chunk(text: str) -> str:
+    """按JSON字符串转义文本（不含两侧引号）；大多数片段不含需要转义的字符，直接返回"""
+    if _NEEDS_ESCAPE.search(text) is None:
+        return text
+    return encode_basestring_ascii(text)[1:-1]
+
+
+def chunk_parts(event) -> tuple[str, str] | None:
+    """
+    拆分文本片段事件（如 {'status': 'diagram_chunk', 'chunk': ...}）
+
+    Returns:
+        tuple[str, str] | None: (状态, 转义后的文本)；不是文本片段事件时返回None
+    """
+    if type(event) is dict and len(event) == 2 and "chunk" in event:
+        status = event.get("status")
+        chunk = event["chunk"]
+        if type(status) is str and type(chunk) is str:
+            return status, escape_chunk(chunk)
+    return None
+
+
+def encode_event(event: dict) -> str:
+    """将事件编码为SSE帧"""
+    parts = chunk_parts(event)
+    if parts is not None:
+        prefix, suffix = _envelope(parts[0])
+        return prefix + parts[1] + suffix
+    return f"data: {json.dumps(event)}\n\n"
+
+
+class _Frame:
+    """缓冲区中的一帧；文本片段帧保存转义后的片段，写出时才拼接"""
+
+    __slots__ = ("key", "parts", "size", "created_at")
+
+    def __init__(self, key: str | None, parts: list[str], size: int):
+        self.key = key
+        self.parts = parts
+        self.size = size
+        self.created_at = time.monotonic()
+
+    def render(self) -> str:
+        if self.key is None:
+            return self.parts[0]
+        prefix, suffix = _envelope(self.key)
+        return "".join([prefix, *self.parts, suffix])
+
+
+class SSEBuffer:
+    """
+    单个事件流在生成流程（生产者）和客户端写出（消费者）之间的有界缓冲区
+
+    相邻的同类文本片段合并为一帧（不超过SSE_FLUSH_BYTES），按帧数和字节数计算占用。
+    """
+
+    def __init__(
+        self,
+        encode: Callable[[T], str],
+        coalesce: bool,
+        max_events: int = SSE_QUEUE_SIZE,
+        max_bytes: int = SSE_MAX_BUFFER_BYTES,
+        policy: str = SSE_OVERFLOW_POLICY,
+    ):
+        self.encode = encode
+        self.coalesce = coalesce
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.frames: deque[_Frame] = deque()
+        self.bytes = 0
+        self.high_watermark = 0.0
+        self.events = 0
+        self.written = 0
+        self.coalesced = 0
+        self.overflows = 0
+        self.closed = False
+        self._wakeup = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+
+    @property
+    def occupancy(self) -> float:
+        """缓冲区占用率（帧数和字节数中较高的比例）"""
+        return max(len(self.frames) / self.max_events, self.bytes / self.max_bytes)
+
+    def _fits(self, size: int) -> bool:
+        return len(self.frames) < self.max_events and self.bytes + size <= self.max_bytes
+
+    def _append(self, frame: _Frame) -> None:
+        self.frames.append(frame)
+        self.bytes += frame.size
+        self.high_watermark = max(self.high_watermark, min(self.occupancy, 1.0))
+        self._wakeup.set()
+        if not self._fits(0):
+            self._not_full.clear()
+
+    def _merge(self, tail: _Frame, text: str) -> None:
+        tail.parts.append(text)
+        tail.size += len(text)
+        self.bytes += len(text)
+        self.coalesced += 1
+        if tail.size >= SSE_FLUSH_BYTES:
+            # 达到字节阈值：唤醒等待合并的读取方
+            self._wakeup.set()
+
+    async def put(self, item) -> bool:
+        """
+        写入一个事件；文本片段优先合并到缓冲区末尾的同类帧，缓冲区满时按溢出策略处理
+
+        Returns:
+            bool: 是否写入成功；为False时应中止事件流（客户端读取过慢）
+        """
+        self.events += 1
+        parts = chunk_parts(item) if self.coalesce else None
+        if parts is not None:
+            key, text = parts
+            tail = self.frames[-1] if self.frames else None
+            if tail is not None and tail.key == key:
+                if tail.size + len(text) <= SSE_FLUSH_BYTES:
+                    self._merge(tail, text)
+                    return True
+                if (
+                    self.policy == "coalesce"
+                    and not self._fits(0)
+                    and self.bytes + len(text) <= self.max_bytes
+                ):
+                    # 缓冲区已满：超出字节阈值也继续合并
+                    self.overflows += 1
+                    self._merge(tail, text)
+                    return True
+            prefix, suffix = _envelope(key)
+            frame = _Frame(key, [text], len(prefix) + len(text) + len(suffix))
+        else:
+            encoded = self.encode(item)
+            frame = _Frame(None, [encoded], len(encoded))
+
+        if self._fits(frame.size):
+            self._append(frame)
+            return True
+
+        self.overflows += 1
+        if self.policy == "abort":
+            return False
+        try:
+            async with asyncio.timeout(SSE_SLOW_CLIENT_SECONDS):
+                while not self._fits(frame.size):
+                    self._not_full.clear()
+                    await self._not_full.wait()
+        except TimeoutError:
+            return False
+        self._append(frame)
+        return True
+
+    def put_final(self, encoded: str) -> None:
+        """写入最后一帧（如错误信息），不受容量限制"""
+        self._append(_Frame(None, [encoded], len(encoded)))
+
+    def close(self) -> None:
+        self.closed = True
+        self._wakeup.set()
+
+    async def _wait(self, timeout: float) -> bool:
+        self._wakeup.clear()
+        try:
+            async with asyncio.timeout(timeout):
+                await self._wakeup.wait()
+        except TimeoutError:
+            return False
+        return True
+
+    async def get(self, timeout: float) -> str | None:
+        """
+        读取下一帧；timeout秒内没有新帧时返回心跳帧
+
+        缓冲区中只有一个仍在合并的文本片段帧时，等待它满SSE_FLUSH_INTERVAL秒、达到
+        SSE_FLUSH_BYTES字节或有后续事件后再写出。
+
+        Returns:
+            str | None: SSE帧；缓冲区已关闭且读完时返回None
+        """
+        while True:
+            if self.frames:
+                head = self.frames[0]
+                if head.key is not None and len(self.frames) == 1 and not self.closed and head.size < SSE_FLUSH_BYTES:
+                    remaining = head.created_at + SSE_FLUSH_INTERVAL - time.monotonic()
+                    if remaining > 0:
+                        await self._wait(remaining)
+                        continue
+                self.frames.popleft()
+                self.bytes -= head.size
+                self.written += 1
+                if self._fits(0):
+                    self._not_full.set()
+                return head.render()
+            if self.closed:
+                return None
+            if not await self._wait(timeout):
+                return HEARTBEAT_FRAME
+
+
+class SSEMonitor:
+    """统计进程内所有事件流的缓冲区占用、合并、心跳和因读取过慢被中止的次数"""
+
+    def __init__(self):
+        self.active: set[SSEBuffer] = set()
+        self.streams = 0
+        self.events = 0
+        self.written = 0
+        self.heartbeats = 0
+        self.coalesced = 0
+        self.overflows = 0
+        self.slow_clients = 0
+        self.high_watermark = 0.0
+
+    def register(self, buffer: SSEBuffer) -> None:
+        self.active.add(buffer)
+        self.streams += 1
+
+    def unregister(self, buffer: SSEBuffer) -> None:
+        self.active.discard(buffer)
+        self.events += buffer.events
+        self.written += buffer.written
+        self.coalesced += buffer.coalesced
+        self.overflows += buffer.overflows
+        self.high_watermark = max(self.high_watermark, buffer.high_watermark)
+
+    def stats(self) -> dict:
+        events = self.events + sum(buffer.events for buffer in self.active)
+        written = self.written + sum(buffer.written for buffer in self.active)
+        return {
+            "active": len(self.active),
+            "buffered_frames": sum(len(buffer.frames) for buffer in self.active),
+            "buffered_bytes": sum(buffer.bytes for buffer in self.active),
+            "max_occupancy": round(max((buffer.occupancy for buffer in self.active), default=0.0), 3),
+            "high_watermark": round(
+                max([self.high_watermark] + [buffer.high_watermark for buffer in self.active]), 3
+            ),
+            "streams": self.streams,
+            "events": events,
+            "frames": written,
+            "events_per_frame": round(events / written, 2) if written else 0.0,
+            "heartbeats": self.heartbeats,
+            "coalesced": self.coalesced + sum(buffer.coalesced for buffer in self.active),
+            "overflows": self.overflows + sum(buffer.overflows for buffer in self.active),
+            "slow_clients": self.slow_clients,
+        }
+
+
+# 进程内共享的事件流统计
+sse_monitor = SSEMonitor()
+
+
+async def sse_stream(
+    events: AsyncIterator[T],
+    encode: Callable[[T], str] = encode_event,
+    coalesce: bool = True,
+) -> AsyncGenerator[str, None]:
+    """
+    在独立任务中消费事件流，经有界缓冲区转发为SSE帧
+
+    - 相邻的同类文本片段在SSE_FLUSH_INTERVAL秒/SSE_FLUSH_BYTES字节内合并为一帧，
+      合并后的帧与逐个片段的帧对客户端等价（片段文本按顺序拼接）
+    - 客户端读取慢时缓冲区吸收突发片段，满后按SSE_OVERFLOW_POLICY合并片段或暂停上游，
+      超过SSE_SLOW_CLIENT_SECONDS仍无法写入时中止事件流并关闭上游
+    - 空闲超过SSE_HEARTBEAT_SECONDS时发送注释行心跳
+    - 转发方被关闭（如客户端断开）时取消消费任务，取消会沿调用链中止上游流
+
+    Args:
+        events: 事件流（如生成流程）
+        encode: 将事件编码为SSE帧的函数
+        coalesce: 是否合并文本片段事件（带编号的事件流应为False）
+
+    Yields:
+        str: SSE帧
+    """
+    buffer = SSEBuffer(encode, coalesce)
+    sse_monitor.register(buffer)
+
+    async def produce() -> None:
+        try:
+            async for item in events:
+                if not await buffer.put(item):
+                    sse_monitor.slow_clients += 1
+                    print(f"客户端读取过慢（缓冲 {len(buffer.frames)} 帧，{buffer.bytes} 字节），中止事件流")
+                    buffer.put_final(encode_event({'error': SLOW_CLIENT_MESSAGE}))
+                    return
+        finally:
+            # 提前结束时关闭上游事件流（async for 不会自动关闭）
+            aclose = getattr(events, "aclose", None)
+            if aclose is not None:
+                await aclose()
+            buffer.close()
+
+    task = asyncio.create_task(produce())
+    try:
+        while True:
+            frame = await buffer.get(SSE_HEARTBEAT_SECONDS)
+            if frame is None:
+                break
+            if frame is HEARTBEAT_FRAME:
+                sse_monitor.heartbeats += 1
+            yield frame
+        # 传播事件流中的异常
+        await task
+    finally:
+        # 先登记：客户端断开时所在的取消范围会再次取消下面的等待
+        sse_monitor.unregister(buffer)
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+
+class SSEStreamingResponse(StreamingResponse):
+    """
+    响应结束（包括客户端断开）后立即关闭事件生成器的StreamingResponse
+
+    StreamingResponse在客户端断开时只取消发送任务，生成器停在yield处，要等到被垃圾回收
+    才会关闭；这里显式关闭，使生成器的finally（取消上游流、归还准入名额）及时执行。
+    """
+
+    media_type = "text/event-stream"
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            aclose = getattr(self.body_iterator, "aclose", None)
+            if aclose is not None:
+                await aclose()
@@ -0,0 +1,122 @@
+import asyncio
+from typing import AsyncGenerator, AsyncIterator
+
+_DONE = object()
+
+
+async def merge_async_streams(
+    streams: dict[str, AsyncIterator[str]],
+) -> AsyncGenerator[tuple[str, str], None]:
+    """
+    并发消费多个异步流，按到达顺序产出 (流名称, 片段)
+
+    任一流抛出异常时立即向上抛出，并取消其余仍在运行的流。
+
+    Args:
+        streams: 流名称到异步迭代器的映射
+
+    Yields:
+        tuple[str, str]: (流名称, 片段)
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def pump(name: str, stream: AsyncIterator[str]) -> None:
+        try:
+            async for item in stream:
+                await queue.put((name, item, None))
+        except Exception as e:
+            await queue.put((name, None, e))
+        finally:
+            await queue.put((name, _DONE, None))
+
+    tasks = [asyncio.create_task(pump(name, stream)) for name, stream in streams.items()]
+    remaining = len(tasks)
+    try:
+        while remaining:
+            name, item, error = await queue.get()
+            if error is not None:
+                raise error
+            if item is _DONE:
+                remaining -= 1
+                continue
+            yield name, item
+    finally:
+        for task in tasks:
+            task.cancel()
+        # 等待被取消的流结束，确保上游连接在返回前关闭
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class TaggedStreamDemultiplexer:
+    """
+    将一个包含多个XML风格标签段落的流拆分为各段落的片段
+
+    例如单次调用模式下模型依次输出 `<explanation>...</explanation>`、
+    `<component_mapping>...</component_mapping>` 和 `<diagram>...</diagram>`，
+    标签可能被拆分在相邻的片段中。标签之外的文本会被丢弃。
+    """
+
+    def __init__(self, sections: dict[str, str]):
+        """
+        Args:
+            sections: 标签名到段落名的映射，如 {"component_mapping": "mapping"}
+        """
+        self.sections = sections
+        self.current: str | None = None
+        self.buffer = ""
+        self._max_open_tag = max(len(f"<{tag}>") for tag in sections)
+
+    def feed(self, chunk: str) -> list[tuple[str, str]]:
+        """
+        输入一个流片段
+
+        Returns:
+            list[tuple[str, str]]: 可以立即输出的 (段落名, 文本) 列表
+        """
+        self.buffer += chunk
+        output: list[tuple[str, str]] = []
+        while True:
+            if self.current is None:
+                positions = [
+                    (self.buffer.find(f"<{tag}>"), tag)
+                    for tag in self.sections
+                    if f"<{tag}>" in self.buffer
+                ]
+                if not positions:
+                    # 保留可能是起始标签前缀的尾部
+                    self.buffer = self.buffer[-(self._max_open_tag - 1):]
+                    return output
+                index, tag = min(positions)
+                self.current = tag
+                self.buffer = self.buffer[index + len(f"<{tag}>"):]
+                continue
+
+            close_tag = f"</{self.current}>"
+            index = self.buffer.find(close_tag)
+            if index != -1:
+                if index:
+                    output.append((self.sections[self.current], self.buffer[:index]))
+                self.buffer = self.buffer[index + len(close_tag):]
+                self.current = None
+                continue
+
+            # 结束标签可能被拆分：保留可能是其前缀的尾部
+            keep = 0
+            for length in range(min(len(close_tag) - 1, len(self.buffer)), 0, -1):
+                if close_tag.startswith(self.buffer[-length:]):
+                    keep = length
+                    break
+            emit = self.buffer[: len(self.buffer) - keep]
+            if emit:
+                output.append((self.sections[self.current], emit))
+            self.buffer = self.buffer[len(self.buffer) - keep:]
+            return output
+
+    def flush(self) -> list[tuple[str, str]]:
+        """流结束时输出剩余文本（未闭合的段落按已结束处理）"""
+        output = []
+        if self.current is not None and self.buffer:
+            output.append((self.sections[self.current], self.buffer))
+        self.buffer = ""
+        self.current = None
+        return output
@@ -0,0 +1,146 @@
+import re
+
+from app.utils.tree_summarizer import is_structural_path
+
+# 解释文本中常见但对路径匹配无意义的词
+STOPWORDS = {
+    "the", "and", "for", "with", "that", "this", "from", "into", "are", "was",
+    "its", "their", "which", "each", "such", "also", "should", "would", "could",
+    "can", "will", "use", "uses", "used", "using", "based", "via", "all", "any",
+    "other", "these", "those", "between", "include", "including", "includes",
+    "diagram", "component", "components", "system", "project", "layer", "layers",
+    "service", "services", "module", "modules", "file", "files", "directory",
+    "directories", "folder", "code", "main", "data", "flow", "design", "user",
+    "users", "explanation", "architecture", "engineer", "arrows", "color", "show",
+    "clear", "labels", "represent", "node", "nodes", "key", "core", "handles",
+}
+
+# 每个匹配目录最多保留的子条目数
+MAX_ENTRIES_PER_MATCH = 40
+# 剪枝后保留比例超过该值时直接返回原始文件树
+MAX_KEPT_RATIO = 0.8
+
+_PATH_HINT_PATTERN = re.compile(r"[\w.\-]+(?:/[\w.\-]+)+/?|[\w\-]+\.[A-Za-z]{1,5}\b")
+
+
+def normalize_name(name: str) -> str:
+    """规范化名称：小写、去除非字母数字字符并去掉简单复数后缀"""
+    normalized = re.sub(r"[^a-z0-9]", "", name.lower())
+    # 使 "routers" 与 "router" 能够匹配
+    if len(normalized) > 3 and normalized.endswith("s") and not normalized.endswith("ss"):
+        normalized = normalized[:-1]
+    return normalized
+
+
+def name_variants(name: str) -> set[str]:
+    """返回名称的规范化形式及其拆分单词（支持 camelCase / snake_case / kebab-case）"""
+    stem = name.rsplit(".", 1)[0] if "." in name[1:] else name
+    words = re.findall(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+", stem)
+    variants = {normalize_name(stem)}
+    variants.update(normalize_name(w) for w in words if len(w) >= 3)
+    return {v for v in variants if v}
+
+
+def extract_hints(explanation: str) -> dict:
+    """
+    从阶段1的解释中提取路径提示和组件名提示
+
+    Returns:
+        dict: paths为显式路径（如 `app/routers`、`main.py`），names为规范化后的名称词
+    """
+    paths = {
+        match.group(0).strip("/").lower()
+        for match in _PATH_HINT_PATTERN.finditer(explanation)
+    }
+    names: set[str] = set()
+    for word in re.findall(r"[A-Za-z][A-Za-z0-9_\-]{2,}", explanation):
+        for variant in name_variants(word):
+            if len(variant) >= 3 and variant not in STOPWORDS:
+                names.add(variant)
+    return {"paths": paths, "names": names}
+
+
+def prune_file_tree(file_tree: str, explanation: str) -> dict:
+    """
+    根据阶段1的解释剪枝文件树，供阶段2组件映射使用
+
+    只保留顶层条目、结构性文件，以及与解释中提到的路径或组件名匹配的子树。
+
+    Args:
+        file_tree: 换行分隔的路径列表
+        explanation: 阶段1生成的解释
+
+    Returns:
+        dict: 包含剪枝后的file_tree以及original_entries、entries、matched_paths
+    """
+    paths = [line for line in file_tree.split("\n") if line.strip()]
+    result = {
+        "file_tree": file_tree,
+        "original_entries": len(paths),
+        "entries": len(paths),
+        "matched_paths": [],
+    }
+    if not paths or not explanation:
+        return result
+
+    hints = extract_hints(explanation)
+    lowered = [p.lower() for p in paths]
+
+    matched: set[str] = set()
+    # 需要展开子树的匹配：显式路径提示，或非顶层的名称匹配（顶层目录本身总会保留）
+    expanded: set[str] = set()
+    for path, lower in zip(paths, lowered):
+        # 汇总条目如 "tests/fixtures/ (12 .json files)" 只取路径部分
+        clean = lower.split(" (", 1)[0].rstrip("/")
+        if any(clean == hint or clean.endswith("/" + hint) for hint in hints["paths"]):
+            matched.add(path)
+            expanded.add(path.split(" (", 1)[0].rstrip("/"))
+            continue
+        segment = clean.rsplit("/", 1)[-1]
+        if normalize_name(segment.rsplit(".", 1)[0]) in hints["names"]:
+            matched.add(path)
+            if "/" in clean:
+                expanded.add(path.split(" (", 1)[0].rstrip("/"))
+
+    if not matched:
+        return result
+
+    # 最具体的前缀优先，使深层匹配不被上层目录的条目上限挤掉
+    matched_prefixes = sorted(expanded, key=len, reverse=True)
+    # 匹配目录下的子条目（受MAX_ENTRIES_PER_MATCH限制）
+    per_match_counts: dict[str, int] = {}
+    keep: set[str] = set()
+    for path in paths:
+        clean = path.split(" (", 1)[0].rstrip("/")
+        if "/" not in clean or is_structural_path(clean) or path in matched:
+            keep.add(path)
+            continue
+        for prefix in matched_prefixes:
+            if clean.startswith(prefix + "/"):
+                count = per_match_counts.get(prefix, 0)
+                if count < MAX_ENTRIES_PER_MATCH:
+                    per_match_counts[prefix] = count + 1
+                    keep.add(path)
+                break
+
+    # 保留匹配条目的祖先目录以维持层级上下文
+    path_set = set(paths)
+    for path in list(keep):
+        parts = path.split(" (", 1)[0].rstrip("/").split("/")
+        for i in range(1, len(parts)):
+            ancestor = "/".join(parts[:i])
+            if ancestor in path_set:
+                keep.add(ancestor)
+
+    pruned = [p for p in paths if p in keep]
+    if len(pruned) > len(paths) * MAX_KEPT_RATIO:
+        return result
+
+    result.update(
+        {
+            "file_tree": "\n".join(pruned),
+            "entries": len(pruned),
+            "matched_paths": sorted(matched),
+        }
+    )
+    return result
@@ -0,0 +1,230 @@
+import os
+from collections import Counter
+from typing import Callable
+
+# 结构性文件：即使所在目录被折叠，也始终完整保留
+MANIFEST_FILES = {
+    "package.json",
+    "pyproject.toml",
+    "setup.py",
+    "setup.cfg",
+    "requirements.txt",
+    "pipfile",
+    "cargo.toml",
+    "go.mod",
+    "pom.xml",
+    "build.gradle",
+    "build.gradle.kts",
+    "settings.gradle",
+    "gemfile",
+    "composer.json",
+    "mix.exs",
+    "cmakelists.txt",
+    "makefile",
+    "dockerfile",
+    "docker-compose.yml",
+    "docker-compose.yaml",
+    "tsconfig.json",
+    "next.config.js",
+    "vite.config.ts",
+    "webpack.config.js",
+}
+
+ENTRYPOINT_STEMS = {
+    "main",
+    "index",
+    "app",
+    "server",
+    "cli",
+    "manage",
+    "__main__",
+    "wsgi",
+    "asgi",
+    "lib",
+    "mod",
+}
+
+# 目录中占比超过该阈值的扩展名视为"同质"目录，优先折叠
+HOMOGENEOUS_RATIO = 0.8
+# 少于该数量文件的目录不值得折叠
+MIN_COLLAPSE_FILES = 3
+
+
+def is_structural_path(path: str) -> bool:
+    """判断路径是否为需要完整保留的结构性文件（清单文件或入口文件）"""
+    name = path.rsplit("/", 1)[-1].lower()
+    if name in MANIFEST_FILES:
+        return True
+    stem, ext = os.path.splitext(name)
+    return bool(ext) and stem in ENTRYPOINT_STEMS
+
+
+def _extension(path: str) -> str:
+    ext = os.path.splitext(path.rsplit("/", 1)[-1])[1].lower()
+    return ext or "(no ext)"
+
+
+def _aggregate_label(directory: str, files: list[str]) -> str:
+    counts = Counter(_extension(f) for f in files)
+    if len(counts) == 1:
+        ext = next(iter(counts))
+        return f"{directory}/ ({len(files):,} {ext} files)"
+    parts = [f"{count:,} {e}" for e, count in counts.most_common(3)]
+    other = len(files) - sum(count for _, count in counts.most_common(3))
+    if other:
+        parts.append(f"{other:,} other")
+    return f"{directory}/ ({len(files):,} files: {', '.join(parts)})"
+
+
+def summarize_file_tree(
+    file_tree: str,
+    token_budget: int,
+    count_tokens: Callable[[str], int],
+) -> dict:
+    """
+    将文件树压缩到目标令牌预算内
+
+    大型同质目录会被折叠为聚合条目（如 `tests/fixtures/ (2,341 .json files)`），
+    顶层目录、清单文件和入口文件始终完整保留。
+
+    Args:
+        file_tree: 由GitService.get_file_tree返回的换行分隔路径列表
+        token_budget: 目标令牌数
+        count_tokens: AI服务的令牌计数函数（只调用一次，用于估算每字符令牌数）
+
+    Returns:
+        dict: 包含压缩后的file_tree以及original_tokens、tokens、
+              elided_files、collapsed_dirs、truncated等统计信息
+    """
+    original_tokens = count_tokens(file_tree) if file_tree else 0
+    result = {
+        "file_tree": file_tree,
+        "original_tokens": original_tokens,
+        "tokens": original_tokens,
+        "elided_files": 0,
+        "collapsed_dirs": 0,
+        "truncated": False,
+    }
+    if original_tokens <= token_budget:
+        return result
+
+    paths = [line for line in file_tree.split("\n") if line.strip()]
+    chars_per_token = max(len(file_tree) / original_tokens, 1.0)
+
+    def line_cost(line: str) -> float:
+        return (len(line) + 1) / chars_per_token
+
+    # 所有目录（包括只作为前缀出现的目录，GitLab/Gitea 只返回文件）
+    directories: set[str] = set()
+    for path in paths:
+        parts = path.split("/")
+        for i in range(1, len(parts)):
+            directories.add("/".join(parts[:i]))
+
+    files = [p for p in paths if p not in directories]
+    # 每个目录下（递归）可折叠的文件
+    subtree_files: dict[str, list[str]] = {d: [] for d in directories}
+    # 每个目录子树当前的渲染成本，以及折叠后仍需保留的结构性文件成本
+    subtree_cost: dict[str, float] = {d: 0.0 for d in directories}
+    structural_cost: dict[str, float] = {d: 0.0 for d in directories}
+    for path in paths:
+        parts = path.split("/")
+        cost = line_cost(path)
+        is_directory = path in directories
+        structural = not is_directory and is_structural_path(path)
+        for i in range(1, len(parts)):
+            ancestor = "/".join(parts[:i])
+            subtree_cost[ancestor] += cost
+            if structural:
+                structural_cost[ancestor] += cost
+            elif not is_directory:
+                subtree_files[ancestor].append(path)
+
+    def is_homogeneous(directory: str) -> bool:
+        counts = Counter(_extension(f) for f in subtree_files[directory])
+        return counts.most_common(1)[0][1] / len(subtree_files[directory]) >= HOMOGENEOUS_RATIO
+
+    collapsed: dict[str, str] = {}
+    estimated = sum(line_cost(p) for p in paths)
+
+    def collapsed_ancestor(path: str) -> str | None:
+        parts = path.split("/")
+        for i in range(1, len(parts)):
+            ancestor = "/".join(parts[:i])
+            if ancestor in collapsed:
+                return ancestor
+        return None
+
+    def collapse(directory: str) -> None:
+        nonlocal estimated
+        label = _aggregate_label(directory, subtree_files[directory])
+        new_cost = line_cost(label) + structural_cost[directory]
+        delta = subtree_cost[directory] - new_cost
+        for d in list(collapsed):
+            if d.startswith(directory + "/"):
+                del collapsed[d]
+        collapsed[directory] = label
+        estimated -= delta
+        parts = directory.split("/")
+        for i in range(1, len(parts) + 1):
+            subtree_cost["/".join(parts[:i])] -= delta
+
+    candidates = [
+        d for d in directories if len(subtree_files[d]) >= MIN_COLLAPSE_FILES
+    ]
+    # 第一轮只折叠同质的非顶层目录，第二轮折叠任意非顶层目录，最后才折叠顶层目录的内容
+    passes = [
+        [d for d in candidates if "/" in d and is_homogeneous(d)],
+        [d for d in candidates if "/" in d],
+        [d for d in candidates if "/" not in d],
+    ]
+    for group in passes:
+        group.sort(key=lambda d: subtree_cost[d], reverse=True)
+        for directory in group:
+            if estimated <= token_budget:
+                break
+            if directory in collapsed or collapsed_ancestor(directory):
+                continue
+            collapse(directory)
+
+    lines = []
+    emitted: set[str] = set()
+    for path in paths:
+        ancestor = collapsed_ancestor(path)
+        if ancestor is None:
+            lines.append(collapsed.get(path, path))
+            emitted.add(path)
+            continue
+        if ancestor not in emitted:
+            lines.append(collapsed[ancestor])
+            emitted.add(ancestor)
+        if is_structural_path(path) and path not in directories:
+            lines.append(path)
+
+    # 折叠所有目录后仍超预算时，按顺序截断
+    summary = "\n".join(lines)
+    if estimated > token_budget:
+        kept: list[str] = []
+        spent = 0.0
+        for line in lines:
+            spent += line_cost(line)
+            if spent > token_budget:
+                break
+            kept.append(line)
+        remaining = len(lines) - len(kept)
+        kept.append(f"... ({remaining:,} more entries omitted)")
+        summary = "\n".join(kept)
+        result["truncated"] = True
+        estimated = min(estimated, float(token_budget))
+
+    file_set = set(files)
+    kept_files = sum(1 for line in summary.split("\n") if line in file_set)
+    result.update(
+        {
+            "file_tree": summary,
+            "tokens": int(estimated),
+            "elided_files": len(files) - kept_files,
+            "collapsed_dirs": len(collapsed),
+        }
+    )
+    return result
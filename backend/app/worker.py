@@ -0,0 +1,28 @@
+from dotenv import load_dotenv
+import asyncio
+import signal
+from app.services.job_broker import JOB_BROKER, SqliteBroker, create_broker
+from app.services.job_worker import GenerationWorker
+
+load_dotenv()
+
+
+async def main() -> None:
+    """
+    独立的生成工作进程：从共享任务队列领取生成任务，收到SIGTERM/SIGINT后排空退出
+
+    用法: JOB_BROKER=sqlite python -m app.worker
+    """
+    broker = create_broker()
+    if not isinstance(broker, SqliteBroker):
+        raise SystemExit(f"JOB_BROKER={JOB_BROKER} 不支持独立的工作进程，请设置 JOB_BROKER=sqlite")
+
+    worker = GenerationWorker(broker)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, worker.drain)
+    await worker.run()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
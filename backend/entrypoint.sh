@@ -7,13 +7,17 @@ if [ "$ENVIRONMENT" = "development" ]; then
     exec uvicorn app.main:app --host 0.0.0.0 --port 8000 --reload
 elif [ "$ENVIRONMENT" = "production" ]; then
     echo "Starting in production mode with multiple workers..."
+    # 请求经由宿主机上的nginx和docker端口映射到达，对端地址是docker网关；
+    # 只信任docker私有网段转发的X-Forwarded-For，按真实客户端地址限流和调度
     exec uvicorn app.main:app \
         --host 0.0.0.0 \
         --port 8000 \
         --timeout-keep-alive 300 \
         --workers 2 \
         --loop uvloop \
-        --http httptools
+        --http httptools \
+        --proxy-headers \
+        --forwarded-allow-ips "${FORWARDED_ALLOW_IPS:-172.16.0.0/12}"
 else
     echo "ENVIRONMENT must be set to either 'development' or 'production'"
     exit 1
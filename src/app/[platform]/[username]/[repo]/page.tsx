@@ -60,13 +60,25 @@ export default function Repo() {
       </div>
       <div className="mt-8 flex w-full flex-col items-center gap-8">
         {loading ? (
-          <Loading
-            cost={cost}
-            status={state.status}
-            explanation={state.explanation}
-            mapping={state.mapping}
-            diagram={state.diagram}
-          />
+          <>
+            <Loading
+              cost={cost}
+              status={state.status}
+              explanation={state.explanation}
+              mapping={state.mapping}
+              diagram={state.diagram}
+            />
+            {state.snapshot && (
+              // Remount on every snapshot so mermaid renders the new text
+              <div className="flex w-full justify-center px-4 opacity-80">
+                <MermaidChart
+                  key={state.snapshot}
+                  chart={state.snapshot}
+                  zoomingEnabled={false}
+                />
+              </div>
+            )}
+          </>
         ) : error || state.error ? (
           <div className="mt-12 text-center">
             <p className="max-w-4xl text-lg font-medium text-purple-600">
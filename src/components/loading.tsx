@@ -36,6 +36,8 @@ interface LoadingProps {
     | "diagram_sent"
     | "diagram"
     | "diagram_chunk"
+    | "diagram_retry"
+    | "diagram_snapshot"
     | "complete"
     | "error";
   explanation?: string;
@@ -162,6 +164,8 @@ export default function Loading({
       case "diagram_sent":
       case "diagram":
       case "diagram_chunk":
+      case "diagram_retry":
+      case "diagram_snapshot":
         return {
           text: reasoningType
             ? "Model is reasoning about diagram structure"
@@ -20,12 +20,16 @@ interface StreamState {
     | "diagram_sent"
     | "diagram"
     | "diagram_chunk"
+    | "diagram_retry"
+    | "diagram_snapshot"
     | "complete"
     | "error";
   message?: string;
   explanation?: string;
   mapping?: string;
   diagram?: string;
+  // Renderable prefix of the diagram while phase 3 is still streaming
+  snapshot?: string;
   error?: string;
 }
 
@@ -37,6 +41,7 @@ interface StreamResponse {
   mapping?: string;
   diagram?: string;
   error?: string;
+  delta?: Partial<Record<"explanation" | "mapping", { offset: number; text: string }>>;
 }
 
 // AI平台到localStorage键名的映射
@@ -128,15 +133,19 @@ export function useDiagram(username: string, repo: string, platform = "github")
         let diagram = "";
 
         // Process the stream
+        const decoder = new TextDecoder();
+        let pending = "";
         const processStream = async () => {
           try {
             while (true) {
               const { done, value } = await reader.read();
               if (done) break;
 
-              // Convert the chunk to text
-              const chunk = new TextDecoder().decode(value);
-              const lines = chunk.split("\n");
+              // Convert the chunk to text; an SSE frame may span several reads,
+              // so keep the trailing partial line for the next one
+              pending += decoder.decode(value, { stream: true });
+              const lines = pending.split("\n");
+              pending = lines.pop() ?? "";
 
               // Process each SSE message
               for (const line of lines) {
@@ -220,10 +229,35 @@ export function useDiagram(username: string, repo: string, platform = "github")
                           setState((prev) => ({ ...prev, diagram }));
                         }
                         break;
+                      case "diagram_retry":
+                        // The server aborted a runaway diagram stream and is
+                        // generating it again: drop the chunks received so far
+                        diagram = "";
+                        setState((prev) => ({
+                          ...prev,
+                          status: "diagram",
+                          message: data.message,
+                          diagram,
+                          snapshot: undefined,
+                        }));
+                        break;
+                      case "diagram_snapshot":
+                        if (data.diagram) {
+                          const snapshot = data.diagram;
+                          setState((prev) => ({ ...prev, snapshot }));
+                        }
+                        break;
                       case "complete":
+                        // The complete event only re-sends the explanation when
+                        // post-processing changed it; otherwise use the streamed text
+                        if (data.delta?.explanation) {
+                          explanation =
+                            explanation.slice(0, data.delta.explanation.offset) +
+                            data.delta.explanation.text;
+                        }
                         setState({
                           status: "complete",
-                          explanation: data.explanation,
+                          explanation: data.explanation ?? explanation,
                           diagram: data.diagram,
                         });
                         const date = await getLastGeneratedDate(username, repo);